@@ -6,8 +6,13 @@ This module is an application for flashcarding Japanese.
 
 from __future__ import unicode_literals, print_function
 
+import json
+import logging
+import mimetypes
 import os
 import sqlite3
+import threading
+from urllib.request import pathname2url
 
 from flask import (
     Flask,
@@ -17,32 +22,277 @@ from flask import (
     g,
     request,
     abort,
+    jsonify,
+    send_file,
+    send_from_directory,
+    stream_with_context,
 )
+from jinja2 import FileSystemBytecodeCache
 
-from . import db
+from . import assets, cache, db, logs, pack, profiling, replenish, warmup
 
 
 APP = Flask(__name__)
+APP.config.setdefault('BACKGROUND_REFILL', True)
+# Requests slower than this are logged as warnings
+APP.config.setdefault('SLOW_REQUEST_SECONDS', 1.0)
+APP.config.setdefault('WARM_UP_IN_BACKGROUND', True)
 
+logs.configure()
+REQUEST_LOG = logging.getLogger(__name__ + '.requests')
 
-def get_db():
+# Progress of the warm-up started by configure_app
+WARM_UP = warmup.WarmUp()
+
+
+# Database paths whose schema and migrations already ran in this process
+INITIALIZED_DATABASES = set()
+INITIALIZED_DATABASES_LOCK = threading.Lock()
+
+
+def get_db_path():
     '''
-    Returns the cached database connection
+    Returns the path of the database this app is configured to use
     '''
-    if 'db' not in g:
-        print(str(os.environ))
-        db_path = os.environ.get('DATABASE', APP.config.get('DATABASE', 'example.db'))
-        print("DB STAT: " + str(os.stat(db_path)))
-        print("Dtabase: " + str(db_path))
-        g.db = sqlite3.connect(db_path)
-        g.db.row_factory = sqlite3.Row
-        cursor = g.db.cursor()
+    return os.environ.get('DATABASE', APP.config.get('DATABASE', 'example.db'))
+
+
+def connect(database, **kwargs):
+    '''
+    Opens a connection, timing its statements if the request is profiled
+    '''
+    if 'profiler' in g:
+        connection = sqlite3.connect(
+            database,
+            factory=profiling.ProfiledConnection,
+            **kwargs
+        )
+        connection.profiler = g.profiler
+    else:
+        connection = sqlite3.connect(database, **kwargs)
+    connection.row_factory = sqlite3.Row
+    return connection
+
+
+def init_db(db_path):
+    '''
+    Creates and migrates the schema and fills the working set, once per
+    process for each database, so read requests never have to write.
+    Concurrent callers wait for the first one to finish rather than
+    migrating the same database twice.
+    '''
+    with INITIALIZED_DATABASES_LOCK:
+        if db_path in INITIALIZED_DATABASES:
+            return
+        connection = sqlite3.connect(db_path)
+        cursor = connection.cursor()
         db.init(cursor)
-        g.db.commit()
+        connection.commit()
+        # WAL lets read-only requests keep going while a vote is being
+        # written.  Only switch once the schema exists: WAL writes the
+        # header of a new database, after which auto_vacuum can't be set
+        connection.execute('PRAGMA journal_mode=WAL')
         cursor.close()
+        connection.close()
+        INITIALIZED_DATABASES.add(db_path)
+
+
+def configure_app(config=None):
+    '''
+    Configures the module's APP and starts warming it up: migrations and
+    the working set check, compiling templates into a bytecode cache on
+    disk and reading in the database.  /healthz reports ready once that's
+    done.
+
+    This is not a factory: every call updates and returns the same APP, on
+    which the routes are registered.  Servers should start with
+    FLASK_APP="hikariita:configure_app()".
+    '''
+    global WARM_UP
+    if config:
+        APP.config.update(config)
+
+    template_cache_dir = APP.config.get(
+        'TEMPLATE_CACHE_DIR',
+        os.path.join(APP.instance_path, 'jinja'),
+    )
+    if not os.path.isdir(template_cache_dir):
+        os.makedirs(template_cache_dir)
+    APP.jinja_env.bytecode_cache = FileSystemBytecodeCache(template_cache_dir)
+
+    db_path = get_db_path()
+    steps = [
+        ('database', lambda: init_db(db_path)),
+        ('read_ahead', lambda: warmup.read_ahead(db_path)),
+        ('templates', lambda: warmup.compile_templates(APP.jinja_env)),
+        ('queries', lambda: warmup.touch_hot_pages(db_path)),
+    ]
+    if APP.config['BACKGROUND_REFILL']:
+        steps.append(('replenisher', lambda: replenish.get_replenisher(db_path)))
+    WARM_UP = warmup.WarmUp()
+    WARM_UP.start(steps, background=APP.config['WARM_UP_IN_BACKGROUND'])
+    return APP
+
+
+def get_db():
+    '''
+    Returns the cached read-write database connection, only for requests
+    that change something
+    '''
+    if 'db' not in g:
+        db_path = get_db_path()
+        init_db(db_path)
+        g.db = connect(db_path)
     return g.db
 
 
+def get_read_db():
+    '''
+    Returns the cached read-only database connection used by GET requests.
+    It can neither take nor wait for the write lock.
+    '''
+    if 'read_db' not in g:
+        db_path = get_db_path()
+        init_db(db_path)
+        uri = 'file:%s?mode=ro' % pathname2url(os.path.abspath(db_path))
+        g.read_db = connect(uri, uri=True)
+        g.read_db.execute('PRAGMA query_only = ON')
+    return g.read_db
+
+
+def get_metadata():
+    '''
+    Returns the books, preferences and facets, from the metadata cache
+    unless they changed since we last loaded them
+    '''
+    return cache.METADATA.get(
+        get_db_path(),
+        lambda: db.get_metadata(get_read_db().cursor()),
+    )
+
+
+@APP.teardown_appcontext
+def close_db(exception):
+    '''
+    Closes the connections opened during this request
+    '''
+    del exception
+    for name in ('db', 'read_db'):
+        connection = g.pop(name, None)
+        if connection is not None:
+            connection.close()
+
+
+@APP.before_request
+def start_request():
+    '''
+    Tags everything logged during this request with its id
+    '''
+    logs.start_request()
+
+
+@APP.after_request
+def log_request(response):
+    '''
+    Logs how long this request took, as a warning if it was slow
+    '''
+    response.headers['X-Request-Id'] = g.request_id
+    elapsed = logs.request_elapsed()
+    slow = elapsed > APP.config['SLOW_REQUEST_SECONDS']
+    if request.endpoint != 'healthz':
+        WARM_UP.record_request(slow)
+    if slow:
+        REQUEST_LOG.warning(
+            "Slow request %s %s: %d in %.3fs",
+            request.method, request.path, response.status_code, elapsed,
+        )
+    else:
+        REQUEST_LOG.debug(
+            "%s %s: %d", request.method, request.path, response.status_code)
+    return response
+
+
+@APP.before_request
+def start_profiling():
+    '''
+    Profiles this request if an admin asked for it and profiling is enabled
+    '''
+    if profiling.is_requested(APP.config, request):
+        g.profiler = profiling.RequestProfiler()
+        g.profiler.start()
+
+
+@APP.after_request
+def save_profile(response):
+    '''
+    Writes out the profile of this request, if it was profiled
+    '''
+    profiler = g.pop('profiler', None)
+    if profiler is not None:
+        name = profiler.save(
+            profiling.get_profile_dir(APP.config),
+            request.path,
+            request.endpoint,
+        )
+        response.headers['X-Profile-Name'] = name
+    return response
+
+
+@APP.after_request
+def compress_response(response):
+    '''
+    Compresses HTML and JSON responses the browser accepts compressed
+    '''
+    return assets.compress_response(response, request.accept_encodings)
+
+
+@APP.teardown_request
+def stop_profiling(exception):
+    '''
+    Stops profiling requests that failed before save_profile could run
+    '''
+    del exception
+    profiler = g.pop('profiler', None)
+    if profiler is not None:
+        profiler.stop()
+
+
+@APP.template_global()
+def asset_url(filename):
+    '''
+    Returns the content-hashed URL of a file in the static folder
+    '''
+    manifest = assets.get_manifest(APP.static_folder)
+    return url_for('asset', filename=manifest.hashed[filename])
+
+
+@APP.route('/assets/<path:filename>', methods=['GET'])
+def asset(filename):
+    '''
+    Serves a static file by its content-hashed name, cached forever
+    '''
+    original = assets.get_manifest(APP.static_folder).resolve(filename)
+    if original is None:
+        abort(404)
+    (served, encoding) = assets.choose_variant(
+        APP.static_folder,
+        original,
+        request.accept_encodings,
+    )
+    response = send_from_directory(
+        APP.static_folder,
+        served,
+        mimetype=mimetypes.guess_type(original)[0],
+        max_age=assets.IMMUTABLE_MAX_AGE,
+    )
+    if encoding is not None:
+        response.headers['Content-Encoding'] = encoding
+    response.vary.add('Accept-Encoding')
+    response.cache_control.public = True
+    response.cache_control.immutable = True
+    return response
+
+
 @APP.route('/', methods=['GET'])
 def index():
     '''
@@ -56,38 +306,45 @@ def index():
 @APP.route('/cards/', methods=['GET'])
 def cards():
     '''
-    The index of cards, redirects to an instance of a random card
+    The index of cards, redirects to the next card of the working set,
+    quizzed in the direction it's due in
     '''
-    print("Getting cursor")
-    cursor = get_db().cursor()
-    card_id = db.get_next_card(cursor)
-
-    APP.logger.debug('Type 1: %s', type(card_id))
-    return redirect(url_for('card', card_id=card_id or -1))
+    cursor = get_read_db().cursor()
+    item_id = db.get_next_item(cursor)
+    if item_id is None:
+        return redirect(url_for('card', card_id=-1))
+
+    (card_id, direction) = db.split_item_id(item_id)
+    if direction:
+        return redirect(url_for('card', card_id=card_id, direction=direction))
+    return redirect(url_for('card', card_id=card_id))
 
 
 @APP.route('/cards/<string:card_id>/', methods=['GET'])
 def card(card_id):
     '''
-    Renders a single flash-card on screen
+    Renders a single flash-card on screen, showing only the field that is
+    the prompt of the ?direction= it's quizzed in
     '''
-    APP.logger.debug('Type: %s', type(card_id))
+    direction = request.args.get('direction', 0, type=int)
+    if not 0 <= direction < db.MAX_DIRECTIONS:
+        abort(404)
 
-    cursor = get_db().cursor()
+    metadata = get_metadata()
+    cursor = get_read_db().cursor()
     attributes = db.get_card_attributes(cursor, card_id)
-    books = db.get_books(cursor)
-    active_book = db.get_book(cursor)
     cursor.close()
 
-    primaries = ['hanzi', 'kanji']
     hidden = ['Book', 'Lesson']
-    print("Attributes: " + str(attributes))
+    prompt = attributes[direction][0] if direction < len(attributes) else None
+    APP.logger.debug("Attributes: %s", attributes)
 
     return render_template(
         'card.html',
-        active_book=active_book,
-        books=books,
-        primaries=primaries,
+        active_book=metadata['active_book'],
+        books=metadata['books'],
+        prompt=prompt,
+        direction=direction,
         hidden=hidden,
         attributes=attributes,
     )
@@ -96,27 +353,117 @@ def card(card_id):
 @APP.route('/cards/<string:card_id>/edit/', methods=['POST'])
 def edit_card(card_id):
     '''
-    Renders a single flash-card on screen
+    Sets fields of a single flash-card, refusing names its book doesn't have
     '''
     cursor = get_db().cursor()
-    for (attribute_id, attribute_value) in request.form.items():
-        APP.logger.info(
-            "Editing %s setting %s to %s",
-            card_id,
-            attribute_id,
-            attribute_value,
-        )
-        db.edit_attribute(cursor, attribute_id, attribute_value)
+    APP.logger.info("Editing %s setting %s", card_id, dict(request.form))
+    errors = db.edit_card_fields(cursor, card_id, request.form.items())
+    if errors:
+        APP.logger.info("Refused edit of %s: %s", card_id, errors)
+        abort(400)
+    db.update_neighbours(cursor)
     cursor.close()
     get_db().commit()
     return redirect(url_for('card', card_id=card_id))
 
 
+@APP.route('/api/cards', methods=['GET'])
+def list_cards():
+    '''
+    Lists the cards matching ?book=, ?lesson=, ?bucket= and ?due=, a page
+    of ?limit= at a time after the card id in ?after=.  The "next" field is
+    the ?after= of the next page, if there is one.  Asking for JSON Lines,
+    with ?format=jsonl or an Accept header, streams every match instead.
+    '''
+    try:
+        after = int(request.args.get('after', 0))
+        limit = int(request.args.get('limit', db.DEFAULT_PAGE_SIZE))
+    except ValueError:
+        abort(400)
+    bucket = request.args.get('bucket')
+    due = request.args.get('due')
+    if not 0 < limit <= db.MAX_PAGE_SIZE or \
+            (bucket is not None and bucket not in db.BUCKETS) or \
+            due not in (None, 'true', 'false'):
+        abort(400)
+    filters = {
+        'book': request.args.get('book'),
+        'lesson': request.args.get('lesson'),
+        'bucket': bucket,
+        'due': None if due is None else due == 'true',
+    }
+
+    jsonl = request.args.get('format') == 'jsonl' or \
+        request.accept_mimetypes.best_match(
+            ['application/json', 'application/x-ndjson']
+        ) == 'application/x-ndjson'
+    if jsonl:
+        def generate():
+            cursor = get_read_db().cursor()
+            last = after
+            while True:
+                card_ids = db.list_card_ids(
+                    cursor, after=last, limit=db.MAX_PAGE_SIZE, **filters)
+                for card in db.get_cards(cursor, card_ids):
+                    yield json.dumps(card, ensure_ascii=False) + '\n'
+                if len(card_ids) < db.MAX_PAGE_SIZE:
+                    return
+                last = card_ids[-1]
+        return APP.response_class(
+            stream_with_context(generate()),
+            mimetype='application/x-ndjson',
+        )
+
+    cursor = get_read_db().cursor()
+    # One more than asked tells whether there's a next page
+    card_ids = db.list_card_ids(cursor, after=after, limit=limit + 1, **filters)
+    next_after = card_ids[limit - 1] if len(card_ids) > limit else None
+    return jsonify(
+        cards=db.get_cards(cursor, card_ids[:limit]),
+        next=next_after,
+    )
+
+
+@APP.route('/api/cards/edit', methods=['POST'])
+def edit_cards():
+    '''
+    Edits many cards at once, all or nothing.  The body is either a JSON
+    list of objects with the card "id" and the fields to set, or TSV with
+    an "id" column and one column per field to set.
+    '''
+    if request.is_json:
+        records = request.get_json(silent=True)
+        if not isinstance(records, list):
+            return jsonify(errors=['Expected a list of edits']), 400
+    else:
+        records = db.read_edits(request.get_data(as_text=True))
+    (edits, errors) = db.parse_edits(records)
+    if errors:
+        return jsonify(errors=errors), 400
+
+    cursor = get_db().cursor()
+    result = db.edit_cards(cursor, edits)
+    if result['errors']:
+        get_db().rollback()
+        return jsonify(errors=result['errors']), 400
+    get_db().commit()
+    if result['moved']:
+        cache.bump_version(get_db_path())
+    APP.logger.info("Bulk edit: %s", result)
+    del result['errors']
+    return jsonify(result)
+
+
 @APP.route('/cards/<int:card_id>/vote', methods=['POST'])
 def vote(card_id):
     '''
-    Gives a vote to the given card and redirects to the next card
+    Gives a vote to the given card, in the direction it was quizzed in, and
+    redirects to the next card
     '''
+    direction = request.form.get('direction', 0, type=int)
+    if not 0 <= direction < db.MAX_DIRECTIONS:
+        abort(400)
+
     if 'confidence' in request.form:
         confidence = request.form['confidence']
         if confidence == 'good':
@@ -135,8 +482,17 @@ def vote(card_id):
         )
 
         cursor = get_db().cursor()
-        db.create_vote(cursor, card_id, confidence)
-        get_db().commit()
+        if not db.has_item(cursor, card_id, direction):
+            abort(400)
+        if APP.config['BACKGROUND_REFILL']:
+            db.create_vote(
+                cursor, card_id, confidence, refill=False, direction=direction)
+            replenish.refill_if_empty(cursor)
+            get_db().commit()
+            replenish.get_replenisher(get_db_path()).notify()
+        else:
+            db.create_vote(cursor, card_id, confidence, direction=direction)
+            get_db().commit()
     else:
         APP.logger.warning("No confidence in this vote for %s", card_id)
 
@@ -151,7 +507,9 @@ def preferences_edit():
     cursor = get_db().cursor()
     db.set_preferences(cursor, request.form.items())
     db.clear_working_set(cursor)
+    db.init_working_set(cursor)
     get_db().commit()
+    cache.bump_version(get_db_path())
     if 'preferences' in request.referrer:
         return redirect(url_for('preferences'))
     return redirect(url_for('cards'))
@@ -162,24 +520,157 @@ def preferences():
     '''
     Saves some given user preferences
     '''
-    cursor = get_db().cursor()
-    prefs = db.get_preferences(cursor)
-    attributes = db.get_attributes(cursor)
+    metadata = get_metadata()
+    cursor = get_read_db().cursor()
+    (working_set_size, easy_ratio, new_cards_per_day) = \
+        db.get_deck_settings(cursor)
     return render_template(
         'preferences.html',
-        preferences=prefs,
-        attributes=attributes,
+        preferences=metadata['preferences'],
+        attributes=metadata['facets'],
+        active_book=metadata['active_book'],
+        working_set_size=working_set_size,
+        easy_ratio=easy_ratio,
+        new_cards_per_day=new_cards_per_day,
+        directions=db.get_directions(cursor, metadata['active_book']),
     )
 
 
+@APP.route('/preferences/deck', methods=['POST'])
+def deck_settings_edit():
+    '''
+    Saves the working set size, easy ratio and new cards per day of the
+    prefered book
+    '''
+    try:
+        working_set_size = int(request.form['working_set_size'])
+        easy_ratio = float(request.form['easy_ratio'])
+        new_cards_per_day = int(request.form.get(
+            'new_cards_per_day', db.DEFAULT_NEW_CARDS_PER_DAY))
+    except (KeyError, ValueError):
+        abort(400)
+    if working_set_size <= 0 or not 0 <= easy_ratio <= 1 or \
+            new_cards_per_day < 0:
+        abort(400)
+
+    cursor = get_db().cursor()
+    book = db.get_book(cursor)
+    if book is None:
+        abort(400)
+    db.set_deck_settings(
+        cursor, book, working_set_size, easy_ratio, new_cards_per_day)
+    db.clear_working_set(cursor)
+    db.init_working_set(cursor)
+    get_db().commit()
+    return redirect(url_for('preferences'))
+
+
+@APP.route('/preferences/directions', methods=['POST'])
+def directions_edit():
+    '''
+    Saves which fields of the prefered book are used as prompts
+    '''
+    try:
+        directions = [int(value) for value in request.form.getlist('direction')]
+    except ValueError:
+        abort(400)
+
+    cursor = get_db().cursor()
+    book = db.get_book(cursor)
+    if book is None:
+        abort(400)
+    available = [direction for (direction, _, _) in db.get_directions(cursor, book)]
+    if not directions or not set(directions) <= set(available):
+        abort(400)
+    db.set_directions(cursor, book, directions)
+    db.clear_working_set(cursor)
+    db.init_working_set(cursor)
+    get_db().commit()
+    return redirect(url_for('preferences'))
+
+
 @APP.route('/stats/', methods=['GET'])
 def stats():
     '''
     Shows some summary information about my cards
     '''
-    cursor = get_db().cursor()
+    cursor = get_read_db().cursor()
     books = db.get_card_stats(cursor)
     return render_template(
         'stats.html',
         books=books,
     )
+
+
+@APP.route('/api/pack', methods=['GET'])
+def deck_pack():
+    '''
+    Downloads the cards matching the preferences as a SQLite file to study
+    offline, or with ?since=<token of a pack> just what changed since
+    '''
+    db_path = get_db_path()
+    init_db(db_path)
+    (path, token) = pack.build_pack(
+        db_path,
+        APP.config.get('PACK_DIR'),
+        request.args.get('since'),
+    )
+    etag = os.path.basename(path)[:-len('.sqlite3')]
+    response = send_file(
+        path,
+        mimetype='application/vnd.sqlite3',
+        as_attachment=True,
+        download_name='deck-%s.sqlite3' % etag,
+        conditional=True,
+        etag=etag,
+        max_age=0,
+    )
+    response.headers['X-Pack-Version'] = token
+    return response
+
+
+@APP.route('/healthz', methods=['GET'])
+def healthz():
+    '''
+    Readiness check: 200 once warm-up is done, 503 until then, with how
+    long each step and the first fast request took
+    '''
+    report = WARM_UP.report()
+    response = jsonify(report)
+    response.status_code = 200 if report['ready'] else 503
+    response.cache_control.no_store = True
+    return response
+
+
+@APP.route('/profiles/', methods=['GET'])
+def profiles():
+    '''
+    Lists the saved request profiles, only for admins
+    '''
+    if not APP.config.get('PROFILING') or \
+            not profiling.is_admin(APP.config, request):
+        abort(404)
+    return jsonify(profiling.list_profiles(profiling.get_profile_dir(APP.config)))
+
+
+@APP.route('/profiles/<string:filename>', methods=['GET'])
+def profile_file(filename):
+    '''
+    Downloads one of the files of a saved request profile, only for admins
+    '''
+    if not APP.config.get('PROFILING') or \
+            not profiling.is_admin(APP.config, request):
+        abort(404)
+    return send_from_directory(
+        os.path.abspath(profiling.get_profile_dir(APP.config)),
+        filename,
+        as_attachment=True,
+    )
+
+
+@APP.route('/metrics', methods=['GET'])
+def metrics():
+    '''
+    Reports how the working set is being kept topped up
+    '''
+    return jsonify(replenish=replenish.get_metrics())
@@ -0,0 +1,178 @@
+'''
+Serves static files so that pages need nothing from other hosts and
+browsers can cache them forever.
+
+Templates link to static files through asset_url(), which puts a hash of
+the file's content in its name, e.g. vendor/bootstrap.min.0123456789ab.css.
+A changed file gets a new URL, so the old one can be served with an
+immutable Cache-Control.  If a precompressed .br or .gz copy sits next to
+the file (see main() below) and the browser accepts it, that copy is sent
+instead of compressing on every request.
+
+HTML and JSON responses are compressed on the fly.  Brotli is optional:
+without the brotli package we only write and serve gzip.
+'''
+
+from __future__ import unicode_literals, print_function
+
+import argparse
+import gzip
+import hashlib
+import io
+import os
+import threading
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+# A year, the longest Cache-Control max-age browsers honour
+IMMUTABLE_MAX_AGE = 365 * 24 * 60 * 60
+
+# Precompressed copies, in order of preference
+ENCODINGS = (('br', '.br'), ('gzip', '.gz'))
+
+# Static files worth precompressing
+PRECOMPRESSED_EXTENSIONS = ('.css', '.js', '.svg', '.json', '.txt', '.html')
+
+# Dynamic responses worth compressing, and the size below which it doesn't
+# pay off
+COMPRESSED_MIMETYPES = ('text/html', 'application/json')
+MIN_COMPRESSED_SIZE = 500
+
+MANIFESTS_LOCK = threading.Lock()
+MANIFESTS = {}
+
+
+def hashed_name(filename, digest):
+    '''
+    Returns the filename with the digest inserted before its extension
+    '''
+    (base, extension) = os.path.splitext(filename)
+    return '%s.%s%s' % (base, digest, extension)
+
+
+class Manifest(object):
+    '''
+    Maps the static files of one folder to and from their hashed names
+    '''
+
+    def __init__(self, static_folder):
+        self.static_folder = static_folder
+        self.hashed = {}
+        self.original = {}
+        for (directory, _, filenames) in os.walk(static_folder):
+            for filename in filenames:
+                if filename.endswith(tuple(suffix for (_, suffix) in ENCODINGS)):
+                    continue
+                path = os.path.join(directory, filename)
+                name = os.path.relpath(path, static_folder).replace(os.sep, '/')
+                with io.open(path, 'rb') as handle:
+                    digest = hashlib.sha1(handle.read()).hexdigest()[:12]
+                self.hashed[name] = hashed_name(name, digest)
+                self.original[self.hashed[name]] = name
+
+    def resolve(self, hashed):
+        ''' Returns the real name of a hashed name, or None if it's stale '''
+        return self.original.get(hashed)
+
+
+def get_manifest(static_folder):
+    '''
+    Returns the manifest of a static folder, hashing its files the first
+    time it's asked for in this process
+    '''
+    with MANIFESTS_LOCK:
+        manifest = MANIFESTS.get(static_folder)
+        if manifest is None:
+            manifest = Manifest(static_folder)
+            MANIFESTS[static_folder] = manifest
+        return manifest
+
+
+def choose_variant(static_folder, filename, accept_encodings):
+    '''
+    Returns the (filename, encoding) of the best copy of a static file the
+    browser accepts, with an encoding of None for the file itself
+    '''
+    for (encoding, suffix) in ENCODINGS:
+        if accept_encodings[encoding] and \
+                os.path.isfile(os.path.join(static_folder, filename + suffix)):
+            return (filename + suffix, encoding)
+    return (filename, None)
+
+
+def compress(data, encoding):
+    ''' Compresses data with the given Content-Encoding '''
+    if encoding == 'br':
+        return brotli.compress(data, quality=5)
+    return gzip.compress(data, compresslevel=6)
+
+
+def compress_response(response, accept_encodings):
+    '''
+    Compresses an HTML or JSON response in place if the browser accepts it
+    '''
+    if response.status_code != 200 or response.direct_passthrough or \
+            response.is_streamed or \
+            'Content-Encoding' in response.headers or \
+            response.mimetype not in COMPRESSED_MIMETYPES:
+        return response
+    response.vary.add('Accept-Encoding')
+
+    data = response.get_data()
+    if len(data) < MIN_COMPRESSED_SIZE:
+        return response
+    for (encoding, _) in ENCODINGS:
+        if encoding == 'br' and brotli is None:
+            continue
+        if accept_encodings[encoding]:
+            response.set_data(compress(data, encoding))
+            response.headers['Content-Encoding'] = encoding
+            break
+    return response
+
+
+def precompress(static_folder):
+    '''
+    Writes .gz (and, with brotli installed, .br) copies of the static files
+    worth compressing, returning the paths written
+    '''
+    written = []
+    for (directory, _, filenames) in os.walk(static_folder):
+        for filename in filenames:
+            if not filename.endswith(PRECOMPRESSED_EXTENSIONS):
+                continue
+            path = os.path.join(directory, filename)
+            with io.open(path, 'rb') as handle:
+                data = handle.read()
+            # No timestamp in the gzip header, so the output is reproducible
+            variants = [('.gz', gzip.compress(data, compresslevel=9, mtime=0))]
+            if brotli is not None:
+                variants.append(('.br', brotli.compress(data)))
+            for (suffix, compressed) in variants:
+                with io.open(path + suffix, 'wb') as handle:
+                    handle.write(compressed)
+                written.append(path + suffix)
+    return written
+
+
+def main():
+    ''' Precompresses the static files '''
+    parser = argparse.ArgumentParser(description='Precompresses static files')
+    parser.add_argument(
+        '--static',
+        default=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static'),
+        help='Static folder to precompress (default: the app\'s)',
+    )
+    args = parser.parse_args()
+    if brotli is None:
+        print("brotli is not installed, only writing gzip copies")
+    for path in precompress(args.static):
+        print("Wrote " + path)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,91 @@
+'''
+Per-process cache of the metadata every page needs: the list of books,
+the active preferences and the facet values to filter on.
+
+These only change when content is imported or preferences are saved, so
+instead of querying them on every request we keep them in memory along
+with a version stamp.  The stamp is a small file next to the database that
+gets replaced after every such change, so every worker process (and the
+import script) agree on when the cache is stale.  Checking it is a single
+stat() call, no database query.
+'''
+
+from __future__ import unicode_literals, print_function
+
+import io
+import os
+import threading
+import uuid
+
+
+STAMP_SUFFIX = '-metadata'
+
+
+def get_stamp_path(db_path):
+    ''' Returns the path of the version stamp of the given database '''
+    return db_path + STAMP_SUFFIX
+
+
+def read_version(db_path):
+    '''
+    Returns the current metadata version of the given database, or None if
+    it was never stamped
+    '''
+    try:
+        stat = os.stat(get_stamp_path(db_path))
+    except OSError:
+        return None
+    # Stamps are replaced rather than rewritten, so the inode changes too
+    return (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+
+
+def bump_version(db_path):
+    '''
+    Marks the cached metadata of the given database as stale everywhere.
+    Call it after committing the change, never before.
+    '''
+    stamp_path = get_stamp_path(db_path)
+    temporary_path = '%s.%s' % (stamp_path, uuid.uuid4().hex)
+    with io.open(temporary_path, 'w', encoding='utf8') as handle:
+        handle.write(uuid.uuid4().hex)
+    os.replace(temporary_path, stamp_path)
+
+
+class MetadataCache(object):
+    '''
+    Metadata of each database, reloaded whenever its stamp changes
+    '''
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.entries = {}
+
+    def get(self, db_path, loader):
+        '''
+        Returns the cached metadata of db_path, calling loader() to build it
+        again if it's missing or out of date
+        '''
+        # A database that was never stamped is a version of its own, so
+        # reads never write: stamps are only created by bump_version after
+        # a change, which then differs from it
+        version = read_version(db_path)
+
+        with self.lock:
+            entry = self.entries.get(db_path)
+        if entry is not None and entry[0] == version:
+            return entry[1]
+
+        # Read the stamp before loading, so a change committed while we load
+        # leaves a newer stamp behind and the next request reloads again
+        metadata = loader()
+        with self.lock:
+            self.entries[db_path] = (version, metadata)
+        return metadata
+
+    def clear(self):
+        ''' Forgets everything cached in this process '''
+        with self.lock:
+            self.entries.clear()
+
+
+METADATA = MetadataCache()
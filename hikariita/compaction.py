@@ -0,0 +1,255 @@
+'''
+Compacts old vote history so the scheduler queries stay fast.
+
+Votes older than the retention window are folded into one item_summaries
+row per item (vote count, vote sum and the last vote id), which is all
+calculate_state_of_card and draw_from_least_recently_seen need.  The raw
+rows can be copied into an attached archive database before they are
+deleted, and the freed pages are handed back with an incremental vacuum.
+
+Work is done in small chunks, each in its own short transaction, so the
+job can run next to the live app without holding the write lock for long.
+'''
+
+from __future__ import unicode_literals, print_function
+
+import argparse
+import logging
+import sqlite3
+import time
+
+from . import db, logs
+
+LOG = logging.getLogger(__name__)
+
+
+ARCHIVE_SCHEMA = 'archive'
+
+ARCHIVE_INIT_COMMAND = '''
+CREATE TABLE IF NOT EXISTS archive.votes (
+    id INTEGER PRIMARY KEY,
+    vote INTEGER NOT NULL,
+    card_id INTEGER NOT NULL,
+    created INTEGER,
+    item_id INTEGER
+)
+'''
+
+# Votes without a timestamp predate the created column, so they're always
+# considered old enough to compact
+CHUNK_BOUND_QUERY = '''
+    SELECT MAX(id) FROM (
+        SELECT id FROM votes
+        WHERE created IS NULL OR created <= ?
+        ORDER BY id ASC
+        LIMIT ?
+    )
+'''
+
+CHUNK_CONDITION = '(created IS NULL OR created <= ?) AND id <= ?'
+
+FOLD_COMMAND = '''
+    INSERT INTO item_summaries (item_id, vote_count, vote_sum, last_vote_id)
+    SELECT item_id, COUNT(*), SUM(vote), MAX(id) FROM votes
+    WHERE ''' + CHUNK_CONDITION + '''
+    GROUP BY item_id
+    ON CONFLICT(item_id) DO UPDATE SET
+        vote_count = vote_count + excluded.vote_count,
+        vote_sum = vote_sum + excluded.vote_sum,
+        last_vote_id = MAX(IFNULL(last_vote_id, 0), excluded.last_vote_id)
+'''
+
+ARCHIVE_COMMAND = '''
+    INSERT OR IGNORE INTO archive.votes (id, vote, card_id, created, item_id)
+    SELECT id, vote, card_id, created, item_id FROM votes
+    WHERE ''' + CHUNK_CONDITION
+
+DELETE_COMMAND = 'DELETE FROM votes WHERE ' + CHUNK_CONDITION
+
+
+def attach_archive(connection, archive_path):
+    '''
+    Attaches the archive database (creating it if needed) as "archive"
+    '''
+    connection.execute(
+        'ATTACH DATABASE ? AS ' + ARCHIVE_SCHEMA,
+        (archive_path,),
+    )
+    connection.execute(ARCHIVE_INIT_COMMAND)
+    # Archives made before directions have no item_id, their votes being
+    # all of the first direction
+    columns = [
+        row[1] for row in
+        connection.execute('PRAGMA %s.table_info(votes)' % ARCHIVE_SCHEMA)
+    ]
+    if 'item_id' not in columns:
+        connection.execute(
+            'ALTER TABLE %s.votes ADD COLUMN item_id INTEGER' % ARCHIVE_SCHEMA)
+        connection.execute(
+            'UPDATE %s.votes SET item_id = card_id << 3' % ARCHIVE_SCHEMA)
+    connection.commit()
+
+
+def detach_archive(connection):
+    '''
+    Detaches the archive database attached by attach_archive
+    '''
+    connection.execute('DETACH DATABASE ' + ARCHIVE_SCHEMA)
+
+
+def compact_chunk(connection, cutoff, chunk_size, archive=False):
+    '''
+    Folds up to chunk_size of the oldest votes created at or before cutoff
+    into item_summaries, optionally copying them to the archive first.
+
+    Runs as a single transaction and returns how many votes were removed.
+    '''
+    cursor = connection.cursor()
+    try:
+        cursor.execute(CHUNK_BOUND_QUERY, (cutoff, chunk_size))
+        upper_bound = cursor.fetchone()[0]
+        if upper_bound is None:
+            return 0
+
+        parameters = (cutoff, upper_bound)
+        cursor.execute(FOLD_COMMAND, parameters)
+        if archive:
+            cursor.execute(ARCHIVE_COMMAND, parameters)
+        cursor.execute(DELETE_COMMAND, parameters)
+        removed = cursor.rowcount
+        connection.commit()
+        return removed
+    except Exception:
+        connection.rollback()
+        raise
+    finally:
+        cursor.close()
+
+
+def is_incremental_vacuum_enabled(connection):
+    '''
+    Returns whether the database was created (or vacuumed) with
+    auto_vacuum = INCREMENTAL, which incremental_vacuum requires
+    '''
+    return connection.execute('PRAGMA auto_vacuum').fetchone()[0] == 2
+
+
+def enable_incremental_vacuum(connection):
+    '''
+    Switches an existing database to auto_vacuum = INCREMENTAL.
+
+    This rewrites the whole file with a VACUUM, so run it once, offline.
+    New databases get this setting from db.init(), which init_db() runs
+    before switching them to WAL.
+    '''
+    if is_incremental_vacuum_enabled(connection):
+        return
+    connection.commit()
+    connection.execute('PRAGMA auto_vacuum = INCREMENTAL')
+    connection.execute('VACUUM')
+
+
+def reclaim_space(connection, pages):
+    '''
+    Returns up to the given number of free pages to the file system,
+    committing any pending transaction first.
+
+    Does nothing unless incremental vacuum is enabled for this database.
+    '''
+    if not is_incremental_vacuum_enabled(connection):
+        return 0
+    before = connection.execute('PRAGMA freelist_count').fetchone()[0]
+    # Each step of the pragma frees one page, and execute() only takes the
+    # first step since it returns no columns; executescript() runs it out
+    connection.executescript('PRAGMA incremental_vacuum(%d);' % int(pages))
+    after = connection.execute('PRAGMA freelist_count').fetchone()[0]
+    return before - after
+
+
+def compact_votes(
+        connection,
+        retention_days=90,
+        archive_path=None,
+        chunk_size=500,
+        max_chunks=None,
+        pause=0.05,
+        vacuum_pages=100,
+        now=None):
+    '''
+    Compacts every vote older than retention_days, chunk by chunk.
+
+    Between chunks the write lock is released and we sleep for `pause`
+    seconds so live votes can get in.  Stops early after max_chunks.
+    Returns a dictionary summarizing the work done.
+    '''
+    now = time.time() if now is None else now
+    cutoff = int(now - retention_days * 24 * 60 * 60)
+
+    cursor = connection.cursor()
+    db.init(cursor)
+    cursor.close()
+    connection.commit()
+
+    archive = archive_path is not None
+    if archive:
+        attach_archive(connection, archive_path)
+
+    result = {'chunks': 0, 'votes': 0, 'pages': 0}
+    try:
+        while max_chunks is None or result['chunks'] < max_chunks:
+            removed = compact_chunk(connection, cutoff, chunk_size, archive)
+            if not removed:
+                break
+            result['chunks'] += 1
+            result['votes'] += removed
+            result['pages'] += reclaim_space(connection, vacuum_pages)
+            LOG.info("Compacted %d votes", removed)
+            if pause:
+                time.sleep(pause)
+    finally:
+        if archive:
+            detach_archive(connection)
+
+    # Pick up whatever the last chunks freed
+    result['pages'] += reclaim_space(connection, vacuum_pages)
+    return result
+
+
+def main():
+    ''' Compacts the vote history of a database '''
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('database', help='Path to the sqlite database')
+    parser.add_argument('--retention-days', type=float, default=90)
+    parser.add_argument('--archive', help='Path to the archive database')
+    parser.add_argument('--chunk-size', type=int, default=500)
+    parser.add_argument('--max-chunks', type=int)
+    parser.add_argument('--pause', type=float, default=0.05)
+    parser.add_argument('--vacuum-pages', type=int, default=100)
+    parser.add_argument(
+        '--enable-incremental-vacuum',
+        action='store_true',
+        help='Convert the database to auto_vacuum=INCREMENTAL first (VACUUM)',
+    )
+    args = parser.parse_args()
+    logs.configure()
+
+    connection = sqlite3.connect(args.database)
+    if args.enable_incremental_vacuum:
+        enable_incremental_vacuum(connection)
+    result = compact_votes(
+        connection,
+        retention_days=args.retention_days,
+        archive_path=args.archive,
+        chunk_size=args.chunk_size,
+        max_chunks=args.max_chunks,
+        pause=args.pause,
+        vacuum_pages=args.vacuum_pages,
+    )
+    connection.close()
+    print("Compacted " + str(result['votes']) + " votes in " +
+          str(result['chunks']) + " chunks, reclaimed " +
+          str(result['pages']) + " pages")
+
+
+if __name__ == '__main__':
+    main()
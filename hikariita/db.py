@@ -4,23 +4,85 @@ Imports flashcards into a sqlite database from CSV
 
 from __future__ import unicode_literals, print_function
 
+import argparse
+import datetime
+import hashlib
+import io
+import json
+import logging
+import re
 import sqlite3
 import random
+import time
 
+from . import cache
+from . import logs
+from . import similarity
+from .normalize import content_key
+
+LOG = logging.getLogger(__name__)
 
 INIT_DB_COMMANDS = '''
+PRAGMA auto_vacuum = INCREMENTAL;
+
 CREATE TABLE IF NOT EXISTS cards (
     id INTEGER PRIMARY KEY,
-    bucket TEXT DEFAULT "genesis"
+    bucket TEXT DEFAULT "genesis",
+    book_id INTEGER,
+    content TEXT,
+    content_key TEXT,
+    FOREIGN KEY(book_id) REFERENCES attributes(id)
+);
+
+-- Only the Book and Lesson facets we filter on are kept as attributes,
+-- the rest of a card is packed into cards.content as a JSON list in the
+-- order of its book's headers
+CREATE TABLE IF NOT EXISTS card_duplicates (
+    card_id INTEGER PRIMARY KEY,
+    duplicate_of INTEGER NOT NULL,
+    FOREIGN KEY(card_id) REFERENCES cards(id) ON DELETE CASCADE,
+    FOREIGN KEY(duplicate_of) REFERENCES cards(id) ON DELETE CASCADE
+);
+
+CREATE TABLE IF NOT EXISTS card_schemas (
+    book_id INTEGER PRIMARY KEY,
+    headers TEXT NOT NULL,
+    FOREIGN KEY(book_id) REFERENCES attributes(id) ON DELETE CASCADE
+);
+
+-- Cards are quizzed in one or more directions, each showing a different
+-- field of the card as the prompt: direction d prompts with the d-th of the
+-- book's headers.  Each (card, direction) is scheduled on its own, as an
+-- item whose id is card_id * 8 + direction, so the items of a card are
+-- next to each other.  Books without rows here only quiz direction 0.
+CREATE TABLE IF NOT EXISTS book_directions (
+    book_id INTEGER NOT NULL,
+    direction INTEGER NOT NULL,
+    PRIMARY KEY (book_id, direction)
+) WITHOUT ROWID;
+
+-- cards.bucket is only read to migrate older databases to items
+CREATE TABLE IF NOT EXISTS items (
+    id INTEGER PRIMARY KEY,
+    bucket TEXT NOT NULL DEFAULT 'genesis'
 );
 
 CREATE TABLE IF NOT EXISTS votes (
     id INTEGER PRIMARY KEY,
     vote INTEGER NOT NULL,
     card_id INTEGER NOT NULL,
+    created INTEGER,
+    item_id INTEGER,
     FOREIGN KEY(card_id) REFERENCES cards(id) ON DELETE CASCADE
 );
 
+CREATE TABLE IF NOT EXISTS item_summaries (
+    item_id INTEGER PRIMARY KEY,
+    vote_count INTEGER NOT NULL DEFAULT 0,
+    vote_sum INTEGER NOT NULL DEFAULT 0,
+    last_vote_id INTEGER
+);
+
 CREATE TABLE IF NOT EXISTS attributes (
     id INTEGER PRIMARY KEY,
     name TEXT NOT NULL,
@@ -34,12 +96,71 @@ CREATE TABLE IF NOT EXISTS attributes_cards_relation (
     FOREIGN KEY(attribute_id) REFERENCES attributes(id) ON DELETE CASCADE
 );
 
+-- Only one item of a card is studied at a time, see working_set_card_id
 CREATE TABLE IF NOT EXISTS working_set (
     id INTEGER PRIMARY KEY,
     card_id INTEGER,
+    item_id INTEGER,
     FOREIGN KEY(card_id) REFERENCES cards(id) ON DELETE CASCADE
 );
 
+-- Features of each card and its most confusable neighbours, see
+-- similarity.py.  Cards whose neighbours need updating wait in
+-- stale_neighbours until update_neighbours() runs.
+CREATE TABLE IF NOT EXISTS card_features (
+    feature TEXT NOT NULL,
+    card_id INTEGER NOT NULL,
+    PRIMARY KEY (feature, card_id)
+) WITHOUT ROWID;
+
+CREATE TABLE IF NOT EXISTS card_neighbours (
+    card_id INTEGER NOT NULL,
+    neighbour_id INTEGER NOT NULL,
+    score REAL NOT NULL,
+    PRIMARY KEY (card_id, neighbour_id)
+) WITHOUT ROWID;
+
+CREATE TABLE IF NOT EXISTS stale_neighbours (
+    card_id INTEGER PRIMARY KEY
+);
+
+-- Version of the last change to each card, its lessons, items, votes or place
+-- in the working set, kept by the triggers below so deck packs can be
+-- updated incrementally
+CREATE TABLE IF NOT EXISTS card_versions (
+    card_id INTEGER PRIMARY KEY,
+    version INTEGER NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS deck_settings (
+    book TEXT PRIMARY KEY,
+    working_set_size INTEGER NOT NULL,
+    easy_ratio REAL NOT NULL,
+    new_cards_per_day INTEGER
+);
+
+-- New items are introduced in the order of a queue precomputed for each
+-- set of preferences (filters): by book, lesson, direction, then import
+-- order.  position is how far along it the draws are, and introduced how
+-- many were drawn on day, a date ordinal.  Triggers below mark queues
+-- stale when items are added or cards change lessons, and they are
+-- rebuilt on their next draw.
+CREATE TABLE IF NOT EXISTS introduction_queues (
+    id INTEGER PRIMARY KEY,
+    filters TEXT NOT NULL UNIQUE,
+    position INTEGER NOT NULL DEFAULT 0,
+    day INTEGER,
+    introduced INTEGER NOT NULL DEFAULT 0,
+    stale INTEGER NOT NULL DEFAULT 0
+);
+
+CREATE TABLE IF NOT EXISTS introduction_queue_items (
+    queue_id INTEGER NOT NULL,
+    position INTEGER NOT NULL,
+    item_id INTEGER NOT NULL,
+    PRIMARY KEY (queue_id, position)
+) WITHOUT ROWID;
+
 CREATE TABLE IF NOT EXISTS preferences (
     attribute_name TEXT PRIMARY KEY,
     attribute_value TEXT,
@@ -48,13 +169,142 @@ CREATE TABLE IF NOT EXISTS preferences (
 );
 '''
 
+# Columns added after the first release.  CREATE TABLE IF NOT EXISTS won't
+# touch tables from older databases, so these get patched in by init().
+MIGRATION_COLUMNS = (
+    ('votes', 'created', 'INTEGER'),
+    ('cards', 'book_id', 'INTEGER'),
+    ('cards', 'content', 'TEXT'),
+    ('cards', 'content_key', 'TEXT'),
+    ('votes', 'item_id', 'INTEGER'),
+    ('working_set', 'item_id', 'INTEGER'),
+    ('deck_settings', 'new_cards_per_day', 'INTEGER'),
+)
+
+INIT_INDEX_COMMANDS = '''
+CREATE INDEX IF NOT EXISTS votes_card_id ON votes (card_id);
+CREATE INDEX IF NOT EXISTS votes_item_id ON votes (item_id);
+CREATE INDEX IF NOT EXISTS items_bucket ON items (bucket);
+DROP INDEX IF EXISTS attributes_name_value;
+DROP INDEX IF EXISTS attributes_cards_relation_card_id;
+CREATE UNIQUE INDEX IF NOT EXISTS attributes_facet
+ON attributes (name, value);
+CREATE INDEX IF NOT EXISTS cards_content_key ON cards (content_key);
+CREATE INDEX IF NOT EXISTS card_features_card_id ON card_features (card_id);
+CREATE INDEX IF NOT EXISTS card_neighbours_neighbour_id
+ON card_neighbours (neighbour_id);
+CREATE UNIQUE INDEX IF NOT EXISTS attributes_cards_relation_card_attribute
+ON attributes_cards_relation (card_id, attribute_id);
+DROP INDEX IF EXISTS attributes_cards_relation_attribute_id;
+CREATE INDEX IF NOT EXISTS attributes_cards_relation_attribute_card
+ON attributes_cards_relation (attribute_id, card_id);
+
+DELETE FROM working_set WHERE id NOT IN (
+    SELECT MIN(id) FROM working_set GROUP BY card_id
+);
+CREATE UNIQUE INDEX IF NOT EXISTS working_set_card_id
+ON working_set (card_id);
+
+CREATE INDEX IF NOT EXISTS card_versions_version ON card_versions (version);
+''' + ''.join(
+    # Superseded by the *_bump_version_* triggers: their INSERT OR REPLACE
+    # took the conflict policy of the statement firing them, so inserts
+    # made with OR IGNORE never bumped the version
+    'DROP TRIGGER IF EXISTS %s;\n' % name for name in (
+        'cards_version_insert', 'cards_version_update', 'cards_version_delete',
+        'relation_version_insert', 'relation_version_delete',
+        'votes_version_insert', 'items_version_insert', 'items_version_update',
+        'items_version_delete',
+    )
+) + ''.join(
+    '''
+CREATE TRIGGER IF NOT EXISTS %s AFTER %s
+BEGIN
+    INSERT OR IGNORE INTO card_versions (card_id, version) VALUES (%s, 0);
+    UPDATE card_versions
+    SET version = (SELECT MAX(version) FROM card_versions) + 1
+    WHERE card_id == %s;
+END;
+''' % (name, event, card_id, card_id)
+    for (name, event, card_id) in (
+        ('cards_bump_version_insert', 'INSERT ON cards', 'NEW.id'),
+        ('cards_bump_version_update',
+         'UPDATE OF bucket, book_id, content ON cards', 'NEW.id'),
+        ('cards_bump_version_delete', 'DELETE ON cards', 'OLD.id'),
+        ('relation_bump_version_insert', 'INSERT ON attributes_cards_relation',
+         'NEW.card_id'),
+        ('relation_bump_version_delete', 'DELETE ON attributes_cards_relation',
+         'OLD.card_id'),
+        ('votes_bump_version_insert', 'INSERT ON votes', 'NEW.card_id'),
+        ('items_bump_version_insert', 'INSERT ON items', 'NEW.id >> 3'),
+        ('items_bump_version_update', 'UPDATE OF bucket ON items',
+         'NEW.id >> 3'),
+        ('items_bump_version_delete', 'DELETE ON items', 'OLD.id >> 3'),
+        ('working_set_bump_version_insert', 'INSERT ON working_set',
+         'NEW.card_id'),
+        ('working_set_bump_version_update',
+         'UPDATE OF card_id, item_id ON working_set', 'NEW.card_id'),
+        ('working_set_bump_version_delete', 'DELETE ON working_set',
+         'OLD.card_id'),
+    )
+) + ''.join(
+    '''
+CREATE TRIGGER IF NOT EXISTS %s AFTER %s
+BEGIN
+    UPDATE introduction_queues SET stale = 1 WHERE stale == 0;
+END;
+''' % trigger for trigger in (
+        ('items_introduction_insert', 'INSERT ON items'),
+        ('relation_introduction_insert', 'INSERT ON attributes_cards_relation'),
+        ('relation_introduction_delete', 'DELETE ON attributes_cards_relation'),
+    )
+)
+
+# Item ids are card_id << DIRECTION_BITS | direction
+DIRECTION_BITS = 3
+MAX_DIRECTIONS = 1 << DIRECTION_BITS
+
+# Used for decks without their own row in deck_settings
+DEFAULT_WORKING_SET_SIZE = 7
+DEFAULT_EASY_RATIO = 0.3
+DEFAULT_NEW_CARDS_PER_DAY = 20
+
+# Buckets an item can be in, from new to learned
+BUCKETS = ('genesis', 'hard', 'okay', 'easy')
+
+# Cards listed per page by list_card_ids, by default and at most
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+
+# Share of new draws spent on cards easily confused with the ones already
+# in the working set, so they get studied side by side
+CONFUSABLE_RATIO = 0.25
+
+# Ids of the cards matching any of the user's preferences
+FILTERED_CARD_IDS = '''
+    SELECT attributes_cards_relation.card_id
+    FROM attributes_cards_relation
+    INNER JOIN attributes
+    ON attributes.id == attributes_cards_relation.attribute_id
+    INNER JOIN preferences
+    ON preferences.attribute_name == attributes.name
+    AND preferences.attribute_value == attributes.value
+'''
+
+# The current preferences as a canonical JSON list, naming the
+# introduction queue that goes with them
+FILTERS_KEY = '''
+    SELECT json_group_array(json_array(attribute_name, attribute_value))
+    FROM (SELECT * FROM preferences ORDER BY attribute_name)
+'''
+
 
 def read_data(file_path):
     '''
     Imports data from file system
     '''
-    with open(file_path, 'r') as handle:
-        content = handle.read().decode('utf8')
+    with io.open(file_path, 'r', encoding='utf8') as handle:
+        content = handle.read()
 
     result = []
 
@@ -70,37 +320,352 @@ def init(cursor):
     Initializes the database with the base tables
     '''
     cursor.executescript(INIT_DB_COMMANDS)
+    for (table, column, definition) in MIGRATION_COLUMNS:
+        add_column(cursor, table, column, definition)
+    pack_card_content(cursor)
+    index_content_keys(cursor)
+    cursor.executescript(INIT_INDEX_COMMANDS)
+    migrate_items(cursor)
     init_working_set(cursor)
 
 
+def add_column(cursor, table, column, definition):
+    '''
+    Adds the given column to an existing table unless it's already there
+    '''
+    cursor.execute('PRAGMA table_info(%s)' % table)
+    if column in [row[1] for row in cursor.fetchall()]:
+        return
+    LOG.info("Migrating %s with new column %s", table, column)
+    cursor.execute(
+        'ALTER TABLE %s ADD COLUMN %s %s' % (table, column, definition)
+    )
+
+
+def pack_card_content(cursor):
+    '''
+    Migrates cards from one attribute row per field to a single packed
+    content column, and merges the duplicated Book and Lesson attributes
+    older imports created for every lesson.  Does nothing once migrated.
+    '''
+    cursor.execute('''
+        SELECT relation.card_id, attributes.id, attributes.name, attributes.value
+        FROM attributes_cards_relation AS relation
+        INNER JOIN attributes
+        ON attributes.id == relation.attribute_id
+        WHERE attributes.name NOT IN ('Book', 'Lesson')
+        ORDER BY relation.card_id, attributes.id
+    ''')
+    fields = cursor.fetchall()
+
+    cursor.execute('''
+        SELECT name, value, MIN(id) FROM attributes
+        WHERE name IN ('Book', 'Lesson')
+        GROUP BY name, value
+        HAVING COUNT(*) > 1
+    ''')
+    duplicates = cursor.fetchall()
+    if not fields and not duplicates:
+        return
+
+    LOG.info("Migrating %d card attributes to packed content", len(fields))
+    # Point every relation at the first of its identical facets
+    cursor.executemany('''
+        UPDATE attributes_cards_relation SET attribute_id = ?
+        WHERE attribute_id IN (
+            SELECT id FROM attributes WHERE name == ? AND value == ?
+        )
+    ''', [(first_id, name, value) for (name, value, first_id) in duplicates])
+    cursor.executemany('''
+        DELETE FROM attributes WHERE name == ? AND value == ? AND id != ?
+    ''', duplicates)
+    cursor.execute('''
+        DELETE FROM attributes_cards_relation WHERE rowid NOT IN (
+            SELECT MIN(rowid) FROM attributes_cards_relation
+            GROUP BY card_id, attribute_id
+        )
+    ''')
+
+    cursor.execute('''
+        SELECT relation.card_id, attributes.id FROM attributes_cards_relation AS relation
+        INNER JOIN attributes
+        ON attributes.id == relation.attribute_id
+        WHERE attributes.name == 'Book'
+    ''')
+    book_of_card = dict(cursor.fetchall())
+
+    # Each book's headers are all its field names in the order imported
+    cards = {}
+    for (card_id, _, name, value) in fields:
+        book_id = book_of_card.get(card_id)
+        if book_id is None:
+            LOG.warning("Card %s has no book, not packing it", card_id)
+            continue
+        cards.setdefault((book_id, card_id), []).append((name, value))
+    headers = {}
+    for ((book_id, card_id), card_fields) in sorted(cards.items()):
+        book_headers = headers.setdefault(book_id, get_headers(cursor, book_id))
+        for (name, _) in card_fields:
+            if name not in book_headers:
+                book_headers.append(name)
+
+    updates = []
+    for ((book_id, card_id), card_fields) in cards.items():
+        values = [''] * len(headers[book_id])
+        for (name, value) in card_fields:
+            values[headers[book_id].index(name)] = value
+        updates.append((book_id, pack_values(values), card_id))
+    cursor.executemany('''
+        INSERT OR REPLACE INTO card_schemas (book_id, headers) VALUES (?, ?)
+    ''', [(book_id, pack_values(names)) for (book_id, names) in headers.items()])
+    cursor.executemany(
+        'UPDATE cards SET book_id=?, content=? WHERE id==?',
+        updates,
+    )
+
+    packed = [(attribute_id,) for (card_id, attribute_id, _, _) in fields
+              if card_id in book_of_card]
+    cursor.executemany(
+        'DELETE FROM attributes_cards_relation WHERE attribute_id == ?',
+        packed,
+    )
+    cursor.executemany('DELETE FROM attributes WHERE id == ?', packed)
+
+
+def index_content_keys(cursor):
+    '''
+    Fills in the normalized content key of cards imported before we had one
+    '''
+    cursor.execute('''
+        SELECT id, content FROM cards
+        WHERE content_key IS NULL AND content IS NOT NULL
+    ''')
+    updates = [
+        (content_key(unpack_values(content)), card_id)
+        for (card_id, content) in cursor.fetchall()
+    ]
+    cursor.executemany('UPDATE cards SET content_key=? WHERE id==?', updates)
+
+
+def migrate_items(cursor):
+    '''
+    Moves the scheduling state of databases from before quiz directions to
+    items: each card's bucket goes to its direction 0 item, and votes,
+    vote summaries and the working set get item ids.  Cards without any
+    item also get one for each direction of their book.
+    '''
+    cursor.execute('''
+        INSERT OR IGNORE INTO items (id, bucket)
+        SELECT
+            (cards.id << 3) + IFNULL(book_directions.direction, 0),
+            IFNULL(cards.bucket, 'genesis')
+        FROM cards
+        LEFT JOIN book_directions ON book_directions.book_id == cards.book_id
+        WHERE NOT EXISTS (
+            SELECT 1 FROM items
+            WHERE items.id BETWEEN cards.id << 3 AND (cards.id << 3) + 7
+        )
+    ''')
+    cursor.execute(
+        'UPDATE votes SET item_id = card_id << 3 WHERE item_id IS NULL')
+    cursor.execute(
+        'UPDATE working_set SET item_id = card_id << 3 WHERE item_id IS NULL')
+
+    cursor.execute('''
+        SELECT 1 FROM sqlite_master
+        WHERE type == 'table' AND name == 'vote_summaries'
+    ''')
+    if cursor.fetchone():
+        LOG.info("Migrating vote summaries to items")
+        cursor.execute('''
+            INSERT OR IGNORE INTO item_summaries
+            (item_id, vote_count, vote_sum, last_vote_id)
+            SELECT card_id << 3, vote_count, vote_sum, last_vote_id
+            FROM vote_summaries
+        ''')
+        cursor.execute('DROP TABLE vote_summaries')
+
+
+def make_item_id(card_id, direction=0):
+    '''
+    Returns the id of the item quizzing a card in the given direction
+    '''
+    return (int(card_id) << DIRECTION_BITS) + direction
+
+
+def split_item_id(item_id):
+    '''
+    Returns the (card id, direction) of an item id
+    '''
+    return (item_id >> DIRECTION_BITS, item_id & (MAX_DIRECTIONS - 1))
+
+
+def has_item(cursor, card_id, direction=0):
+    '''
+    Returns whether the card is quizzed in the given direction, that is
+    whether its item exists
+    '''
+    cursor.execute(
+        'SELECT 1 FROM items WHERE id == ?',
+        (make_item_id(card_id, direction),),
+    )
+    return cursor.fetchone() is not None
+
+
+def get_book_directions(cursor, book_id):
+    '''
+    Returns the directions quizzed for the given book id, in order
+    '''
+    cursor.execute('''
+        SELECT direction FROM book_directions
+        WHERE book_id == ? ORDER BY direction
+    ''', (book_id,))
+    return [row[0] for row in cursor.fetchall()] or [0]
+
+
+def get_directions(cursor, book_name):
+    '''
+    Returns the (direction, prompt header, enabled) of every direction the
+    given book could be quizzed in
+    '''
+    cursor.execute('''
+        SELECT attributes.id, card_schemas.headers FROM attributes
+        INNER JOIN card_schemas ON card_schemas.book_id == attributes.id
+        WHERE attributes.name == 'Book' AND attributes.value == ?
+    ''', (book_name,))
+    row = cursor.fetchone()
+    if row is None:
+        return []
+    enabled = get_book_directions(cursor, row[0])
+    headers = unpack_values(row[1])[:MAX_DIRECTIONS]
+    return [
+        (direction, header, direction in enabled)
+        for (direction, header) in enumerate(headers)
+    ]
+
+
+def set_directions(cursor, book_name, directions):
+    '''
+    Sets which directions the given book is quizzed in, creating the items
+    of the new ones.  Items of dropped directions leave the working set and
+    lose their bucket, but their votes are kept for if they come back.
+    '''
+    available = [direction for (direction, _, _) in get_directions(cursor, book_name)]
+    directions = sorted(set(directions))
+    assert directions
+    assert all(direction in available for direction in directions)
+    book_id = create_book(cursor, book_name)
+
+    cursor.execute('DELETE FROM book_directions WHERE book_id == ?', (book_id,))
+    cursor.executemany(
+        'INSERT INTO book_directions (book_id, direction) VALUES (?, ?)',
+        [(book_id, direction) for direction in directions],
+    )
+
+    # Directions enabled now, as a bit mask to test item ids against
+    mask = sum(1 << direction for direction in directions)
+    for (table, column) in (('working_set', 'item_id'), ('items', 'id')):
+        cursor.execute('''
+            DELETE FROM %s
+            WHERE ((1 << (%s & 7)) & ?) == 0
+            AND (%s >> 3) IN (SELECT id FROM cards WHERE book_id == ?)
+        ''' % (table, column, column), (mask, book_id))
+    cursor.execute('''
+        INSERT OR IGNORE INTO items (id)
+        SELECT (cards.id << 3) + book_directions.direction FROM cards
+        INNER JOIN book_directions ON book_directions.book_id == cards.book_id
+        WHERE cards.book_id == ?
+    ''', (book_id,))
+
+
+def create_items(cursor, card_id, book_id):
+    '''
+    Creates the items of a new card, one for each direction of its book
+    '''
+    cursor.executemany(
+        'INSERT OR IGNORE INTO items (id) VALUES (?)',
+        [
+            (make_item_id(card_id, direction),)
+            for direction in get_book_directions(cursor, book_id)
+        ],
+    )
+
+
+def pack_values(values):
+    '''
+    Packs a list of field values (or header names) into one column
+    '''
+    return json.dumps(list(values), ensure_ascii=False, separators=(',', ':'))
+
+
+def unpack_values(content, length=0):
+    '''
+    Unpacks a column written by pack_values, padded with blanks to at least
+    the given length for cards imported before their book grew new headers
+    '''
+    values = json.loads(content) if content else []
+    return values + [''] * (length - len(values))
+
+
+def get_headers(cursor, book_id):
+    '''
+    Returns the list of field names of the given book
+    '''
+    cursor.execute('SELECT headers FROM card_schemas WHERE book_id == ?', (book_id,))
+    row = cursor.fetchone()
+    return unpack_values(row[0]) if row else []
+
+
+def extend_headers(cursor, book_id, names):
+    '''
+    Adds any of the given field names the book doesn't have yet to the end
+    of its headers, and returns the resulting headers
+    '''
+    headers = get_headers(cursor, book_id)
+    missing = [name for name in names if name not in headers]
+    if missing or not headers:
+        headers.extend(missing)
+        command = '''
+            INSERT OR REPLACE INTO card_schemas (book_id, headers) VALUES (?, ?)
+        '''
+        cursor.execute(command, (book_id, pack_values(headers)))
+    return headers
+
+
 def create_book(cursor, title):
     '''
-    Adds a new book to the DB, and returns it's ID
+    Adds a new book to the DB, or finds the existing one, and returns it's ID
     '''
-    return create_attribute(cursor, "Book", title)
+    return get_or_create_attribute(cursor, "Book", title)
 
 
-def create_vote(cursor, card_id, vote_value):
+def create_vote(cursor, card_id, vote_value, refill=True, direction=0):
     '''
-    Registers a vote on a card
+    Registers a vote on a card quizzed in the given direction
+
+    The working set is topped up afterwards unless refill is False, for
+    callers that leave that to a background replenisher.
     '''
-    print("Creating vote")
+    LOG.debug("Creating vote")
+    item_id = make_item_id(card_id, direction)
     # Insert vote record
-    command = 'INSERT INTO votes (vote, card_id) VALUES (?, ?)'
-    cursor.execute(command, (vote_value, card_id))
+    command = '''
+        INSERT INTO votes (vote, card_id, item_id, created) VALUES (?, ?, ?, ?)
+    '''
+    cursor.execute(command, (vote_value, card_id, item_id, int(time.time())))
 
     # Calculate new state
     bucket = 'easy' if vote_value == 1 else calculate_state_of_card(
         cursor,
         card_id,
+        direction,
     )
 
     # Update state
-    update_command = '''UPDATE cards SET bucket=? WHERE id==? AND bucket!=?'''
-    cursor.execute(update_command, (bucket, card_id, bucket))
+    update_command = '''UPDATE items SET bucket=? WHERE id==? AND bucket!=?'''
+    cursor.execute(update_command, (bucket, item_id, bucket))
 
-    print("Did something update? " + str(cursor.rowcount))
-    print("What was the vote? " + str(vote_value))
+    LOG.debug("Vote %s updated %d rows", vote_value, cursor.rowcount)
 
     if vote_value == 1:
         # Evict from working set and resample if state is "easy"
@@ -109,9 +674,10 @@ def create_vote(cursor, card_id, vote_value):
         # If we aren't confident in this card,
         # move it to the back of the working set queue
         delete_card_from_working_set(cursor, card_id)
-        add_card_to_working_set(cursor, card_id)
+        add_card_to_working_set(cursor, card_id, direction)
 
-    init_working_set(cursor)
+    if refill:
+        init_working_set(cursor)
 
 
 def get_working_set_size(cursor):
@@ -125,7 +691,7 @@ def get_working_set_size(cursor):
     cursor.execute(working_set_size_query)
     working_set_size_row = cursor.fetchone()
     working_set_size = working_set_size_row[0]
-    print("Working Set Size: " + str(working_set_size))
+    LOG.debug("Working set size: %d", working_set_size)
     return working_set_size
 
 
@@ -136,60 +702,89 @@ def clear_working_set(cursor):
 
     This should be used for major preference or state changes.
     '''
-    print("Clearing working set")
+    LOG.debug("Clearing working set")
     delete_command = '''DELETE FROM working_set'''
     cursor.execute(delete_command)
+    # Items drawn but not learned yet are back to being new
+    cursor.execute('UPDATE introduction_queues SET position = 0')
 
 
 def delete_card_from_working_set(cursor, card_id):
     '''
     Removes hte given card from the working set
     '''
-    print("Evicting " + str(card_id))
+    LOG.debug("Evicting %s", card_id)
     delete_command = '''DELETE FROM working_set WHERE card_id == ?'''
     cursor.execute(delete_command, (card_id,))
 
 
-def add_card_to_working_set(cursor, card_id):
+def add_card_to_working_set(cursor, card_id, direction=0):
     '''
-    Adds the given card to the working set
+    Adds the given card to the working set, quizzed in the given direction
     '''
-    print("Inserting " + str(card_id))
-    update_command = 'INSERT INTO working_set (id, card_id) VALUES (NULL, ?)'
-    cursor.execute(update_command, (card_id,))
+    LOG.debug("Inserting %s", card_id)
+    update_command = '''
+        INSERT OR IGNORE INTO working_set (id, card_id, item_id)
+        VALUES (NULL, ?, ?)
+    '''
+    cursor.execute(update_command, (card_id, make_item_id(card_id, direction)))
 
 
-def draw_from_least_recently_seen(cursor):
+def draw_from_least_recently_seen(cursor, limit=1):
     '''
-    Pulls a card from a bucket into a working set
+    Pulls up to `limit` of the items we haven't seen for the longest into
+    the working set, oldest first
 
-    Returns the card_id pulled, or None if there isn't
-    any in the bucket not in the working set
+    Returns how many cards were pulled
     '''
-    print("Searching for least-recently-seen card")
+    LOG.debug("Searching for least-recently-seen cards")
+    # Compacted history only keeps the last vote id of each item, which is
+    # all we need to know how long ago it was seen.  Joining items leaves
+    # out the directions no longer quizzed.
     query_command = '''
-        SELECT votes.card_id, MAX(votes.id) FROM votes
-        LEFT JOIN working_set
-        ON votes.card_id == working_set.card_id
-        INNER JOIN attributes_cards_relation
-        ON attributes_cards_relation.card_id == votes.card_id
-        INNER JOIN attributes
-        ON attributes.id == attributes_cards_relation.attribute_id
-        INNER JOIN preferences
-        ON preferences.attribute_name == attributes.name AND preferences.attribute_value = attributes.value
-        WHERE working_set.card_id IS NULL
-        GROUP BY votes.card_id
-        ORDER BY MAX(votes.id) ASC
-        LIMIT 1
+        INSERT OR IGNORE INTO working_set (card_id, item_id)
+        SELECT seen.item_id >> 3, seen.item_id FROM (
+            SELECT item_id, id AS vote_id FROM votes
+            UNION ALL
+            SELECT item_id, last_vote_id AS vote_id FROM item_summaries
+        ) AS seen
+        INNER JOIN items ON items.id == seen.item_id
+        WHERE (seen.item_id >> 3) IN (''' + FILTERED_CARD_IDS + ''')
+        AND (seen.item_id >> 3) NOT IN (SELECT card_id FROM working_set)
+        GROUP BY seen.item_id
+        ORDER BY MAX(seen.vote_id) ASC
+        LIMIT ?
     '''
-    cursor.execute(query_command)
-    row = cursor.fetchone()
-    if not row:
-        print("Found none")
-        return None
-    card_id = row[0]
-    add_card_to_working_set(cursor, card_id)
-    return card_id
+    cursor.execute(query_command, (limit,))
+    return cursor.rowcount
+
+
+def draw_confusables(cursor, limit=1):
+    '''
+    Pulls up to `limit` of the cards most easily confused with the ones in
+    the working set into it, reading only the precomputed neighbours of the
+    cards already there.  They are quizzed in the same direction as the
+    card they are confused with, when their book has it.
+
+    Returns how many cards were pulled
+    '''
+    LOG.debug("Drawing confusable cards")
+    query_command = '''
+        INSERT OR IGNORE INTO working_set (card_id, item_id)
+        SELECT card_neighbours.neighbour_id, items.id FROM working_set
+        INNER JOIN card_neighbours
+        ON card_neighbours.card_id == working_set.card_id
+        INNER JOIN items
+        ON items.id == (card_neighbours.neighbour_id << 3) +
+            (working_set.item_id & 7)
+        WHERE card_neighbours.neighbour_id IN (''' + FILTERED_CARD_IDS + ''')
+        AND card_neighbours.neighbour_id NOT IN (SELECT card_id FROM working_set)
+        GROUP BY card_neighbours.neighbour_id
+        ORDER BY MAX(card_neighbours.score) DESC
+        LIMIT ?
+    '''
+    cursor.execute(query_command, (limit,))
+    return cursor.rowcount
 
 
 def get_working_set_size_by_buckets(cursor):
@@ -202,8 +797,8 @@ def get_working_set_size_by_buckets(cursor):
     working_set_distribution_query = '''
         SELECT COUNT(*), bucket
         FROM working_set
-        INNER JOIN cards
-        ON working_set.card_id == cards.id
+        INNER JOIN items
+        ON working_set.item_id == items.id
         GROUP BY bucket
     '''
     cursor.execute(working_set_distribution_query)
@@ -215,68 +810,214 @@ def get_working_set_size_by_buckets(cursor):
     return buckets
 
 
-def draw_from_bucket(cursor, bucket):
+def draw_from_bucket(cursor, bucket, limit=1):
     '''
-    Pulls a card from a bucket into a working set
+    Pulls up to `limit` random items from a bucket into the working set.
+    The items_bucket index means only that bucket's items are looked at.
 
-    Returns the card_id pulled, or None if there isn't
-    any in the bucket not in the working set
+    Returns how many cards were pulled
     '''
-    print("Drawing from " + bucket)
+    LOG.debug("Drawing from %s", bucket)
     query_command = '''
-        SELECT cards.id FROM cards
-        LEFT JOIN working_set
-        ON cards.id == working_set.card_id
-        INNER JOIN attributes_cards_relation
-        ON attributes_cards_relation.card_id == cards.id
-        INNER JOIN attributes
-        ON attributes.id == attributes_cards_relation.attribute_id
-        INNER JOIN preferences
-        ON preferences.attribute_name == attributes.name AND preferences.attribute_value = attributes.value
-        WHERE working_set.card_id IS NULL AND bucket == ?
+        INSERT OR IGNORE INTO working_set (card_id, item_id)
+        SELECT items.id >> 3, items.id FROM items
+        WHERE items.bucket == ?
+        AND (items.id >> 3) IN (''' + FILTERED_CARD_IDS + ''')
+        AND (items.id >> 3) NOT IN (SELECT card_id FROM working_set)
         ORDER BY RANDOM()
-        LIMIT 1
-    '''
-    cursor.execute(query_command, (bucket,))
-    row = cursor.fetchone()
-    if not row:
-        print("Found none")
-        return None
-    card_id = row[0]
-    add_card_to_working_set(cursor, card_id)
-    return card_id
+        LIMIT ?
+    '''
+    cursor.execute(query_command, (bucket, limit))
+    return cursor.rowcount
+
+
+def lesson_sort_key(name):
+    '''
+    Sorts lesson names with the numbers in them compared as numbers, so
+    "Lesson 2" comes before "Lesson 13".  Cards without a lesson go last.
+    '''
+    if name is None:
+        return (1, [])
+    parts = re.split(r'(\d+)', name.lower())
+    return (0, [int(part) if part.isdigit() else part for part in parts])
+
+
+def build_introduction_queue(cursor):
+    '''
+    (Re)computes the introduction queue of the current preferences: their
+    "genesis" items by book, lesson, direction, then import order.  Putting
+    the direction before import order keeps the items of a card a lesson
+    apart, since only one of them can be in the working set.
+
+    Returns its (id, position, day, introduced) like get_introduction_queue
+    '''
+    LOG.debug("Building introduction queue")
+    cursor.execute(
+        'INSERT OR IGNORE INTO introduction_queues (filters) ' + FILTERS_KEY)
+    cursor.execute(
+        'SELECT id, day, introduced FROM introduction_queues '
+        'WHERE filters == (' + FILTERS_KEY + ')')
+    (queue_id, day, introduced) = cursor.fetchone()
+
+    cursor.execute('''
+        SELECT items.id, cards.book_id, lessons.value FROM items
+        INNER JOIN cards ON cards.id == items.id >> 3
+        LEFT JOIN attributes_cards_relation AS relation
+        ON relation.card_id == cards.id
+        AND relation.attribute_id IN (
+            SELECT id FROM attributes WHERE name == 'Lesson'
+        )
+        LEFT JOIN attributes AS lessons ON lessons.id == relation.attribute_id
+        WHERE items.bucket == 'genesis'
+        AND cards.id IN (''' + FILTERED_CARD_IDS + ''')
+    ''')
+    # Cards in several lessons are introduced with the earliest one
+    keys = {}
+    for (item_id, book_id, lesson) in cursor.fetchall():
+        (card_id, direction) = split_item_id(item_id)
+        key = (book_id or 0, lesson_sort_key(lesson), direction, card_id)
+        keys[item_id] = min(keys.get(item_id, key), key)
+    item_ids = sorted(keys, key=keys.get)
+
+    cursor.execute(
+        'DELETE FROM introduction_queue_items WHERE queue_id == ?',
+        (queue_id,),
+    )
+    cursor.executemany(
+        'INSERT INTO introduction_queue_items (queue_id, position, item_id) '
+        'VALUES (?, ?, ?)',
+        [
+            (queue_id, position, item_id)
+            for (position, item_id) in enumerate(item_ids, 1)
+        ],
+    )
+    cursor.execute(
+        'UPDATE introduction_queues SET position = 0, stale = 0 WHERE id == ?',
+        (queue_id,),
+    )
+    return (queue_id, 0, day, introduced)
 
 
-def calculate_state_of_card(cursor, card_id):
+def get_introduction_queue(cursor):
+    '''
+    Returns the (id, position, day, introduced) of the introduction queue of
+    the current preferences, building it first if it's missing or stale
     '''
-    Queries for the last 5 votes and calculates the state of that card:
+    cursor.execute(
+        'SELECT id, position, day, introduced, stale FROM introduction_queues '
+        'WHERE filters == (' + FILTERS_KEY + ')')
+    row = cursor.fetchone()
+    if row is None or row[4]:
+        return build_introduction_queue(cursor)
+    return tuple(row[:4])
+
+
+def draw_new_items(cursor, new_cards_per_day, limit=1):
+    '''
+    Pulls up to `limit` of the next new items of the introduction queue
+    into the working set, at most new_cards_per_day of them a day.
+
+    The draw starts from the queue's position, reading only the entries
+    after it, and the position is moved up to the first entry that's still
+    new and not in the working set.  Items of cards already in the working
+    set hold it back until they can be drawn, so they aren't skipped.
+
+    Returns how many items were pulled
+    '''
+    LOG.debug("Drawing new items")
+    (queue_id, position, day, introduced) = get_introduction_queue(cursor)
+    today = datetime.date.today().toordinal()
+    if day != today:
+        introduced = 0
+    limit = min(limit, new_cards_per_day - introduced)
+    if limit <= 0:
+        return 0
+
+    cursor.execute('''
+        INSERT OR IGNORE INTO working_set (card_id, item_id)
+        SELECT queue.item_id >> 3, queue.item_id
+        FROM introduction_queue_items AS queue
+        INNER JOIN items ON items.id == queue.item_id
+        WHERE queue.queue_id == ? AND queue.position > ?
+        AND items.bucket == 'genesis'
+        AND (queue.item_id >> 3) NOT IN (SELECT card_id FROM working_set)
+        ORDER BY queue.position
+        LIMIT ?
+    ''', (queue_id, position, limit))
+    added = cursor.rowcount
+
+    cursor.execute('''
+        UPDATE introduction_queues SET
+            day = :today,
+            introduced = :introduced,
+            position = IFNULL(
+                (
+                    SELECT queue.position - 1
+                    FROM introduction_queue_items AS queue
+                    INNER JOIN items ON items.id == queue.item_id
+                    WHERE queue.queue_id == :queue_id
+                    AND queue.position > :position
+                    AND items.bucket == 'genesis'
+                    AND NOT EXISTS (
+                        SELECT 1 FROM working_set
+                        WHERE working_set.item_id == queue.item_id
+                    )
+                    ORDER BY queue.position
+                    LIMIT 1
+                ),
+                (
+                    SELECT IFNULL(MAX(position), 0)
+                    FROM introduction_queue_items
+                    WHERE queue_id == :queue_id
+                )
+            )
+        WHERE id == :queue_id
+    ''', {
+        'today': today,
+        'introduced': introduced + added,
+        'queue_id': queue_id,
+        'position': position,
+    })
+    return added
+
+
+def calculate_state_of_card(cursor, card_id, direction=0):
+    '''
+    Queries for the votes on a card in the given direction and calculates
+    its state:
 
     * easy
     * medium
     * hard
     '''
     command = '''
-        SELECT AVG(vote), COUNT(vote)
-        FROM votes
-        WHERE card_id=?
-        ORDER BY ROWID DESC
-        LIMIT 3
-    '''
-    cursor.execute(command, (card_id,))
-    row = cursor.fetchone()
+        SELECT SUM(vote_sum), SUM(vote_count) FROM (
+            SELECT SUM(vote) AS vote_sum, COUNT(vote) AS vote_count
+            FROM votes
+            WHERE item_id=?
+            UNION ALL
+            SELECT vote_sum, vote_count
+            FROM item_summaries
+            WHERE item_id=?
+        )
+    '''
+    item_id = make_item_id(card_id, direction)
+    cursor.execute(command, (item_id, item_id))
+    (vote_sum, vote_count) = cursor.fetchone()
 
     # We don't have enough votes to determine state yet
-    if row[1] < 3:
+    if not vote_count or vote_count < 3:
         return None
 
-    assert row[0] >= -1
-    assert row[0] <= 1
+    average = float(vote_sum) / vote_count
+    assert average >= -1
+    assert average <= 1
 
-    if row[0] < 0:
+    if average < 0:
         return 'hard'
-    elif row[0] < 1:
+    elif average < 1:
         return 'okay'
-    elif row[0] == 1:
+    elif average == 1:
         return 'easy'
 
     assert False
@@ -284,9 +1025,22 @@ def calculate_state_of_card(cursor, card_id):
 
 def create_lesson(cursor, number):
     '''
-    Creates a new lesson for the given number
+    Creates a new lesson for the given number, or finds the existing one
     '''
-    return create_attribute(cursor, "Lesson", number)
+    return get_or_create_attribute(cursor, "Lesson", number)
+
+
+def get_or_create_attribute(cursor, name, value):
+    '''
+    Returns the id of the attribute with the given name and value,
+    creating it if there isn't one yet
+    '''
+    command = 'SELECT id FROM attributes WHERE name == ? AND value == ?'
+    cursor.execute(command, (name, value))
+    row = cursor.fetchone()
+    if row:
+        return row[0]
+    return create_attribute(cursor, name, value)
 
 
 def create_attribute(cursor, name, value):
@@ -309,13 +1063,392 @@ def associate_card_and_attribute(cursor, card_id, attribute_id):
     cursor.execute(command, (card_id, attribute_id))
 
 
-def create_card(cursor):
+def create_card(cursor, book_id=None, values=()):
+    '''
+    Creates a card in the given book with the given field values, in the
+    order of the book's headers, and its items
+    '''
+    command = '''
+        INSERT INTO cards (id, book_id, content, content_key)
+        VALUES (NULL, ?, ?, ?)
+    '''
+    cursor.execute(command, (book_id, pack_values(values), content_key(values)))
+    card_id = cursor.lastrowid
+    create_items(cursor, card_id, book_id)
+    return card_id
+
+
+def find_duplicate(cursor, values):
+    '''
+    Returns the oldest card whose normalized content matches the given
+    field values, or None
+    '''
+    key = content_key(values)
+    if key is None:
+        return None
+    command = '''
+        SELECT id FROM cards WHERE content_key == ? ORDER BY id LIMIT 1
     '''
-    Creates a blank card to fill in with attributes later
+    cursor.execute(command, (key,))
+    row = cursor.fetchone()
+    return row[0] if row else None
+
+
+def add_card(cursor, book_id, lesson_id, values, duplicates=None):
+    '''
+    Adds a card with the given values to a book and lesson, returning its id
+
+    With duplicates='merge', a card matching an existing one (see
+    normalize.py) is not created; the existing card is added to the book and
+    lesson instead, so both decks share its scheduling.  With 'link', the new
+    card is created but remembered as a duplicate of the existing one.
+    '''
+    duplicate_of = None
+    if duplicates is not None:
+        duplicate_of = find_duplicate(cursor, values)
+
+    if duplicates == 'merge' and duplicate_of is not None:
+        card_id = duplicate_of
+    else:
+        card_id = create_card(cursor, book_id, values)
+        mark_neighbours_stale(cursor, [card_id])
+        if duplicate_of is not None:
+            command = '''
+                INSERT INTO card_duplicates (card_id, duplicate_of) VALUES (?, ?)
+            '''
+            cursor.execute(command, (card_id, duplicate_of))
+
+    cursor.executemany('''
+        INSERT OR IGNORE INTO attributes_cards_relation (card_id, attribute_id)
+        VALUES (?, ?)
+    ''', [(card_id, book_id), (card_id, lesson_id)])
+    return card_id
+
+
+def find_duplicates(cursor):
+    '''
+    Returns every group of cards with the same normalized content, as lists
+    of card ids, using the content key index instead of comparing cards
+    '''
+    command = '''
+        SELECT GROUP_CONCAT(id) FROM cards
+        WHERE content_key IS NOT NULL
+        GROUP BY content_key
+        HAVING COUNT(*) > 1
+        ORDER BY MIN(id)
     '''
-    command = 'INSERT INTO cards (id, bucket) VALUES (NULL, "genesis")'
     cursor.execute(command)
-    return cursor.lastrowid
+    return [
+        sorted(int(card_id) for card_id in row[0].split(','))
+        for row in cursor.fetchall()
+    ]
+
+
+def edit_card_fields(cursor, card_id, fields):
+    '''
+    Sets the given (name, value) fields of one card.  Like edit_cards, names
+    that aren't among the card's book's headers are refused and nothing is
+    changed; only imports add headers.
+
+    Returns the list of errors, empty if the card was edited.
+    '''
+    cursor.execute('SELECT book_id, content FROM cards WHERE id == ?', (card_id,))
+    row = cursor.fetchone()
+    if not row:
+        return ['Card %s does not exist' % card_id]
+    (book_id, content) = (row[0], row[1])
+    fields = list(fields)
+    headers = get_headers(cursor, book_id)
+    errors = [
+        'Card %s has no field %s' % (card_id, name)
+        for (name, _) in fields if name not in headers
+    ]
+    if errors:
+        return errors
+    values = unpack_values(content, len(headers))
+    for (name, value) in fields:
+        values[headers.index(name)] = value
+    cursor.execute(
+        'UPDATE cards SET content=?, content_key=? WHERE id==?',
+        (pack_values(values), content_key(values), card_id),
+    )
+    mark_neighbours_stale(cursor, [card_id])
+    return []
+
+
+def mark_neighbours_stale(cursor, card_ids):
+    '''
+    Queues the given new or edited cards for update_neighbours
+    '''
+    cursor.executemany(
+        'INSERT OR IGNORE INTO stale_neighbours (card_id) VALUES (?)',
+        [(card_id,) for card_id in card_ids],
+    )
+
+
+def get_neighbours(cursor, card_id):
+    '''
+    Returns the (neighbour_id, score) pairs of the cards most easily confused
+    with the given one, best first
+    '''
+    command = '''
+        SELECT neighbour_id, score FROM card_neighbours
+        WHERE card_id == ?
+        ORDER BY score DESC
+    '''
+    cursor.execute(command, (card_id,))
+    return [(row[0], row[1]) for row in cursor.fetchall()]
+
+
+def write_features(cursor, features_by_card):
+    '''
+    Stores the similarity features of the given cards
+    '''
+    cursor.executemany(
+        'INSERT OR IGNORE INTO card_features (feature, card_id) VALUES (?, ?)',
+        [
+            (feature, card_id)
+            for (card_id, features) in features_by_card.items()
+            for feature in features
+        ],
+    )
+
+
+def update_neighbours(cursor, k=similarity.DEFAULT_NEIGHBOURS):
+    '''
+    Re-indexes the cards queued by mark_neighbours_stale and ranks their
+    neighbours, loading only the posting lists of their own features.  The
+    new cards are also merged into the lists of the neighbours they found,
+    so no other card needs to be compared.
+
+    Returns how many cards were updated.
+    '''
+    command = '''
+        SELECT cards.id, cards.content FROM stale_neighbours
+        INNER JOIN cards ON cards.id == stale_neighbours.card_id
+    '''
+    cursor.execute(command)
+    features_by_card = dict(
+        (card_id, similarity.card_features(unpack_values(content)))
+        for (card_id, content) in cursor.fetchall()
+    )
+    stale = [(card_id,) for card_id in features_by_card]
+    cursor.executemany('DELETE FROM card_features WHERE card_id == ?', stale)
+    cursor.executemany('DELETE FROM card_neighbours WHERE card_id == ?', stale)
+    cursor.executemany(
+        'DELETE FROM card_neighbours WHERE neighbour_id == ?', stale)
+    cursor.execute('DELETE FROM stale_neighbours')
+    if not features_by_card:
+        return 0
+    write_features(cursor, features_by_card)
+
+    features = set()
+    for card_features in features_by_card.values():
+        features.update(card_features)
+    # Features shared by too many cards are never scored, so their posting
+    # lists are left out in SQL rather than loaded and dropped
+    command = '''
+        SELECT feature, card_id FROM card_features
+        WHERE feature IN (
+            SELECT feature FROM card_features
+            WHERE feature IN (SELECT value FROM json_each(?))
+            GROUP BY feature HAVING COUNT(*) <= ?
+        )
+    '''
+    cursor.execute(
+        command, (json.dumps(sorted(features)), similarity.MAX_POSTINGS))
+    postings = {}
+    candidates = set()
+    for (feature, card_id) in cursor.fetchall():
+        postings.setdefault(feature, []).append(card_id)
+        candidates.add(card_id)
+    command = '''
+        SELECT card_id, COUNT(*) FROM card_features
+        WHERE card_id IN (SELECT value FROM json_each(?))
+        GROUP BY card_id
+    '''
+    cursor.execute(command, (json.dumps(sorted(candidates)),))
+    sizes = dict((row[0], row[1]) for row in cursor.fetchall())
+    cursor.execute('SELECT COUNT(*) FROM cards')
+    index = similarity.Index(postings, sizes, cursor.fetchone()[0])
+
+    rows = []
+    for (card_id, card_features) in features_by_card.items():
+        for (neighbour_id, score) in index.neighbours(card_id, card_features, k):
+            rows.append((card_id, neighbour_id, score))
+    cursor.executemany('''
+        INSERT OR REPLACE INTO card_neighbours (card_id, neighbour_id, score)
+        VALUES (?, ?, ?)
+    ''', rows)
+
+    # Scores are symmetric, so a neighbour may now want us in its own list
+    reverse = [
+        (neighbour_id, card_id, score)
+        for (card_id, neighbour_id, score) in rows
+        if neighbour_id not in features_by_card
+    ]
+    cursor.executemany('''
+        INSERT OR REPLACE INTO card_neighbours (card_id, neighbour_id, score)
+        VALUES (?, ?, ?)
+    ''', reverse)
+    cursor.executemany('''
+        DELETE FROM card_neighbours
+        WHERE card_id == ? AND neighbour_id NOT IN (
+            SELECT neighbour_id FROM card_neighbours
+            WHERE card_id == ?
+            ORDER BY score DESC
+            LIMIT ?
+        )
+    ''', [(neighbour_id, neighbour_id, k) for (neighbour_id, _, _) in reverse])
+    return len(features_by_card)
+
+
+def rebuild_neighbours(cursor, k=similarity.DEFAULT_NEIGHBOURS, processes=None):
+    '''
+    Indexes every card from scratch, ranking neighbours across a pool of
+    processes for large decks.  Returns how many cards were indexed.
+    '''
+    cursor.execute('SELECT id, content FROM cards')
+    features_by_card = dict(
+        (card_id, similarity.card_features(unpack_values(content)))
+        for (card_id, content) in cursor.fetchall()
+    )
+    for table in ('card_features', 'card_neighbours', 'stale_neighbours'):
+        cursor.execute('DELETE FROM %s' % table)
+    write_features(cursor, features_by_card)
+
+    neighbours = similarity.compute_neighbours(features_by_card, k, processes)
+    cursor.executemany('''
+        INSERT INTO card_neighbours (card_id, neighbour_id, score)
+        VALUES (?, ?, ?)
+    ''', [
+        (card_id, neighbour_id, score)
+        for (card_id, ranked) in neighbours.items()
+        for (neighbour_id, score) in ranked
+    ])
+    return len(features_by_card)
+
+
+def parse_edits(records):
+    '''
+    Turns bulk edit records, dictionaries with the card's "id" and the
+    fields to set, into a list of (card_id, [(name, value), ...]) and a list
+    of problems with them
+    '''
+    edits = []
+    errors = []
+    for (number, record) in enumerate(records):
+        if not isinstance(record, dict):
+            errors.append('Edit %d is not an object' % number)
+            continue
+        fields = [
+            (name, value) for (name, value) in record.items() if name != 'id'
+        ]
+        try:
+            card_id = int(record.get('id'))
+        except (TypeError, ValueError):
+            errors.append('Edit %d has no valid card id' % number)
+            continue
+        for (name, value) in fields:
+            if not isinstance(value, str):
+                errors.append('Card %d: %s is not text' % (card_id, name))
+        edits.append((card_id, fields))
+    return (edits, errors)
+
+
+def read_edits(content):
+    '''
+    Reads a TSV bulk edit: a header row with an "id" column and the names of
+    the fields to set, then one row per card
+    '''
+    lines = [line.split('\t') for line in content.splitlines() if line.strip()]
+    if not lines:
+        return []
+    headers = lines[0]
+    return [dict(zip(headers, line)) for line in lines[1:]]
+
+
+def edit_cards(cursor, edits):
+    '''
+    Applies a bulk edit of (card_id, [(name, value), ...]) pairs.
+
+    Every card is checked to exist and every field to be one of its book's
+    headers in a single query, and nothing is changed unless they all are.
+    "Lesson" moves the card to that lesson by re-pointing only its own
+    relation, so the lesson shared with other cards is never renamed.  The
+    changes are written with one executemany per table, in the caller's
+    transaction.
+
+    Returns a dictionary counting the cards updated, moved and left
+    unchanged, plus the list of errors if it refused the edit.
+    '''
+    result = {'updated': 0, 'moved': 0, 'unchanged': 0, 'errors': []}
+    command = '''
+        SELECT cards.id, cards.content, card_schemas.headers FROM cards
+        LEFT JOIN card_schemas
+        ON card_schemas.book_id == cards.book_id
+        WHERE cards.id IN (SELECT value FROM json_each(?))
+    '''
+    card_ids = sorted(set(card_id for (card_id, _) in edits))
+    cursor.execute(command, (json.dumps(card_ids),))
+    cards = dict(
+        (row[0], (unpack_values(row[2]), row[1])) for row in cursor.fetchall()
+    )
+
+    for (card_id, fields) in edits:
+        if card_id not in cards:
+            result['errors'].append('Card %d does not exist' % card_id)
+            continue
+        headers = cards[card_id][0]
+        for (name, _) in fields:
+            if name != 'Lesson' and name not in headers:
+                result['errors'].append(
+                    'Card %d has no field %s' % (card_id, name))
+    if result['errors']:
+        return result
+
+    updates = {}
+    lessons = {}
+    for (card_id, fields) in edits:
+        (headers, content) = cards[card_id]
+        values = unpack_values(updates.get(card_id, content), len(headers))
+        for (name, value) in fields:
+            if name == 'Lesson':
+                lessons[card_id] = value
+            else:
+                values[headers.index(name)] = value
+        if pack_values(values) != pack_values(unpack_values(content, len(headers))):
+            updates[card_id] = pack_values(values)
+
+    cursor.executemany(
+        'UPDATE cards SET content=?, content_key=? WHERE id==?',
+        [
+            (content, content_key(unpack_values(content)), card_id)
+            for (card_id, content) in updates.items()
+        ],
+    )
+    mark_neighbours_stale(cursor, updates)
+    update_neighbours(cursor)
+
+    lesson_ids = dict(
+        (lesson, create_lesson(cursor, lesson))
+        for lesson in set(lessons.values())
+    )
+    cursor.executemany('''
+        DELETE FROM attributes_cards_relation
+        WHERE card_id == ? AND attribute_id IN (
+            SELECT id FROM attributes WHERE name == 'Lesson'
+        )
+    ''', [(card_id,) for card_id in lessons])
+    cursor.executemany('''
+        INSERT OR IGNORE INTO attributes_cards_relation (card_id, attribute_id)
+        VALUES (?, ?)
+    ''', [(card_id, lesson_ids[lesson]) for (card_id, lesson) in lessons.items()])
+
+    result['updated'] = len(updates)
+    result['moved'] = len(lessons)
+    result['unchanged'] = len(set(cards) - set(updates) - set(lessons))
+    return result
 
 
 def edit_attribute(cursor, attribute_id, attribute_value):
@@ -324,7 +1457,7 @@ def edit_attribute(cursor, attribute_id, attribute_value):
     '''
     command = 'UPDATE attributes SET value=? WHERE id==?'
     cursor.execute(command, (attribute_value, attribute_id,))
-    print("Affected " + str(cursor.rowcount) + " rows")
+    LOG.debug("Affected %d rows", cursor.rowcount)
 
 
 def get_attributes(cursor):
@@ -350,48 +1483,60 @@ def get_attributes(cursor):
 
 def get_card_attributes(cursor, card_id):
     '''
-    Gets all the attributes associated with a card_id
+    Gets the (name, value) fields of a card, in the order of its book's
+    headers, with a single primary key lookup
     '''
     command = '''
-    SELECT * FROM attributes
-    INNER JOIN attributes_cards_relation
-    ON attributes.id == attributes_cards_relation.attribute_id
-    WHERE attributes_cards_relation.card_id == ?
+    SELECT cards.content, card_schemas.headers FROM cards
+    INNER JOIN card_schemas
+    ON card_schemas.book_id == cards.book_id
+    WHERE cards.id == ?
     '''
     cursor.execute(command, (card_id,))
-    rows = cursor.fetchall()
-    return rows
+    row = cursor.fetchone()
+    if not row:
+        return []
+    headers = unpack_values(row[1])
+    return list(zip(headers, unpack_values(row[0], len(headers))))
 
 
-def get_next_card(cursor):
+def get_next_item(cursor):
     '''
-    Out of the working set, pick the card that we have not seen for the longest
+    Out of the working set, pick the item that we have not seen for the
+    longest, returning its item id
     '''
-    print("Getting next card")
+    LOG.debug("Getting next card")
     command = '''
-        SELECT working_set.card_id
+        SELECT working_set.item_id
         FROM working_set
-        LEFT JOIN votes
-        ON working_set.card_id == votes.card_id
-        GROUP BY working_set.card_id
-        ORDER BY MAX(working_set.id) ASC
+        ORDER BY working_set.id ASC
         LIMIT 1
     '''
     cursor.execute(command)
     row = cursor.fetchone()
     if not row:
-        print("No cards in working set")
+        LOG.info("No cards in working set")
         return None
-    card_id = row[0]
-    print("Got " + str(card_id))
-    return card_id
+    item_id = row[0]
+    LOG.debug("Got %s", item_id)
+    return item_id
+
+
+def get_next_card(cursor):
+    '''
+    Out of the working set, pick the card that we have not seen for the longest
+    '''
+    item_id = get_next_item(cursor)
+    if item_id is None:
+        return None
+    return split_item_id(item_id)[0]
 
 
 def get_books(cursor):
     '''
     Returns the list of books available and the active book we're filtering on
     '''
-    print("Getting all books")
+    LOG.debug("Getting all books")
     command = '''
         SELECT attributes.value FROM attributes
         WHERE attributes.name == "Book"
@@ -399,7 +1544,7 @@ def get_books(cursor):
     cursor.execute(command)
     rows = cursor.fetchall()
     book_names = [row[0] for row in rows]
-    print("Got " + str(len(book_names)) + " books")
+    LOG.debug("Got %d books", len(book_names))
     return book_names
 
 
@@ -407,7 +1552,7 @@ def clear_preferences(cursor):
     '''
     Erases all the preference stuff
     '''
-    print("Clearing user's preferences")
+    LOG.debug("Clearing user's preferences")
     command = '''
         DELETE FROM preferences
     '''
@@ -418,47 +1563,49 @@ def set_preference(cursor, preference):
     '''
     Adds/sets the given preference for the user
     '''
-    print("Updating user's preference for " + str(preference))
+    LOG.debug("Updating user's preference for %s", preference)
     (attribute_name, attribute_value) = preference
     command = '''
         INSERT OR REPLACE INTO preferences (attribute_name, attribute_value)
         VALUES(?, ?)
     '''
     cursor.execute(command, (attribute_name, attribute_value,))
-    print("Setted " + attribute_name + ' to ' + attribute_value)
+    LOG.debug("Set %s to %s", attribute_name, attribute_value)
 
 
 def set_preferences(cursor, preferences):
     '''
     Sets the user's preferences to the provided
     '''
-    print("Updating user's preferences")
+    LOG.debug("Updating user's preferences")
     clear_preferences(cursor)
     for preference in preferences:
         set_preference(cursor, preference)
+    get_introduction_queue(cursor)
 
 
 def set_prefered_book(cursor, book_name):
     '''
     Sets the user's prefered book
     '''
-    print("Setting prefered book to " + str(book_name))
+    LOG.debug("Setting prefered book to %s", book_name)
     set_preference(cursor, ('Book', book_name,))
+    get_introduction_queue(cursor)
 
 
 def get_card_stats(cursor):
     '''
-    Returns statistics about card stats
+    Returns how many items of each book are in each bucket
     '''
-    print("Getting statistics")
+    LOG.debug("Getting statistics")
     command = '''
-        SELECT COUNT(*), attributes.value, cards.bucket FROM cards
-        LEFT JOIN attributes_cards_relation
-        ON cards.id == attributes_cards_relation.card_id
+        SELECT COUNT(*), attributes.value, items.bucket FROM items
+        INNER JOIN attributes_cards_relation
+        ON attributes_cards_relation.card_id == items.id >> 3
         INNER JOIN attributes
         ON attributes_cards_relation.attribute_id == attributes.id
-        WHERE attributes.name == "Book"
-        GROUP BY attributes.value, cards.bucket
+        WHERE attributes.name == 'Book'
+        GROUP BY attributes.value, items.bucket
     '''
     cursor.execute(command)
     rows = cursor.fetchall()
@@ -474,7 +1621,7 @@ def get_preferences(cursor):
     '''
     Returns the list of attributes and values the user wants to filter by
     '''
-    print("Getting preferences")
+    LOG.debug("Getting preferences")
     command = '''
         SELECT id as id, name as name, value as value FROM preferences
         INNER JOIN attributes
@@ -492,80 +1639,528 @@ def get_book(cursor):
     '''
     preferences = get_preferences(cursor)
     for preference in preferences:
-        print(preference)
-        print(type(preference))
         if preference[str('name')] == 'Book':
             return preference[str('value')]
     return None
 
 
+def get_metadata(cursor):
+    '''
+    Returns the books, the user's preferences (with the active book) and
+    every facet value, which pages cache until they change
+    '''
+    preferences = [tuple(row) for row in get_preferences(cursor)]
+    active_books = [value for (_, name, value) in preferences if name == 'Book']
+    return {
+        'books': get_books(cursor),
+        'preferences': preferences,
+        'active_book': active_books[0] if active_books else None,
+        'facets': get_attributes(cursor),
+    }
+
+
+def get_deck_settings(cursor):
+    '''
+    Returns the (working set size, easy ratio, new cards per day) for the
+    user's prefered book
+    '''
+    command = '''
+        SELECT working_set_size, easy_ratio, new_cards_per_day
+        FROM deck_settings
+        INNER JOIN preferences
+        ON preferences.attribute_name == 'Book'
+        AND preferences.attribute_value == deck_settings.book
+    '''
+    cursor.execute(command)
+    row = cursor.fetchone()
+    if not row:
+        return (
+            DEFAULT_WORKING_SET_SIZE,
+            DEFAULT_EASY_RATIO,
+            DEFAULT_NEW_CARDS_PER_DAY,
+        )
+    new_cards_per_day = row[2]
+    if new_cards_per_day is None:
+        new_cards_per_day = DEFAULT_NEW_CARDS_PER_DAY
+    return (row[0], row[1], new_cards_per_day)
+
+
+def set_deck_settings(cursor, book_name, working_set_size, easy_ratio,
+                      new_cards_per_day=DEFAULT_NEW_CARDS_PER_DAY):
+    '''
+    Sets how many cards are studied at once for a book, which share of
+    new draws should be easy cards mixed back in, and how many new cards
+    may be introduced a day
+    '''
+    assert working_set_size > 0
+    assert 0 <= easy_ratio <= 1
+    assert new_cards_per_day >= 0
+    command = '''
+        INSERT OR REPLACE INTO deck_settings
+        (book, working_set_size, easy_ratio, new_cards_per_day)
+        VALUES (?, ?, ?, ?)
+    '''
+    cursor.execute(
+        command,
+        (book_name, working_set_size, easy_ratio, new_cards_per_day),
+    )
+
+
 def init_working_set(cursor):
     '''
-    Creates a working set for the user with at least 7 cards
+    Tops up the working set to the deck's working set size
+
+    A share of these cards are the ones most easily confused with cards
+    already in the working set.  The others are new cards from the
+    introduction queue first, within the deck's daily budget, then a share
+    of easy cards to mix things up, and the rest are the oldest cards we
+    haven't seen.  Each of those is a single INSERT ... SELECT, so a refill
+    costs a handful of statements however many cards are missing.
 
-    These cards are drawin from the "genesis" deck,
-    or else it's the oldest card we haven't seen.
+    Returns how many cards were added.
     '''
-    # Assert working set is not initialized
-    print("Initing working set")
+    LOG.debug("Initing working set")
+    (size, easy_ratio, new_cards_per_day) = get_deck_settings(cursor)
+    current = get_working_set_size(cursor)
+    missing = size - current
+    if missing <= 0:
+        return 0
 
-    for _ in range(get_working_set_size(cursor), 7):
-        if draw_from_bucket(cursor, "genesis") is not None:
-            print("Found a card from genesis to add to working set")
-            continue
+    # Round randomly so that topping up one card at a time still draws a
+    # confusable card CONFUSABLE_RATIO of the time
+    added = 0
+    confusable = int(min(missing, missing * CONFUSABLE_RATIO + random.random()))
+    if current > 0 and confusable > 0:
+        added += draw_confusables(cursor, confusable)
 
-        if random.random() < 0.3:
-            print("Randomly draw from the easy pool to mix things up")
-            if draw_from_bucket(cursor, "easy") is not None:
-                print("Found a card from genesis to add to working set")
-                continue
+    added += draw_new_items(cursor, new_cards_per_day, missing - added)
 
-        # However, usually, we should draw from the tail to prevent stale cards
-        if draw_from_least_recently_seen(cursor) is not None:
-            print("Found a card we haven't seen in a while for working set")
-            continue
+    # Likewise, draw an easy card easy_ratio of the time
+    easy = int(min(missing - added, (missing - added) * easy_ratio + random.random()))
+    if easy > 0:
+        added += draw_from_bucket(cursor, "easy", easy)
 
-        print("Could not find another card to add to the working set. \
-        This could there's not enough cards in the deck to form a full \
-        working set, or a bug.")
+    # However, usually, we should draw from the tail to prevent stale cards
+    if added < missing:
+        added += draw_from_least_recently_seen(cursor, missing - added)
 
+    if added < missing:
+        # Either the deck is too small to fill a working set, or a bug
+        LOG.debug(
+            "Could only add %d of the %d cards missing from the working set",
+            added, missing,
+        )
+    return added
 
-def create_content(cursor, book_title, lesson_name, headers, cards):
+
+def create_content(cursor, book_title, lesson_name, headers, cards,
+                   duplicates=None):
     '''
     Populates/inserts the given content into the database
 
-    We will not reuse any content (merging).
+    We will not reuse any cards (merging) unless duplicates is 'merge', see
+    add_card, but the book and lesson are shared with earlier imports.
     '''
     book_id = create_book(cursor, book_title)
     lesson_id = create_lesson(cursor, lesson_name)
+    names = [header.lower() for header in headers]
+    book_headers = extend_headers(cursor, book_id, names)
+    positions = [book_headers.index(name) for name in names]
+
     for row in cards:
         assert len(headers) == len(row)
 
-        card_id = create_card(cursor)
-        print("Created card: " + str(card_id))
-        for i in range(0, len(headers)):
-            name = headers[i].lower()
-            value = row[i]
-            attribute_id = create_attribute(cursor, name, value)
-            print("Created attribute: " + str(attribute_id) + " for " + name + " = " + value)
-            associate_card_and_attribute(cursor, card_id, attribute_id)
-        associate_card_and_attribute(cursor, card_id, book_id)
-        associate_card_and_attribute(cursor, card_id, lesson_id)
+        values = [''] * len(book_headers)
+        for (position, value) in zip(positions, row):
+            values[position] = value
+        card_id = add_card(cursor, book_id, lesson_id, values, duplicates)
+        LOG.debug("Created card %d", card_id)
+    update_neighbours(cursor)
+
+
+def list_card_ids(cursor, book=None, lesson=None, bucket=None, due=None,
+                  after=0, limit=DEFAULT_PAGE_SIZE):
+    '''
+    Returns up to `limit` ids of cards after the given card id, in order,
+    in the given book and lesson, with an item in the given bucket, and in
+    the working set (due) or not.  Filters left as None aren't applied.
+
+    Pages are read by seeking to the card id through an index instead of
+    skipping the pages before with OFFSET, so a page costs the same however
+    deep it is.  With a book or lesson, the scan runs over that facet's
+    (attribute_id, card_id) index.
+    '''
+    facet_ids = []
+    for (name, value) in (('Lesson', lesson), ('Book', book)):
+        if value is None:
+            continue
+        cursor.execute(
+            'SELECT id FROM attributes WHERE name == ? AND value == ?',
+            (name, value),
+        )
+        row = cursor.fetchone()
+        if row is None:
+            return []
+        facet_ids.append(row[0])
+
+    parameters = {'after': after, 'limit': limit, 'bucket': bucket}
+    if facet_ids:
+        column = 'relation.card_id'
+        command = '''
+            SELECT relation.card_id FROM attributes_cards_relation AS relation
+            WHERE relation.attribute_id == :facet0
+            AND relation.card_id > :after
+        '''
+        parameters['facet0'] = facet_ids[0]
+    else:
+        column = 'cards.id'
+        command = 'SELECT cards.id FROM cards WHERE cards.id > :after'
+    conditions = []
+    for (i, facet_id) in enumerate(facet_ids[1:], 1):
+        conditions.append('''
+            EXISTS (
+                SELECT 1 FROM attributes_cards_relation AS other
+                WHERE other.card_id == %s AND other.attribute_id == :facet%d
+            )
+        ''' % (column, i))
+        parameters['facet%d' % i] = facet_id
+    if bucket is not None:
+        conditions.append('''
+            EXISTS (
+                SELECT 1 FROM items
+                WHERE items.id BETWEEN %s << 3 AND (%s << 3) + 7
+                AND items.bucket == :bucket
+            )
+        ''' % (column, column))
+    if due is not None:
+        conditions.append('%s %s (SELECT card_id FROM working_set)' % (
+            column, 'IN' if due else 'NOT IN'))
+
+    command += ''.join(' AND ' + condition for condition in conditions)
+    command += ' ORDER BY %s LIMIT :limit' % column
+    cursor.execute(command, parameters)
+    return [row[0] for row in cursor.fetchall()]
+
+
+def get_cards(cursor, card_ids):
+    '''
+    Returns the given cards, in id order, as dictionaries with their book,
+    lessons, fields, the bucket of each of their items and whether they're
+    in the working set (due).  The whole page is read in a single query.
+    '''
+    command = '''
+        SELECT
+            cards.id,
+            cards.content,
+            card_schemas.headers,
+            books.value,
+            (
+                SELECT json_group_array(lessons.value)
+                FROM attributes_cards_relation AS relation
+                INNER JOIN attributes AS lessons
+                ON lessons.id == relation.attribute_id
+                WHERE relation.card_id == cards.id AND lessons.name == 'Lesson'
+            ),
+            (
+                SELECT json_group_array(json_array(items.id & 7, items.bucket))
+                FROM items
+                WHERE items.id BETWEEN cards.id << 3 AND (cards.id << 3) + 7
+            ),
+            cards.id IN (SELECT card_id FROM working_set)
+        FROM cards
+        LEFT JOIN card_schemas ON card_schemas.book_id == cards.book_id
+        LEFT JOIN attributes AS books ON books.id == cards.book_id
+        WHERE cards.id IN (SELECT value FROM json_each(?))
+        ORDER BY cards.id
+    '''
+    cursor.execute(command, (json.dumps(list(card_ids)),))
+    cards = []
+    for (card_id, content, headers, book, lessons, items, due) in cursor.fetchall():
+        headers = unpack_values(headers)
+        cards.append({
+            'id': card_id,
+            'book': book,
+            'lessons': json.loads(lessons),
+            'fields': dict(zip(headers, unpack_values(content, len(headers)))),
+            'items': [
+                {'direction': direction, 'bucket': item_bucket}
+                for (direction, item_bucket) in json.loads(items)
+            ],
+            'due': bool(due),
+        })
+    return cards
+
+
+def get_lesson_cards(cursor, book_title, lesson_name):
+    '''
+    Returns every card in the given book and lesson as a dictionary of
+    card_id to its list of field values, in one query
+    '''
+    command = '''
+        SELECT cards.id, cards.content FROM cards
+        WHERE cards.id IN (
+            SELECT relation.card_id FROM attributes_cards_relation AS relation
+            INNER JOIN attributes
+            ON attributes.id == relation.attribute_id
+            WHERE attributes.name == 'Book' AND attributes.value == ?
+        )
+        AND cards.id IN (
+            SELECT relation.card_id FROM attributes_cards_relation AS relation
+            INNER JOIN attributes
+            ON attributes.id == relation.attribute_id
+            WHERE attributes.name == 'Lesson' AND attributes.value == ?
+        )
+    '''
+    cursor.execute(command, (book_title, lesson_name))
+    return dict(
+        (card_id, unpack_values(content))
+        for (card_id, content) in cursor.fetchall()
+    )
+
+
+def content_hash(values):
+    '''
+    Returns a stable identity for a card made from its field values
+    '''
+    content = '\x1f'.join(values)
+    return hashlib.sha1(content.encode('utf8')).hexdigest()
+
+
+def delete_cards(cursor, card_ids):
+    '''
+    Deletes the given cards along with their items, votes, working set
+    entries and similarity index.  Shared Book and Lesson attributes are
+    kept, and cards that had them as neighbours are queued to find new ones.
+    '''
+    parameters = [(card_id,) for card_id in card_ids]
+    cursor.executemany('''
+        INSERT OR IGNORE INTO stale_neighbours (card_id)
+        SELECT card_id FROM card_neighbours WHERE neighbour_id == ?
+    ''', parameters)
+    cursor.executemany(
+        'DELETE FROM card_neighbours WHERE neighbour_id == ?', parameters)
+    for table in ('attributes_cards_relation', 'votes', 'working_set',
+                  'card_features', 'card_neighbours', 'stale_neighbours'):
+        cursor.executemany(
+            'DELETE FROM %s WHERE card_id == ?' % table,
+            parameters,
+        )
+    for (table, column) in (('items', 'id'), ('item_summaries', 'item_id')):
+        cursor.executemany(
+            'DELETE FROM %s WHERE %s BETWEEN ?1 << 3 AND (?1 << 3) + 7' % (
+                table, column),
+            parameters,
+        )
+    cursor.executemany('DELETE FROM cards WHERE id == ?', parameters)
+
+
+def get_cards_in_other_lessons(cursor, card_ids, lesson_id):
+    '''
+    Returns which of the given cards also belong to a lesson other than
+    lesson_id, because a duplicate was merged into them
+    '''
+    command = '''
+        SELECT DISTINCT relation.card_id FROM attributes_cards_relation AS relation
+        INNER JOIN attributes
+        ON attributes.id == relation.attribute_id
+        WHERE relation.card_id IN (SELECT value FROM json_each(?))
+        AND attributes.name == 'Lesson' AND attributes.id != ?
+    '''
+    cursor.execute(command, (json.dumps(list(card_ids)), lesson_id))
+    return set(row[0] for row in cursor.fetchall())
+
+
+def sync_content(cursor, book_title, lesson_name, headers, cards,
+                 key_column=None, delete_missing=False, duplicates=None):
+    '''
+    Merges the given content into an existing book and lesson.
+
+    Cards are matched by the value in key_column, or by a hash of all their
+    fields when no key column is given (so any edit looks like a new card).
+    Matching cards keep their id, votes and bucket and only have their
+    content rewritten if it changed.  New rows become new cards, and cards
+    missing from the content are deleted only if delete_missing is set;
+    cards merged into other lessons too are just unlinked from this one.
+    New rows are checked for duplicates like create_content does.
+
+    Nothing is committed, so the whole sync is one transaction for the
+    caller.  Returns a dictionary counting the cards inserted, updated,
+    deleted, unlinked from the lesson and left unchanged.
+    '''
+    names = [header.lower() for header in headers]
+    if key_column is not None:
+        key_index = names.index(key_column.lower())
+
+        def key_of(values):
+            ''' Returns the value of the key column '''
+            return values[key_index]
+    else:
+        key_of = content_hash
+
+    book_id = create_book(cursor, book_title)
+    lesson_id = create_lesson(cursor, lesson_name)
+    book_headers = extend_headers(cursor, book_id, names)
+    positions = [book_headers.index(name) for name in names]
+
+    existing = get_lesson_cards(cursor, book_title, lesson_name)
+    by_key = {}
+    for (card_id, values) in sorted(existing.items()):
+        values = values + [''] * (len(book_headers) - len(values))
+        existing[card_id] = values
+        by_key.setdefault(key_of([values[i] for i in positions]), card_id)
+
+    updates = []
+    insertions = []
+    matched = set()
+    result = {
+        'inserted': 0, 'updated': 0, 'deleted': 0, 'unlinked': 0,
+        'unchanged': 0,
+    }
+    for row in cards:
+        assert len(names) == len(row)
+        card_id = by_key.get(key_of(row))
+        if card_id is None or card_id in matched:
+            insertions.append(row)
+            continue
+
+        matched.add(card_id)
+        values = list(existing[card_id])
+        for (position, value) in zip(positions, row):
+            values[position] = value
+        if values != existing[card_id]:
+            updates.append((pack_values(values), content_key(values), card_id))
+            result['updated'] += 1
+        else:
+            result['unchanged'] += 1
+
+    LOG.info(
+        "Syncing %s %s: %d new, %d edits",
+        book_title, lesson_name, len(insertions), len(updates),
+    )
+    cursor.executemany(
+        'UPDATE cards SET content=?, content_key=? WHERE id==?',
+        updates,
+    )
+    mark_neighbours_stale(cursor, [card_id for (_, _, card_id) in updates])
+
+    for row in insertions:
+        values = [''] * len(book_headers)
+        for (position, value) in zip(positions, row):
+            values[position] = value
+        add_card(cursor, book_id, lesson_id, values, duplicates)
+    result['inserted'] = len(insertions)
+
+    if delete_missing:
+        missing = [card_id for card_id in existing if card_id not in matched]
+        shared = get_cards_in_other_lessons(cursor, missing, lesson_id)
+        cursor.executemany('''
+            DELETE FROM attributes_cards_relation
+            WHERE card_id == ? AND attribute_id == ?
+        ''', [(card_id, lesson_id) for card_id in shared])
+        deleted = [card_id for card_id in missing if card_id not in shared]
+        delete_cards(cursor, deleted)
+        result['deleted'] = len(deleted)
+        result['unlinked'] = len(shared)
+
+    update_neighbours(cursor)
+    return result
 
 
 def main():
     ''' Imports data from a file '''
-    connection = sqlite3.connect('../example.db')
+    parser = argparse.ArgumentParser(description='Imports flashcards from TSV')
+    parser.add_argument(
+        'file_path', nargs='?', help='TSV export with a header row')
+    parser.add_argument(
+        'book', nargs='?', help='Title of the book, e.g. Mandarin')
+    parser.add_argument(
+        'lesson', nargs='?', help='Name of the lesson, e.g. 8-5')
+    parser.add_argument('--database', default='example.db')
+    parser.add_argument(
+        '--duplicates',
+        choices=('link', 'merge'),
+        help='Link new cards to, or merge them into, matching existing cards',
+    )
+    parser.add_argument(
+        '--report-duplicates',
+        action='store_true',
+        help='List groups of likely duplicate cards instead of importing',
+    )
+    parser.add_argument(
+        '--index-neighbours',
+        action='store_true',
+        help='Rebuild the index of easily confused cards instead of importing',
+    )
+    parser.add_argument(
+        '--processes',
+        type=int,
+        help='Worker processes for --index-neighbours (default: one per CPU)',
+    )
+    parser.add_argument(
+        '--sync',
+        action='store_true',
+        help='Merge into the existing lesson instead of adding new cards',
+    )
+    parser.add_argument(
+        '--key',
+        help='Column identifying a card when syncing (default: content hash)',
+    )
+    parser.add_argument(
+        '--delete-missing',
+        action='store_true',
+        help='When syncing, delete cards no longer in the file',
+    )
+    args = parser.parse_args()
+    logs.configure()
+
+    connection = sqlite3.connect(args.database)
     cursor = connection.cursor()
     init(cursor)
-    title = 'Mandarin'
-    lesson = '8-5'
-    file_path = "/Users/livingon/Downloads/Mandarin - Level 8 Lesson 5-2.tsv"
-    data = read_data(file_path)
+    if args.report_duplicates:
+        connection.commit()
+        for group in find_duplicates(cursor):
+            print(' | '.join(
+                '%d: %s' % (card_id, ', '.join(
+                    value for (_, value) in get_card_attributes(cursor, card_id)
+                    if value
+                ))
+                for card_id in group
+            ))
+        return
+    if args.index_neighbours:
+        count = rebuild_neighbours(cursor, processes=args.processes)
+        connection.commit()
+        print("Indexed neighbours of " + str(count) + " cards")
+        return
+    if not args.lesson:
+        parser.error('file_path, book and lesson are required to import')
+
+    data = read_data(args.file_path)
     headers = data[0]
     cards = data[1:]
-    create_content(cursor, title, lesson, headers, cards)
+    if args.sync:
+        result = sync_content(
+            cursor,
+            args.book,
+            args.lesson,
+            headers,
+            cards,
+            key_column=args.key,
+            delete_missing=args.delete_missing,
+            duplicates=args.duplicates,
+        )
+        print("Synced: " + str(result))
+    else:
+        create_content(
+            cursor,
+            args.book,
+            args.lesson,
+            headers,
+            cards,
+            duplicates=args.duplicates,
+        )
     connection.commit()
+    cache.bump_version(args.database)
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,371 @@
+'''
+Load generator that simulates concurrent learners studying with the app.
+
+Every simulated learner walks the real routes the way a person would:
+pick a book, fetch the next card, look at it, answer good/okay/bad with a
+configurable distribution, and now and then peek at the statistics page or
+switch books.  It can drive the app in-process through the Flask test
+client, or over HTTP against a running server, and reports throughput and
+p50/p95/p99 latencies per route along with how often SQLite was locked.
+
+    python -m hikariita.loadtest --learners 8 --iterations 50 --database example.db
+    python -m hikariita.loadtest --url http://localhost:5000 --learners 8
+'''
+
+from __future__ import unicode_literals, print_function
+
+import argparse
+import math
+import random
+import re
+import sqlite3
+import threading
+import time
+from http.client import HTTPConnection
+from urllib.parse import urlencode, urlsplit
+
+from flask import got_request_exception
+
+
+DEFAULT_ANSWERS = (('good', 0.6), ('okay', 0.25), ('bad', 0.15))
+
+CARD_PATH = re.compile(r'/cards/(-?\d+)/(?:\?direction=(\d+))?$')
+BOOK_INPUT = re.compile(r'name="Book" value="([^"]*)"')
+
+
+def percentile(samples, fraction):
+    '''
+    Nearest-rank percentile of an already sorted list of samples
+    '''
+    if not samples:
+        return None
+    rank = max(int(math.ceil(fraction * len(samples))) - 1, 0)
+    return samples[min(rank, len(samples) - 1)]
+
+
+class Results(object):
+    '''
+    Thread-safe collection of per-route latencies and error counts
+    '''
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = {}
+        self.errors = {}
+        self.lock_waits = 0
+
+    def record(self, route, elapsed, ok):
+        ''' Records one request against the given route label '''
+        with self.lock:
+            self.latencies.setdefault(route, []).append(elapsed)
+            if not ok:
+                self.errors[route] = self.errors.get(route, 0) + 1
+
+    def record_lock_wait(self):
+        ''' Records a request that failed because the database was locked '''
+        with self.lock:
+            self.lock_waits += 1
+
+    def summary(self, duration):
+        '''
+        Returns a dictionary with throughput and latency percentiles
+        (in milliseconds) for each route
+        '''
+        routes = {}
+        total = 0
+        for (route, samples) in self.latencies.items():
+            samples = sorted(samples)
+            total += len(samples)
+            routes[route] = {
+                'count': len(samples),
+                'errors': self.errors.get(route, 0),
+                'p50': percentile(samples, 0.50) * 1000,
+                'p95': percentile(samples, 0.95) * 1000,
+                'p99': percentile(samples, 0.99) * 1000,
+            }
+        return {
+            'duration': duration,
+            'requests': total,
+            'throughput': total / duration if duration else 0.0,
+            'lock_waits': self.lock_waits,
+            'routes': routes,
+        }
+
+
+class TestClientSession(object):
+    '''
+    Sends requests straight into the Flask app through its test client
+    '''
+
+    def __init__(self, app):
+        self.client = app.test_client()
+
+    def request(self, method, path, data=None, headers=None):
+        '''
+        Returns (status code, Location header, body) for the request
+        '''
+        response = self.client.open(
+            path,
+            method=method,
+            data=data,
+            headers=headers,
+        )
+        body = response.get_data(as_text=True)
+        return (response.status_code, response.headers.get('Location'), body)
+
+
+class HttpSession(object):
+    '''
+    Sends requests to a running server over a keep-alive HTTP connection
+    '''
+
+    def __init__(self, base_url):
+        parts = urlsplit(base_url)
+        self.host = parts.hostname
+        self.port = parts.port or 80
+        self.connection = HTTPConnection(self.host, self.port, timeout=30)
+
+    def request(self, method, path, data=None, headers=None):
+        '''
+        Returns (status code, Location header, body) for the request
+        '''
+        headers = dict(headers or {})
+        body = None
+        if data is not None:
+            body = urlencode(data)
+            headers['Content-Type'] = 'application/x-www-form-urlencoded'
+        try:
+            self.connection.request(method, path, body, headers)
+            response = self.connection.getresponse()
+        except Exception:
+            # The server may close idle keep-alive connections on us
+            self.connection.close()
+            self.connection = HTTPConnection(self.host, self.port, timeout=30)
+            self.connection.request(method, path, body, headers)
+            response = self.connection.getresponse()
+        content = response.read().decode('utf8', 'replace')
+        return (response.status, response.getheader('Location'), content)
+
+
+class Learner(object):
+    '''
+    A simulated person studying flashcards
+    '''
+
+    def __init__(self, session, results, rng, answers=DEFAULT_ANSWERS,
+                 stats_every=10, switch_book_chance=0.02, think_time=0.0):
+        self.session = session
+        self.results = results
+        self.rng = rng
+        self.answers = answers
+        self.stats_every = stats_every
+        self.switch_book_chance = switch_book_chance
+        self.think_time = think_time
+        self.books = []
+
+    def request(self, route, method, path, data=None, headers=None):
+        '''
+        Times a single request and files it under the given route label
+        '''
+        start = time.time()
+        try:
+            (status, location, body) = self.session.request(
+                method, path, data, headers)
+        except sqlite3.OperationalError as error:
+            # In-process requests raise when the app is in testing mode
+            self.results.record(route, time.time() - start, False)
+            if 'locked' in str(error):
+                self.results.record_lock_wait()
+            return (500, None, '')
+        self.results.record(route, time.time() - start, status < 500)
+        if location:
+            parts = urlsplit(location)
+            location = parts.path + ('?' + parts.query if parts.query else '')
+        return (status, location, body)
+
+    def answer(self):
+        ''' Picks an answer following the configured distribution '''
+        roll = self.rng.random()
+        for (answer, weight) in self.answers:
+            roll -= weight
+            if roll < 0:
+                return answer
+        return self.answers[-1][0]
+
+    def pick_book(self, referer):
+        ''' Chooses one of the known books to study from '''
+        if not self.books:
+            return
+        self.request(
+            '/preferences/edit',
+            'POST',
+            '/preferences/edit',
+            data={'Book': self.rng.choice(self.books)},
+            headers={'Referer': referer},
+        )
+
+    def study(self, iterations):
+        ''' Studies the given number of cards '''
+        for iteration in range(iterations):
+            (_, location, _) = self.request('/cards/', 'GET', '/cards/')
+            match = CARD_PATH.search(location or '')
+            if not match:
+                continue
+            (card_id, direction) = match.groups('0')
+
+            (_, _, body) = self.request(
+                '/cards/<id>/', 'GET', location)
+            if not self.books:
+                self.books = BOOK_INPUT.findall(body)
+
+            if card_id == '-1' or \
+                    self.rng.random() < self.switch_book_chance:
+                self.pick_book('/cards/%s/' % card_id)
+                continue
+
+            if self.think_time:
+                time.sleep(self.rng.expovariate(1.0 / self.think_time))
+
+            self.request(
+                '/cards/<id>/vote',
+                'POST',
+                '/cards/%s/vote' % card_id,
+                data={'confidence': self.answer(), 'direction': direction},
+            )
+
+            if self.stats_every and iteration % self.stats_every == 0:
+                self.request('/stats/', 'GET', '/stats/')
+
+
+def _count_lock_errors(app, results):
+    '''
+    Subscribes to the app's exception signal to count locked databases
+    '''
+    def on_exception(sender, exception, **extra):
+        ''' Counts exceptions caused by SQLite lock timeouts '''
+        del sender, extra
+        if isinstance(exception, sqlite3.OperationalError) and \
+                'locked' in str(exception):
+            results.record_lock_wait()
+
+    got_request_exception.connect(on_exception, app)
+    return on_exception
+
+
+def run(session_factory, learners, iterations, seed=None, **options):
+    '''
+    Runs the given number of learners concurrently, each with a session
+    from session_factory, and returns the Results summary
+    '''
+    results = options.pop('results', None) or Results()
+    seeder = random.Random(seed)
+    threads = []
+    for _ in range(learners):
+        learner = Learner(
+            session_factory(),
+            results,
+            random.Random(seeder.random()),
+            **options
+        )
+        threads.append(threading.Thread(target=learner.study, args=(iterations,)))
+
+    start = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results.summary(time.time() - start)
+
+
+def run_in_process(app, learners, iterations, seed=None, **options):
+    '''
+    Load tests the given Flask app through its test client
+    '''
+    results = Results()
+    handler = _count_lock_errors(app, results)
+    try:
+        return run(
+            lambda: TestClientSession(app),
+            learners,
+            iterations,
+            seed=seed,
+            results=results,
+            **options
+        )
+    finally:
+        got_request_exception.disconnect(handler, app)
+
+
+def run_over_http(base_url, learners, iterations, seed=None, **options):
+    '''
+    Load tests a server listening at base_url.  Lock waits cannot be seen
+    from out here, so they only show up as server errors.
+    '''
+    return run(
+        lambda: HttpSession(base_url),
+        learners,
+        iterations,
+        seed=seed,
+        **options
+    )
+
+
+def print_report(summary):
+    ''' Prints a summary as returned by run() '''
+    print("%d requests in %.2fs (%.1f req/s), %d lock waits" % (
+        summary['requests'],
+        summary['duration'],
+        summary['throughput'],
+        summary['lock_waits'],
+    ))
+    print("%-20s %8s %8s %10s %10s %10s" % (
+        'route', 'count', 'errors', 'p50 ms', 'p95 ms', 'p99 ms'))
+    for (route, stats) in sorted(summary['routes'].items()):
+        print("%-20s %8d %8d %10.1f %10.1f %10.1f" % (
+            route,
+            stats['count'],
+            stats['errors'],
+            stats['p50'],
+            stats['p95'],
+            stats['p99'],
+        ))
+
+
+def main():
+    ''' Runs the load generator from the command line '''
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--learners', type=int, default=4)
+    parser.add_argument('--iterations', type=int, default=25)
+    parser.add_argument('--seed', type=int)
+    parser.add_argument(
+        '--url',
+        help='Base URL of a running server, otherwise runs in-process',
+    )
+    parser.add_argument(
+        '--database',
+        help='Database to use when running in-process',
+    )
+    parser.add_argument('--think-time', type=float, default=0.0)
+    parser.add_argument('--stats-every', type=int, default=10)
+    parser.add_argument('--switch-book-chance', type=float, default=0.02)
+    args = parser.parse_args()
+
+    options = {
+        'think_time': args.think_time,
+        'stats_every': args.stats_every,
+        'switch_book_chance': args.switch_book_chance,
+    }
+    if args.url:
+        summary = run_over_http(
+            args.url, args.learners, args.iterations, args.seed, **options)
+    else:
+        from . import APP
+        if args.database:
+            APP.config['DATABASE'] = args.database
+        summary = run_in_process(
+            APP, args.learners, args.iterations, args.seed, **options)
+    print_report(summary)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,242 @@
+'''
+Sets up logging so that it costs the request path next to nothing.
+
+Modules log through their own logger, logging.getLogger(__name__), with
+%-style arguments instead of pre-built strings.  Below the configured level
+a call returns before anything is formatted.  Records that do pass are put
+on a queue as they are and formatted and written by a background thread,
+so a slow log file never holds up a request.
+
+Levels are set per module with the HIKARIITA_LOG environment variable, a
+default level optionally followed by per-logger ones, e.g.
+
+    HIKARIITA_LOG=INFO,hikariita.db=DEBUG,hikariita.replenish=WARNING
+
+Debug records are rate limited per call site, so turning debugging on for a
+busy module doesn't flood the log.  Records logged during a request carry
+its id, the card id from the URL and the time elapsed since it started, and
+everything is written as one JSON object per line.
+'''
+
+from __future__ import unicode_literals, print_function
+
+import atexit
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import sys
+import threading
+import time
+import uuid
+
+from flask import g, has_request_context, request
+
+
+ENVIRONMENT_VARIABLE = 'HIKARIITA_LOG'
+DEFAULT_LEVEL = 'INFO'
+
+# Debug records let through per call site: a burst, then a steady rate
+DEBUG_BURST = 20
+DEBUG_RATE = 5.0
+
+# Attributes every LogRecord has, so anything else came from extra=
+RECORD_ATTRIBUTES = frozenset(vars(logging.LogRecord(
+    '', logging.INFO, '', 0, '', (), None)).keys()) | frozenset(['message'])
+
+CONFIGURATION_LOCK = threading.Lock()
+LISTENER = None
+
+
+class StderrHandler(logging.StreamHandler):
+    '''
+    Writes to whatever sys.stderr currently is, rather than the stream it
+    was at start up
+    '''
+
+    def __init__(self):
+        logging.Handler.__init__(self)
+
+    @property
+    def stream(self):
+        return sys.stderr
+
+
+class BackgroundHandler(logging.handlers.QueueHandler):
+    '''
+    Queues records without formatting them.  The stock QueueHandler formats
+    the message on the calling thread, which is what we want to avoid.
+    '''
+
+    def prepare(self, record):
+        return record
+
+
+class RequestContextFilter(logging.Filter):
+    '''
+    Adds the id, card id and elapsed time of the current request, if any,
+    to each record
+    '''
+
+    def filter(self, record):
+        if has_request_context():
+            record.request_id = g.get('request_id')
+            card_id = (request.view_args or {}).get('card_id')
+            if card_id is not None:
+                record.card_id = card_id
+            elapsed = request_elapsed()
+            if elapsed is not None:
+                record.elapsed_ms = round(elapsed * 1000.0, 3)
+        return True
+
+
+class RateLimitFilter(logging.Filter):
+    '''
+    Lets through at most `burst` records below `level` from each call site
+    at once, refilling at `rate` records per second.  The next record let
+    through after some were dropped says how many in its `suppressed` field.
+    '''
+
+    def __init__(self, level=logging.DEBUG, burst=DEBUG_BURST, rate=DEBUG_RATE):
+        logging.Filter.__init__(self)
+        self.level = level
+        self.burst = burst
+        self.rate = rate
+        self.lock = threading.Lock()
+        # (pathname, lineno) -> [tokens, last refill, suppressed]
+        self.buckets = {}
+
+    def filter(self, record):
+        if record.levelno > self.level:
+            return True
+        key = (record.pathname, record.lineno)
+        now = time.monotonic()
+        with self.lock:
+            bucket = self.buckets.get(key)
+            if bucket is None:
+                bucket = [float(self.burst), now, 0]
+                self.buckets[key] = bucket
+            bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+            bucket[1] = now
+            if bucket[0] < 1.0:
+                bucket[2] += 1
+                return False
+            bucket[0] -= 1.0
+            if bucket[2]:
+                record.suppressed = bucket[2]
+                bucket[2] = 0
+        return True
+
+
+class JSONFormatter(logging.Formatter):
+    '''
+    Formats a record as a JSON object on one line, with its context and
+    extra fields as keys of their own
+    '''
+
+    def format(self, record):
+        entry = {
+            'time': self.formatTime(record),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+        for (key, value) in vars(record).items():
+            if key not in RECORD_ATTRIBUTES:
+                entry[key] = value
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+def parse_levels(spec):
+    '''
+    Parses "INFO,hikariita.db=DEBUG" into a default level and a dictionary
+    of per-logger levels
+    '''
+    default = DEFAULT_LEVEL
+    levels = {}
+    for part in (spec or '').split(','):
+        part = part.strip()
+        if not part:
+            continue
+        if '=' in part:
+            (name, level) = part.split('=', 1)
+            levels[name.strip()] = level.strip().upper()
+        else:
+            default = part.upper()
+    return (default, levels)
+
+
+def configure(spec=None, handlers=None):
+    '''
+    Routes the records of the hikariita loggers through a queue to a
+    background thread writing them with the given handlers (by default
+    JSON lines on stderr).  They don't propagate to the root logger, whose
+    handlers would format them on the calling thread.  Calling it again
+    replaces the previous set up, and resets any level it set.
+    '''
+    global LISTENER
+    if spec is None:
+        spec = os.environ.get(ENVIRONMENT_VARIABLE)
+    (default, levels) = parse_levels(spec)
+    if handlers is None:
+        handler = StderrHandler()
+        handler.setFormatter(JSONFormatter())
+        handlers = [handler]
+
+    with CONFIGURATION_LOCK:
+        root = logging.getLogger('hikariita')
+        if LISTENER is not None:
+            LISTENER.stop()
+            for handler in list(root.handlers):
+                if isinstance(handler, BackgroundHandler):
+                    root.removeHandler(handler)
+        for logger in logging.Logger.manager.loggerDict.values():
+            if isinstance(logger, logging.Logger) and \
+                    logger.name.startswith('hikariita.'):
+                logger.setLevel(logging.NOTSET)
+
+        records = queue.SimpleQueue()
+        handler = BackgroundHandler(records)
+        handler.addFilter(RateLimitFilter())
+        handler.addFilter(RequestContextFilter())
+        root.addHandler(handler)
+        root.setLevel(default)
+        root.propagate = False
+        for (name, level) in levels.items():
+            logging.getLogger(name).setLevel(level)
+
+        LISTENER = logging.handlers.QueueListener(
+            records, *handlers, respect_handler_level=True)
+        LISTENER.start()
+
+
+def stop():
+    ''' Writes out the queued records and stops the background thread '''
+    global LISTENER
+    with CONFIGURATION_LOCK:
+        if LISTENER is not None:
+            LISTENER.stop()
+            LISTENER = None
+
+
+atexit.register(stop)
+
+
+def start_request():
+    '''
+    Gives the current request an id, taken from X-Request-Id if a proxy set
+    one, and starts its clock
+    '''
+    g.request_id = request.headers.get('X-Request-Id') or uuid.uuid4().hex[:16]
+    g.request_started = time.perf_counter()
+
+
+def request_elapsed():
+    ''' Returns the seconds since the current request started, or None '''
+    started = g.get('request_started')
+    if started is None:
+        return None
+    return time.perf_counter() - started
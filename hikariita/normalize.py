@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+
+'''
+Normalizes card text so the same word typed slightly differently in two
+decks compares equal: full/half width forms, katakana vs hiragana, pinyin
+with or without tone marks, case, punctuation and spacing.
+'''
+
+from __future__ import unicode_literals, print_function
+
+import hashlib
+import unicodedata
+
+
+# Katakana ァ (U+30A1) to ヶ (U+30F6) sit exactly 0x60 above their hiragana
+KATAKANA_START = 0x30A1
+KATAKANA_END = 0x30F6
+KATAKANA_TO_HIRAGANA = 0x60
+
+# Combining marks used by pinyin tones: macron, acute, caron and grave.
+# The diaeresis is kept so ü and u stay different.
+TONE_MARKS = set(['\u0304', '\u0301', '\u030c', '\u0300'])
+
+
+def fold_kana(text):
+    '''
+    Replaces katakana with the matching hiragana
+    '''
+    return ''.join(
+        chr(ord(char) - KATAKANA_TO_HIRAGANA)
+        if KATAKANA_START <= ord(char) <= KATAKANA_END else char
+        for char in text
+    )
+
+
+def strip_tones(text):
+    '''
+    Removes pinyin tone marks from latin letters, leaving the dakuten of
+    kana and every other combining mark alone
+    '''
+    result = []
+    base = ''
+    for char in unicodedata.normalize('NFD', text):
+        if not unicodedata.combining(char):
+            base = char
+        elif char in TONE_MARKS and base.isascii():
+            continue
+        result.append(char)
+    return unicodedata.normalize('NFC', ''.join(result))
+
+
+def normalize_text(text):
+    '''
+    Returns the comparable form of a single field value
+    '''
+    text = unicodedata.normalize('NFKC', text).casefold()
+    text = strip_tones(fold_kana(text))
+    return ''.join(
+        char for char in text
+        if not unicodedata.category(char).startswith(('P', 'Z', 'C'))
+    )
+
+
+def content_key(values):
+    '''
+    Returns a hash identifying cards with the same normalized field values,
+    whatever order the fields are in, or None for a blank card
+    '''
+    normalized = sorted(set(
+        value for value in (normalize_text(value) for value in values)
+        if value
+    ))
+    if not normalized:
+        return None
+    content = '\x1f'.join(normalized)
+    return hashlib.sha1(content.encode('utf8')).hexdigest()
@@ -0,0 +1,324 @@
+'''
+Builds deck packs: read-only SQLite files with the cards matching the
+current preferences, their book and lesson, and their scheduling state, so
+a client can study offline.
+
+Every change to a card, its lessons, its votes or its place in the working
+set bumps the card's row in card_versions (see the triggers in db.py), and
+a pack records the version it was built at.  A new pack is made by copying
+the latest pack with the same preferences and re-copying only the cards
+changed since, and clients holding a pack can ask for just those changes.
+All the copying is done by INSERT ... SELECT into the attached pack file,
+so cards never pass through Python.
+
+Packs are named <filters>-<version>.sqlite3, and deltas
+<filters>-<since>-<version>.sqlite3, in a folder next to the database.
+The <filters>-<version> part doubles as the pack's ETag.
+'''
+
+from __future__ import unicode_literals, print_function
+
+import glob
+import hashlib
+import json
+import logging
+import os
+import shutil
+import sqlite3
+import uuid
+
+from . import db
+
+LOG = logging.getLogger(__name__)
+
+# Bumped when PACK_SCHEMA changes, so packs of the old layout aren't reused
+PACK_FORMAT = 2
+
+PACK_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS pack_info (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+
+CREATE TABLE IF NOT EXISTS books (
+    id INTEGER PRIMARY KEY,
+    title TEXT NOT NULL,
+    headers TEXT
+);
+
+CREATE TABLE IF NOT EXISTS lessons (
+    id INTEGER PRIMARY KEY,
+    name TEXT NOT NULL
+);
+
+-- content is a JSON list in the order of the book's headers
+CREATE TABLE IF NOT EXISTS cards (
+    id INTEGER PRIMARY KEY,
+    book_id INTEGER,
+    content TEXT
+);
+
+-- One per direction a card is studied in, id being card id * 8 + direction
+CREATE TABLE IF NOT EXISTS items (
+    id INTEGER PRIMARY KEY,
+    bucket TEXT,
+    vote_count INTEGER NOT NULL,
+    vote_sum INTEGER NOT NULL,
+    last_vote_id INTEGER
+);
+
+CREATE TABLE IF NOT EXISTS card_lessons (
+    card_id INTEGER NOT NULL,
+    lesson_id INTEGER NOT NULL,
+    PRIMARY KEY (card_id, lesson_id)
+) WITHOUT ROWID;
+
+CREATE TABLE IF NOT EXISTS working_set (
+    position INTEGER PRIMARY KEY,
+    card_id INTEGER NOT NULL,
+    item_id INTEGER
+);
+
+-- Only in deltas: cards to drop from the client's pack
+CREATE TABLE IF NOT EXISTS removed (
+    card_id INTEGER PRIMARY KEY
+);
+'''
+
+# Cards of the pack, or of a delta when the changed_since parameter is set
+PACK_CARD_IDS = '''
+    SELECT cards.id FROM main.cards
+    WHERE cards.id IN (''' + db.FILTERED_CARD_IDS + ''')
+    AND (:since IS NULL OR cards.id IN (
+        SELECT card_id FROM main.card_versions WHERE version > :since
+    ))
+'''
+
+COPY_CARDS = '''
+    INSERT OR REPLACE INTO pack.cards (id, book_id, content)
+    SELECT cards.id, cards.book_id, cards.content
+    FROM main.cards
+    WHERE cards.id IN (''' + PACK_CARD_IDS + ''')
+'''
+
+COPY_ITEMS = '''
+    INSERT OR REPLACE INTO pack.items
+    SELECT
+        items.id,
+        items.bucket,
+        IFNULL(summaries.vote_count, 0) +
+            (SELECT COUNT(*) FROM main.votes WHERE votes.item_id == items.id),
+        IFNULL(summaries.vote_sum, 0) + IFNULL(
+            (SELECT SUM(vote) FROM main.votes WHERE votes.item_id == items.id), 0),
+        IFNULL(
+            (SELECT MAX(id) FROM main.votes WHERE votes.item_id == items.id),
+            summaries.last_vote_id)
+    FROM main.items
+    LEFT JOIN main.item_summaries AS summaries
+    ON summaries.item_id == items.id
+    WHERE (items.id >> 3) IN (''' + PACK_CARD_IDS + ''')
+'''
+
+COPY_CARD_LESSONS = '''
+    INSERT OR IGNORE INTO pack.card_lessons (card_id, lesson_id)
+    SELECT relation.card_id, relation.attribute_id
+    FROM main.attributes_cards_relation AS relation
+    INNER JOIN main.attributes ON attributes.id == relation.attribute_id
+    WHERE attributes.name == 'Lesson'
+    AND relation.card_id IN (''' + PACK_CARD_IDS + ''')
+'''
+
+# Cards changed since the pack was built, which get copied again if they
+# still match the preferences
+CHANGED_CARD_IDS = '''
+    SELECT card_id FROM main.card_versions WHERE version > :since
+'''
+
+# Books, lessons and the working set are small, so they are always copied
+# whole
+COPY_SMALL_TABLES = (
+    'DELETE FROM pack.books',
+    '''
+    INSERT INTO pack.books (id, title, headers)
+    SELECT attributes.id, attributes.value, card_schemas.headers
+    FROM main.attributes
+    LEFT JOIN main.card_schemas ON card_schemas.book_id == attributes.id
+    WHERE attributes.id IN (SELECT DISTINCT book_id FROM pack.cards)
+    ''',
+    'DELETE FROM pack.lessons',
+    '''
+    INSERT INTO pack.lessons (id, name)
+    SELECT id, value FROM main.attributes
+    WHERE id IN (SELECT DISTINCT lesson_id FROM pack.card_lessons)
+    ''',
+    'DELETE FROM pack.working_set',
+    '''
+    INSERT INTO pack.working_set (position, card_id, item_id)
+    SELECT id, card_id, item_id FROM main.working_set
+    WHERE card_id IN (SELECT id FROM pack.cards)
+    ''',
+)
+
+
+def get_pack_dir(db_path):
+    ''' Returns the default folder for the packs of a database '''
+    return db_path + '-packs'
+
+
+def get_filters_key(cursor):
+    '''
+    Returns a short hash of the current preferences and pack format, so
+    packs built for other preferences are never reused
+    '''
+    preferences = sorted(db.get_preferences(cursor))
+    content = json.dumps([PACK_FORMAT, preferences], ensure_ascii=False)
+    return hashlib.sha1(content.encode('utf8')).hexdigest()[:12]
+
+
+def get_version(cursor):
+    ''' Returns the version of the most recent change to any card '''
+    cursor.execute('SELECT MAX(version) FROM card_versions')
+    return cursor.fetchone()[0] or 0
+
+
+def parse_token(token):
+    '''
+    Splits a pack token "<filters>-<version>" into its parts, or returns
+    None if it isn't one
+    '''
+    try:
+        (key, version) = token.split('-')
+        return (key, int(version))
+    except (AttributeError, ValueError):
+        return None
+
+
+def find_latest_pack(pack_dir, key, version):
+    '''
+    Returns the (path, version) of the newest full pack for the given
+    filters built at or before version, or None
+    '''
+    latest = None
+    for path in glob.glob(os.path.join(pack_dir, key + '-*.sqlite3')):
+        parsed = parse_token(os.path.basename(path)[:-len('.sqlite3')])
+        if parsed is None or parsed[1] > version:
+            continue
+        if latest is None or parsed[1] > latest[1]:
+            latest = (path, parsed[1])
+    return latest
+
+
+def fill_pack(connection, pack_path, since, version, filters):
+    '''
+    Copies the cards changed since the given version (all of them if since
+    is None) into the pack file, in a single transaction
+    '''
+    connection.execute('ATTACH DATABASE ? AS pack', (pack_path,))
+    try:
+        cursor = connection.cursor()
+        cursor.executescript(PACK_SCHEMA.replace(
+            'CREATE TABLE IF NOT EXISTS ', 'CREATE TABLE IF NOT EXISTS pack.'))
+        parameters = {'since': since}
+        if since is not None:
+            for (table, column) in (
+                    ('cards', 'id'),
+                    ('items', 'id >> 3'),
+                    ('card_lessons', 'card_id')):
+                cursor.execute(
+                    'DELETE FROM pack.%s WHERE %s IN (%s)' % (
+                        table, column, CHANGED_CARD_IDS),
+                    parameters,
+                )
+        cursor.execute(COPY_CARDS, parameters)
+        cursor.execute(COPY_ITEMS, parameters)
+        cursor.execute(COPY_CARD_LESSONS, parameters)
+        for command in COPY_SMALL_TABLES:
+            cursor.execute(command)
+        cursor.executemany(
+            'INSERT OR REPLACE INTO pack.pack_info (key, value) VALUES (?, ?)',
+            [('version', str(version)), ('filters', filters)],
+        )
+        connection.commit()
+    except Exception:
+        connection.rollback()
+        raise
+    finally:
+        connection.execute('DETACH DATABASE pack')
+
+
+def fill_delta(connection, pack_path, since, version, filters):
+    '''
+    Writes just the cards changed since a client's pack into a new pack
+    file, listing the ones it should drop in its removed table
+    '''
+    fill_pack(connection, pack_path, since, version, filters)
+    connection.execute('ATTACH DATABASE ? AS pack', (pack_path,))
+    try:
+        connection.execute('''
+            INSERT OR IGNORE INTO pack.removed (card_id)
+            SELECT card_id FROM main.card_versions
+            WHERE version > ? AND card_id NOT IN (SELECT id FROM pack.cards)
+        ''', (since,))
+        connection.commit()
+    finally:
+        connection.execute('DETACH DATABASE pack')
+
+
+def build_pack(db_path, pack_dir=None, since=None):
+    '''
+    Returns the (path, token) of the pack for the current preferences,
+    building it if it doesn't exist yet.  If since is the token of a pack
+    the client already has, returns a delta from it instead.
+    '''
+    pack_dir = pack_dir or get_pack_dir(db_path)
+    if not os.path.isdir(pack_dir):
+        os.makedirs(pack_dir)
+
+    connection = sqlite3.connect(db_path)
+    try:
+        cursor = connection.cursor()
+        key = get_filters_key(cursor)
+        version = get_version(cursor)
+        token = '%s-%d' % (key, version)
+        filters = json.dumps(db.get_preferences(cursor), ensure_ascii=False)
+
+        parsed = parse_token(since)
+        if parsed is not None and parsed[0] == key and parsed[1] <= version:
+            name = '%s-%d-%d.sqlite3' % (key, parsed[1], version)
+            path = os.path.join(pack_dir, name)
+            if not os.path.exists(path):
+                temporary = '%s.%s' % (path, uuid.uuid4().hex)
+                fill_delta(connection, temporary, parsed[1], version, filters)
+                os.replace(temporary, path)
+            return (path, token)
+
+        path = os.path.join(pack_dir, token + '.sqlite3')
+        if os.path.exists(path):
+            return (path, token)
+
+        temporary = '%s.%s' % (path, uuid.uuid4().hex)
+        latest = find_latest_pack(pack_dir, key, version)
+        if latest is None:
+            LOG.info("Building pack %s", token)
+            fill_pack(connection, temporary, None, version, filters)
+        else:
+            LOG.info("Updating pack %s-%d to %d", key, latest[1], version)
+            shutil.copyfile(latest[0], temporary)
+            fill_pack(connection, temporary, latest[1], version, filters)
+        os.replace(temporary, path)
+    finally:
+        connection.close()
+
+    remove_old_packs(pack_dir, key, version)
+    return (path, token)
+
+
+def remove_old_packs(pack_dir, key, version):
+    '''
+    Deletes the packs and deltas of the given filters older than version.
+    Downloads already in progress keep their open file.
+    '''
+    for path in glob.glob(os.path.join(pack_dir, key + '-*.sqlite3')):
+        parts = os.path.basename(path)[:-len('.sqlite3')].split('-')
+        if int(parts[-1]) < version:
+            os.remove(path)
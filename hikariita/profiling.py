@@ -0,0 +1,247 @@
+'''
+Opt-in profiling of single requests.
+
+With PROFILING enabled in the app config, a request carrying the admin
+PROFILE_TOKEN in an X-Profile header (or a ?profile= query parameter) is
+run under cProfile while a sampling thread records its call stacks.  Every
+SQL statement executed through the request's database connection is timed
+as well.  When the request finishes we write to PROFILE_DIR:
+
+* <name>.pstats, loadable with the pstats module or snakeviz
+* <name>.collapsed, collapsed stacks for flamegraph.pl / speedscope
+* <name>.json, time per db.py function and per SQL statement
+'''
+
+from __future__ import unicode_literals, print_function
+
+import cProfile
+import collections
+import hmac
+import io
+import json
+import os
+import pstats
+import re
+import sqlite3
+import sys
+import threading
+import time
+
+
+HEADER = 'X-Profile'
+QUERY_PARAMETER = 'profile'
+
+DB_MODULE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'db.py')
+
+WHITESPACE = re.compile(r'\s+')
+
+
+def is_requested(config, request):
+    '''
+    Returns whether this request asked to be profiled with a valid token.
+
+    Profiling is off unless PROFILING is set and a PROFILE_TOKEN is
+    configured, so nobody but an admin can trigger it.
+    '''
+    return config.get('PROFILING') and is_admin(config, request)
+
+
+def is_admin(config, request):
+    '''
+    Returns whether the request carries the configured admin token
+    '''
+    expected = config.get('PROFILE_TOKEN')
+    if not expected:
+        return False
+    given = request.headers.get(HEADER) or \
+        request.args.get(QUERY_PARAMETER) or ''
+    return hmac.compare_digest(given.encode('utf8'), expected.encode('utf8'))
+
+
+def get_profile_dir(config):
+    '''
+    Returns the directory profiles are written to, creating it if needed
+    '''
+    profile_dir = config.get('PROFILE_DIR', 'profiles')
+    if not os.path.isdir(profile_dir):
+        os.makedirs(profile_dir)
+    return profile_dir
+
+
+class ProfiledCursor(sqlite3.Cursor):
+    '''
+    Cursor that reports how long each statement took to its profiler
+    '''
+
+    def execute(self, sql, parameters=()):
+        start = time.time()
+        try:
+            return sqlite3.Cursor.execute(self, sql, parameters)
+        finally:
+            self.connection.profiler.record_sql(sql, time.time() - start)
+
+    def executemany(self, sql, parameters):
+        start = time.time()
+        try:
+            return sqlite3.Cursor.executemany(self, sql, parameters)
+        finally:
+            self.connection.profiler.record_sql(sql, time.time() - start)
+
+    def executescript(self, sql_script):
+        start = time.time()
+        try:
+            return sqlite3.Cursor.executescript(self, sql_script)
+        finally:
+            self.connection.profiler.record_sql(sql_script, time.time() - start)
+
+
+class ProfiledConnection(sqlite3.Connection):
+    '''
+    Connection whose cursors are timed, pass as sqlite3.connect's factory
+    and then set the profiler attribute
+    '''
+
+    profiler = None
+
+    def cursor(self, factory=ProfiledCursor):
+        return sqlite3.Connection.cursor(self, factory)
+
+
+class StackSampler(threading.Thread):
+    '''
+    Periodically samples the call stack of one thread and counts each
+    distinct stack, for a collapsed-stack flamegraph
+    '''
+
+    def __init__(self, thread_id, interval=0.001):
+        threading.Thread.__init__(self, name='profile-sampler')
+        self.daemon = True
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = collections.Counter()
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append('%s (%s:%d)' % (
+                    code.co_name,
+                    os.path.basename(code.co_filename),
+                    code.co_firstlineno,
+                ))
+                frame = frame.f_back
+            if stack:
+                self.stacks[';'.join(reversed(stack))] += 1
+
+    def stop(self):
+        ''' Stops sampling and waits for the thread to exit '''
+        self.stopped.set()
+        self.join()
+
+
+class RequestProfiler(object):
+    '''
+    Profiles everything the current thread does between start and stop
+    '''
+
+    def __init__(self, interval=0.001):
+        self.profile = cProfile.Profile()
+        self.sampler = StackSampler(threading.current_thread().ident, interval)
+        self.sql = {}
+        self.started = None
+        self.elapsed = None
+
+    def start(self):
+        ''' Starts both the deterministic and the sampling profilers '''
+        self.started = time.time()
+        self.sampler.start()
+        self.profile.enable()
+
+    def stop(self):
+        ''' Stops profiling, safe to call more than once '''
+        if self.elapsed is not None:
+            return
+        self.profile.disable()
+        self.sampler.stop()
+        self.elapsed = time.time() - self.started
+
+    def record_sql(self, sql, elapsed):
+        ''' Adds the time spent on one execution of a statement '''
+        statement = WHITESPACE.sub(' ', sql).strip()
+        (count, total) = self.sql.get(statement, (0, 0.0))
+        self.sql[statement] = (count + 1, total + elapsed)
+
+    def db_functions(self):
+        '''
+        Returns calls and cumulative seconds for each db.py function
+        '''
+        stats = pstats.Stats(self.profile, stream=io.StringIO()).stats
+        result = {}
+        for ((filename, _, name), row) in stats.items():
+            if os.path.abspath(filename) == DB_MODULE:
+                (_, calls, _, cumulative, _) = row
+                result[name] = {'calls': calls, 'seconds': cumulative}
+        return result
+
+    def summary(self, path):
+        ''' Returns the JSON-friendly summary saved next to the profile '''
+        sql = [
+            {'sql': statement, 'calls': count, 'seconds': total}
+            for (statement, (count, total)) in self.sql.items()
+        ]
+        sql.sort(key=lambda entry: entry['seconds'], reverse=True)
+        return {
+            'path': path,
+            'started': self.started,
+            'seconds': self.elapsed,
+            'db_functions': self.db_functions(),
+            'sql': sql,
+        }
+
+    def save(self, profile_dir, path, endpoint):
+        '''
+        Writes the pstats, collapsed-stack and summary files and returns
+        the name they share
+        '''
+        self.stop()
+        stamp = time.strftime('%Y%m%dT%H%M%S', time.gmtime(self.started))
+        name = '%s%06d-%s' % (
+            stamp,
+            int(self.started % 1 * 1000000),
+            endpoint or 'none',
+        )
+        base = os.path.join(profile_dir, name)
+
+        self.profile.dump_stats(base + '.pstats')
+        with io.open(base + '.collapsed', 'w', encoding='utf8') as handle:
+            for (stack, count) in self.sampler.stacks.most_common():
+                handle.write('%s %d\n' % (stack, count))
+        with io.open(base + '.json', 'w', encoding='utf8') as handle:
+            handle.write(json.dumps(self.summary(path), indent=2))
+        return name
+
+
+def list_profiles(profile_dir):
+    '''
+    Returns the saved profiles, newest first, without their SQL details
+    '''
+    if not os.path.isdir(profile_dir):
+        return []
+    result = []
+    for filename in sorted(os.listdir(profile_dir), reverse=True):
+        if not filename.endswith('.json'):
+            continue
+        with io.open(os.path.join(profile_dir, filename), encoding='utf8') as handle:
+            summary = json.load(handle)
+        name = filename[:-len('.json')]
+        result.append({
+            'name': name,
+            'path': summary['path'],
+            'started': summary['started'],
+            'seconds': summary['seconds'],
+            'files': [name + '.pstats', name + '.collapsed', filename],
+        })
+    return result
@@ -0,0 +1,147 @@
+'''
+Keeps the working set topped up from a background thread.
+
+Votes only remove or requeue a card and then notify the replenisher of
+their database, so the person studying doesn't wait for the scheduler
+queries.  Notifications are debounced, so a burst of votes is covered by
+a single refill.  The request path only refills synchronously when the
+working set ran completely dry, and counts each time it had to.
+'''
+
+from __future__ import unicode_literals, print_function
+
+import logging
+import sqlite3
+import threading
+
+from . import db
+
+LOG = logging.getLogger(__name__)
+
+
+METRICS_LOCK = threading.Lock()
+METRICS = {
+    'notifications': 0,
+    'background_refills': 0,
+    'background_cards': 0,
+    'background_errors': 0,
+    'sync_refills': 0,
+}
+
+REPLENISHERS_LOCK = threading.Lock()
+REPLENISHERS = {}
+
+
+def count(metric, amount=1):
+    ''' Adds to one of the replenishment metrics '''
+    with METRICS_LOCK:
+        METRICS[metric] += amount
+
+
+def get_metrics():
+    ''' Returns a copy of the replenishment metrics '''
+    with METRICS_LOCK:
+        return dict(METRICS)
+
+
+class Replenisher(threading.Thread):
+    '''
+    Background thread refilling the working set of one database
+    '''
+
+    def __init__(self, db_path, debounce=0.05, max_delay=0.5):
+        threading.Thread.__init__(self, name='replenisher')
+        self.daemon = True
+        self.db_path = db_path
+        self.debounce = debounce
+        self.max_delay = max_delay
+        self.pending = threading.Event()
+        self.idle = threading.Event()
+        self.idle.set()
+        self.stopped = False
+
+    def notify(self):
+        ''' Asks for a refill soon '''
+        count('notifications')
+        self.idle.clear()
+        self.pending.set()
+
+    def stop(self):
+        ''' Stops the thread after any refill in progress '''
+        self.stopped = True
+        self.pending.set()
+        self.join()
+
+    def wait_idle(self, timeout=None):
+        ''' Blocks until every notification so far has been handled '''
+        return self.idle.wait(timeout)
+
+    def run(self):
+        connection = sqlite3.connect(self.db_path)
+        try:
+            while not self.stopped:
+                self.pending.wait()
+                self.settle()
+                if self.stopped:
+                    break
+                self.refill(connection)
+                if not self.pending.is_set():
+                    self.idle.set()
+        finally:
+            connection.close()
+            self.idle.set()
+
+    def settle(self):
+        '''
+        Waits until notifications stop arriving for `debounce` seconds, but
+        no longer than `max_delay` in total
+        '''
+        waited = 0.0
+        while waited < self.max_delay:
+            self.pending.clear()
+            if not self.pending.wait(self.debounce) or self.stopped:
+                return
+            waited += self.debounce
+        self.pending.clear()
+
+    def refill(self, connection):
+        ''' Tops up the working set in its own short transaction '''
+        cursor = connection.cursor()
+        try:
+            added = db.init_working_set(cursor)
+            connection.commit()
+            count('background_refills')
+            count('background_cards', added)
+        except sqlite3.OperationalError as error:
+            # Most likely the database was locked, try again on the next vote
+            connection.rollback()
+            count('background_errors')
+            LOG.warning("Background refill failed: %s", error)
+        finally:
+            cursor.close()
+
+
+def get_replenisher(db_path):
+    '''
+    Returns the running replenisher for the given database, starting one
+    the first time it's asked for
+    '''
+    with REPLENISHERS_LOCK:
+        replenisher = REPLENISHERS.get(db_path)
+        if replenisher is None or not replenisher.is_alive():
+            replenisher = Replenisher(db_path)
+            replenisher.start()
+            REPLENISHERS[db_path] = replenisher
+        return replenisher
+
+
+def refill_if_empty(cursor):
+    '''
+    Refills the working set right away if there is no next card to show,
+    which means the background refill fell behind.  Returns whether it did.
+    '''
+    if db.get_working_set_size(cursor) > 0:
+        return False
+    count('sync_refills')
+    db.init_working_set(cursor)
+    return True
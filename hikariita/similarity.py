@@ -0,0 +1,165 @@
+# -*- coding: utf-8 -*-
+
+'''
+Finds the cards most easily confused with each other, so the scheduler can
+deliberately study them side by side.
+
+Each card is broken into features of its normalized fields (see
+normalize.py): every non-latin character it uses, so cards sharing a kanji
+or kana match, and the character bigrams of each field, so readings that
+only differ by a tone or a letter match too.  Features shared by fewer
+cards count for more.  Cards are only ever compared with the cards in the
+posting lists of their own features, never with the whole deck, and the
+best `k` of them are kept as the card's neighbours.
+
+This module only does the computation; db.py stores the features and
+neighbour lists and keeps them up to date.
+'''
+
+from __future__ import unicode_literals, print_function
+
+import collections
+import concurrent.futures
+import math
+
+from .normalize import normalize_text
+
+
+# Neighbours kept per card
+DEFAULT_NEIGHBOURS = 10
+
+# Features in more cards than this (like the bigrams of common English
+# words) hardly tell cards apart but would make most of the deck a
+# candidate, so they are ignored when looking for neighbours
+MAX_POSTINGS = 100
+
+# Decks smaller than this aren't worth starting processes for
+PARALLEL_THRESHOLD = 2000
+
+# Set in each worker process by init_worker
+WORKER_INDEX = None
+
+
+def card_features(values):
+    '''
+    Returns the set of features of a card with the given field values
+    '''
+    features = set()
+    for value in values:
+        text = normalize_text(value)
+        if not text:
+            continue
+        for char in text:
+            if not char.isascii():
+                features.add('c:' + char)
+        padded = '^' + text + '$'
+        for i in range(len(padded) - 1):
+            features.add('b:' + padded[i:i + 2])
+    return features
+
+
+class Index(object):
+    '''
+    Inverted index from feature to the cards having it, with what's needed
+    to score a pair of cards
+    '''
+
+    def __init__(self, postings, sizes, total):
+        # feature -> list of card ids
+        self.postings = postings
+        # card id -> number of features
+        self.sizes = sizes
+        self.total = total
+        self.weights = {}
+
+    @classmethod
+    def build(cls, features_by_card):
+        ''' Indexes a {card_id: features} dictionary '''
+        postings = collections.defaultdict(list)
+        for (card_id, features) in features_by_card.items():
+            for feature in features:
+                postings[feature].append(card_id)
+        sizes = dict(
+            (card_id, len(features))
+            for (card_id, features) in features_by_card.items()
+        )
+        return cls(dict(postings), sizes, len(features_by_card))
+
+    def weight(self, feature):
+        ''' Inverse document frequency of a feature '''
+        weight = self.weights.get(feature)
+        if weight is None:
+            weight = math.log(1.0 + self.total / float(len(self.postings[feature])))
+            self.weights[feature] = weight
+        return weight
+
+    def neighbours(self, card_id, features, k=DEFAULT_NEIGHBOURS):
+        '''
+        Returns the best k (neighbour_id, score) pairs for a card, best
+        first, looking only at cards sharing one of its features.  Features
+        missing from the postings were left out for being too frequent.
+        '''
+        scores = collections.defaultdict(float)
+        for feature in features:
+            posting = self.postings.get(feature, ())
+            if not posting or len(posting) > MAX_POSTINGS:
+                continue
+            weight = self.weight(feature)
+            for other_id in posting:
+                if other_id != card_id:
+                    scores[other_id] += weight
+
+        size = len(features)
+        ranked = [
+            (other_id, score / math.sqrt(size * self.sizes[other_id]))
+            for (other_id, score) in scores.items()
+        ]
+        ranked.sort(key=lambda pair: (-pair[1], pair[0]))
+        return ranked[:k]
+
+
+def init_worker(features_by_card):
+    ''' Builds the index once in each worker process '''
+    global WORKER_INDEX
+    WORKER_INDEX = (Index.build(features_by_card), features_by_card)
+
+
+def neighbours_of_chunk(card_ids, k):
+    ''' Ranks the neighbours of some cards inside a worker process '''
+    (index, features_by_card) = WORKER_INDEX
+    return [
+        (card_id, index.neighbours(card_id, features_by_card[card_id], k))
+        for card_id in card_ids
+    ]
+
+
+def compute_neighbours(features_by_card, k=DEFAULT_NEIGHBOURS, processes=None,
+                       chunk_size=500):
+    '''
+    Returns {card_id: [(neighbour_id, score), ...]} for every card of a
+    {card_id: features} dictionary.  Large decks are split across a pool of
+    processes, each building its own copy of the index.
+    '''
+    card_ids = sorted(features_by_card)
+    if processes == 1 or len(card_ids) < PARALLEL_THRESHOLD:
+        index = Index.build(features_by_card)
+        return dict(
+            (card_id, index.neighbours(card_id, features_by_card[card_id], k))
+            for card_id in card_ids
+        )
+
+    chunks = [
+        card_ids[i:i + chunk_size]
+        for i in range(0, len(card_ids), chunk_size)
+    ]
+    result = {}
+    with concurrent.futures.ProcessPoolExecutor(
+            max_workers=processes,
+            initializer=init_worker,
+            initargs=(features_by_card,)) as executor:
+        futures = [
+            executor.submit(neighbours_of_chunk, chunk, k) for chunk in chunks
+        ]
+        for future in futures:
+            result.update(future.result())
+    return result
@@ -0,0 +1,575 @@
+'''
+Offline simulator of the scheduler, to compare policies before changing
+init_working_set, calculate_state_of_card or the deck settings.
+
+    python -m hikariita.simulator --database example.db --days 90 \\
+        --reviews-per-day 200 --policy easy_ratio=0.1 \\
+        --policy working_set_size=15
+
+A snapshot of the deck and its vote history is loaded once into flat
+arrays indexed by item, a card studied in one direction, which is what
+db.py schedules.  Items of a card are simulated independently, although
+db.py never has two of them in the working set at once.  Each policy then
+studies its own copy for the given number of days: the next card is the
+front of the working set queue, the learner answers with the card's next
+recorded vote while there are any left, and after that according to a
+forgetting curve fitted to the card's history.  Votes move cards between
+buckets and refill the working set the way db.py does, while counting the
+statements db.py would have run.
+
+By default the simulation carries on from the state of the snapshot.  With
+--from-scratch every card starts out new, and the recorded history is
+replayed under each policy before the model takes over.
+
+Policies are independent, so they run in parallel across processes.
+'''
+
+from __future__ import unicode_literals, print_function
+
+import argparse
+import array
+import collections
+import concurrent.futures
+import heapq
+import math
+import random
+import sqlite3
+import time
+from urllib.request import pathname2url
+
+from . import db
+
+
+# Bucket codes, NONE being the NULL bucket of cards with too few votes
+GENESIS, EASY, OKAY, HARD, NONE = range(5)
+BUCKETS = {'genesis': GENESIS, 'easy': EASY, 'okay': OKAY, 'hard': HARD, None: NONE}
+BUCKET_NAMES = dict((code, name) for (name, code) in BUCKETS.items())
+
+# Statements db.py runs for each step of studying, to estimate database load
+QUERIES = {
+    'next_card': 1,       # get_next_card
+    'vote': 3,            # create_vote's insert, bucket update and eviction
+    'requeue': 2,         # calculate_state_of_card and requeuing if not easy
+    'refill_check': 2,    # get_deck_settings, get_working_set_size
+    'draw': 1,            # each draw_from_* that runs
+    'introduce': 3,       # draw_new_items' queue lookup, draw and advance
+}
+
+# Forgetting curve of the modelled learner, in days
+DAY = 24 * 60 * 60
+SECONDS_PER_REVIEW = 10
+MIN_STABILITY = 0.1
+STABILITY_GROWTH = {1: 2.5, 0: 1.2, -1: 0.5}
+
+Policy = collections.namedtuple(
+    'Policy', ['name', 'working_set_size', 'easy_ratio', 'min_votes',
+               'new_cards_per_day'])
+
+CURRENT_POLICY = Policy(
+    name='current',
+    working_set_size=db.DEFAULT_WORKING_SET_SIZE,
+    easy_ratio=db.DEFAULT_EASY_RATIO,
+    min_votes=3,
+    new_cards_per_day=db.DEFAULT_NEW_CARDS_PER_DAY,
+)
+
+
+def parse_policy(spec):
+    '''
+    Turns "working_set_size=15,easy_ratio=0.1" into a Policy that changes
+    just those settings of the current one
+    '''
+    changes = {'name': spec}
+    for assignment in spec.split(','):
+        if assignment == 'current':
+            continue
+        (key, value) = assignment.split('=')
+        if key not in Policy._fields or key == 'name':
+            raise ValueError('Unknown policy setting: ' + key)
+        changes[key] = float(value) if key == 'easy_ratio' else int(value)
+    return CURRENT_POLICY._replace(**changes)
+
+
+class Snapshot(object):
+    '''
+    The deck and vote history of one database, as arrays indexed by item
+    '''
+
+    def __init__(self, item_ids):
+        size = len(item_ids)
+        self.item_ids = array.array('q', item_ids)
+        self.buckets = array.array('b', [GENESIS] * size)
+        self.vote_counts = array.array('l', [0] * size)
+        self.vote_sums = array.array('l', [0] * size)
+        # Order of the last vote, like votes.id, and its time in seconds
+        self.last_votes = array.array('q', [-1] * size)
+        self.last_times = array.array('d', [float('nan')] * size)
+        # Every card's recorded votes, oldest first, in one flat array
+        self.history_starts = array.array('l', [0] * (size + 1))
+        self.history = array.array('b')
+        self.working_set = []
+        self.last_vote = 0
+        self.now = time.time()
+
+    def __len__(self):
+        return len(self.item_ids)
+
+
+def load_snapshot(db_path, all_cards=False):
+    '''
+    Loads the items of the cards matching the preferences (or of every
+    card, if there are none or all_cards is set) and their votes, read-only
+    '''
+    uri = 'file:%s?mode=ro' % pathname2url(db_path)
+    connection = sqlite3.connect(uri, uri=True)
+    cursor = connection.cursor()
+    try:
+        cursor.execute('SELECT COUNT(*) FROM preferences')
+        if all_cards or not cursor.fetchone()[0]:
+            cursor.execute('SELECT id, bucket FROM items ORDER BY id')
+        else:
+            cursor.execute(
+                'SELECT id, bucket FROM items WHERE (id >> 3) IN (' +
+                db.FILTERED_CARD_IDS + ') ORDER BY id')
+        rows = cursor.fetchall()
+        snapshot = Snapshot([item_id for (item_id, _) in rows])
+        index = dict((item_id, i) for (i, item_id) in enumerate(snapshot.item_ids))
+        for (i, (_, bucket)) in enumerate(rows):
+            snapshot.buckets[i] = BUCKETS.get(bucket, NONE)
+
+        cursor.execute('''
+            SELECT item_id, vote_count, vote_sum, last_vote_id
+            FROM item_summaries
+        ''')
+        for (item_id, vote_count, vote_sum, last_vote_id) in cursor.fetchall():
+            i = index.get(item_id)
+            if i is not None:
+                snapshot.vote_counts[i] += vote_count
+                snapshot.vote_sums[i] += vote_sum
+                snapshot.last_votes[i] = max(snapshot.last_votes[i], last_vote_id or 0)
+
+        histories = [[] for _ in rows]
+        cursor.execute('SELECT id, item_id, vote, created FROM votes ORDER BY id')
+        for (vote_id, item_id, vote, created) in cursor.fetchall():
+            snapshot.last_vote = max(snapshot.last_vote, vote_id)
+            i = index.get(item_id)
+            if i is None:
+                continue
+            histories[i].append(vote)
+            snapshot.vote_counts[i] += 1
+            snapshot.vote_sums[i] += vote
+            snapshot.last_votes[i] = vote_id
+            if created is not None:
+                snapshot.last_times[i] = created
+        for (i, votes) in enumerate(histories):
+            snapshot.history.extend(votes)
+            snapshot.history_starts[i + 1] = len(snapshot.history)
+
+        cursor.execute('SELECT item_id FROM working_set ORDER BY id')
+        snapshot.working_set = [
+            index[item_id] for (item_id,) in cursor.fetchall() if item_id in index
+        ]
+        cursor.execute('SELECT MAX(created) FROM votes')
+        snapshot.now = cursor.fetchone()[0] or snapshot.now
+    finally:
+        connection.close()
+    return snapshot
+
+
+class OrderedPool(object):
+    '''
+    Set of card indexes handed out lowest first, the way the introduction
+    queue hands out new items.  Lessons aren't in the snapshot, so this is
+    import order.
+    '''
+
+    def __init__(self):
+        self.heap = []
+        self.members = set()
+
+    def __len__(self):
+        return len(self.members)
+
+    def add(self, item):
+        if item not in self.members:
+            self.members.add(item)
+            heapq.heappush(self.heap, item)
+
+    def discard(self, item):
+        # Left in the heap, and skipped when it comes up
+        self.members.discard(item)
+
+    def take(self, rng):
+        ''' Removes and returns the lowest item '''
+        del rng
+        while True:
+            item = heapq.heappop(self.heap)
+            if item in self.members:
+                self.members.remove(item)
+                return item
+
+
+class IndexedPool(object):
+    '''
+    Set of card indexes with constant time add, remove and random choice
+    '''
+
+    def __init__(self):
+        self.items = []
+        self.positions = {}
+
+    def __len__(self):
+        return len(self.items)
+
+    def add(self, item):
+        if item not in self.positions:
+            self.positions[item] = len(self.items)
+            self.items.append(item)
+
+    def discard(self, item):
+        position = self.positions.pop(item, None)
+        if position is None:
+            return
+        last = self.items.pop()
+        if last != item:
+            self.items[position] = last
+            self.positions[last] = position
+
+    def take(self, rng):
+        ''' Removes and returns a random item '''
+        item = self.items[rng.randrange(len(self.items))]
+        self.discard(item)
+        return item
+
+
+class Simulation(object):
+    '''
+    One policy studying its own copy of a snapshot
+    '''
+
+    def __init__(self, snapshot, policy, seed=None, from_scratch=False):
+        self.policy = policy
+        self.rng = random.Random(seed)
+        size = len(snapshot)
+        self.buckets = array.array('b', snapshot.buckets)
+        self.vote_counts = array.array('l', snapshot.vote_counts)
+        self.vote_sums = array.array('l', snapshot.vote_sums)
+        self.last_votes = array.array('q', snapshot.last_votes)
+        self.history = snapshot.history
+        self.history_ends = snapshot.history_starts[1:]
+        self.next_vote = 0
+        self.now = 0.0
+        self.queries = collections.Counter()
+        self.answers = collections.Counter()
+        self.introduced = 0
+        self.introduced_today = 0
+
+        # Forgetting curve: recall after a day matches the card's history
+        self.stabilities = array.array('d', [0.0] * size)
+        self.last_times = array.array('d', [float('-inf')] * size)
+        for i in range(size):
+            start = snapshot.history_starts[i]
+            votes = snapshot.history[start:self.history_ends[i]]
+            good = sum(1 for vote in votes if vote == 1)
+            recall = min(max((good + 1.0) / (len(votes) + 2.0), 0.05), 0.95)
+            self.stabilities[i] = -1.0 / math.log(recall)
+            if not math.isnan(snapshot.last_times[i]):
+                self.last_times[i] = (snapshot.last_times[i] - snapshot.now) / DAY
+            elif snapshot.last_votes[i] >= 0:
+                self.last_times[i] = -30.0
+
+        if from_scratch:
+            # Everything is new, and the recorded votes get replayed
+            self.buckets = array.array('b', [GENESIS] * size)
+            self.vote_counts = array.array('l', [0] * size)
+            self.vote_sums = array.array('l', [0] * size)
+            self.last_votes = array.array('q', [-1] * size)
+            self.last_times = array.array('d', [float('-inf')] * size)
+            self.replay = array.array('l', snapshot.history_starts[:-1])
+            self.working_set = collections.deque()
+        else:
+            self.next_vote = snapshot.last_vote
+            self.replay = array.array('l', self.history_ends)
+            self.working_set = collections.deque(snapshot.working_set)
+        self.in_working_set = set(self.working_set)
+
+        self.pools = {GENESIS: OrderedPool(), EASY: IndexedPool()}
+        self.seen = []
+        for i in range(size):
+            self.place(i)
+
+    def place(self, i):
+        ''' Makes a card outside the working set drawable again '''
+        if i in self.in_working_set:
+            return
+        pool = self.pools.get(self.buckets[i])
+        if pool is not None:
+            pool.add(i)
+        if self.last_votes[i] >= 0:
+            heapq.heappush(self.seen, (self.last_votes[i], i))
+
+    def enqueue(self, i):
+        ''' Adds a card to the back of the working set '''
+        for pool in self.pools.values():
+            pool.discard(i)
+        self.working_set.append(i)
+        self.in_working_set.add(i)
+
+    def take(self, bucket, limit):
+        ''' Moves up to limit cards of a bucket's pool to the working set '''
+        pool = self.pools[bucket]
+        added = 0
+        while added < limit and pool:
+            self.enqueue(pool.take(self.rng))
+            added += 1
+        return added
+
+    def draw_from_bucket(self, bucket, limit):
+        ''' Like db.draw_from_bucket '''
+        self.queries['draw'] += QUERIES['draw']
+        return self.take(bucket, limit)
+
+    def draw_new_items(self, limit):
+        ''' Like db.draw_new_items '''
+        self.queries['introduce'] += QUERIES['introduce']
+        limit = min(limit, self.policy.new_cards_per_day - self.introduced_today)
+        if limit <= 0:
+            return 0
+        added = self.take(GENESIS, limit)
+        self.introduced += added
+        self.introduced_today += added
+        return added
+
+    def draw_from_least_recently_seen(self, limit):
+        ''' Like db.draw_from_least_recently_seen '''
+        self.queries['draw'] += QUERIES['draw']
+        added = 0
+        while added < limit and self.seen:
+            (last_vote, i) = heapq.heappop(self.seen)
+            # Skip entries left behind by later votes or the working set
+            if last_vote != self.last_votes[i] or i in self.in_working_set:
+                continue
+            self.enqueue(i)
+            added += 1
+        return added
+
+    def refill(self):
+        ''' Like db.init_working_set, without the confusable draws '''
+        self.queries['refill_check'] += QUERIES['refill_check']
+        missing = self.policy.working_set_size - len(self.working_set)
+        if missing <= 0:
+            return
+        added = self.draw_new_items(missing)
+        easy = int(min(
+            missing - added,
+            (missing - added) * self.policy.easy_ratio + self.rng.random(),
+        ))
+        if easy > 0:
+            added += self.draw_from_bucket(EASY, easy)
+        if added < missing:
+            self.draw_from_least_recently_seen(missing - added)
+
+    def recall_probability(self, i):
+        ''' Chance the learner remembers a card right now '''
+        elapsed = self.now - self.last_times[i]
+        return math.exp(-elapsed / self.stabilities[i])
+
+    def answer(self, i):
+        '''
+        The learner's vote on a card: the next recorded one if there is any
+        left, otherwise drawn from the forgetting curve
+        '''
+        if self.replay[i] < self.history_ends[i]:
+            vote = self.history[self.replay[i]]
+            self.replay[i] += 1
+            return vote
+        recall = self.recall_probability(i)
+        roll = self.rng.random()
+        if roll < recall:
+            return 1
+        return 0 if roll < recall + (1 - recall) / 2 else -1
+
+    def state(self, i):
+        ''' Like db.calculate_state_of_card '''
+        if self.vote_counts[i] < self.policy.min_votes:
+            return None
+        average = float(self.vote_sums[i]) / self.vote_counts[i]
+        if average < 0:
+            return HARD
+        return OKAY if average < 1 else EASY
+
+    def review(self):
+        ''' Shows the next card and votes on it, like the vote route '''
+        self.queries['next_card'] += QUERIES['next_card']
+        if not self.working_set:
+            self.refill()
+            if not self.working_set:
+                return False
+        i = self.working_set.popleft()
+        self.in_working_set.discard(i)
+
+        vote = self.answer(i)
+        self.answers[vote] += 1
+        self.queries['vote'] += QUERIES['vote']
+        if vote != 1:
+            self.queries['requeue'] += QUERIES['requeue']
+        self.next_vote += 1
+        self.vote_counts[i] += 1
+        self.vote_sums[i] += vote
+        self.last_votes[i] = self.next_vote
+        elapsed = self.now - self.last_times[i]
+        self.last_times[i] = self.now
+        if elapsed != float('inf'):
+            self.stabilities[i] = max(
+                MIN_STABILITY, self.stabilities[i] * STABILITY_GROWTH[vote])
+
+        # The bucket is left alone while the state is unknown, since
+        # "bucket != NULL" never matches in SQL
+        bucket = EASY if vote == 1 else self.state(i)
+        if bucket is not None:
+            self.buckets[i] = bucket
+        if vote == 1:
+            self.place(i)
+        else:
+            self.enqueue(i)
+        self.refill()
+        return True
+
+    def run(self, days, reviews_per_day):
+        ''' Studies every day and returns the report of this policy '''
+        started = time.time()
+        reviews = 0
+        daily = []
+        for day in range(days):
+            self.now = float(day)
+            self.introduced_today = 0
+            done = 0
+            while done < reviews_per_day and self.review():
+                done += 1
+                self.now += SECONDS_PER_REVIEW / float(DAY)
+            reviews += done
+            daily.append(done)
+        self.now = float(days)
+        return self.report(reviews, daily, time.time() - started)
+
+    def report(self, reviews, daily, seconds):
+        ''' Review load, retention proxies and query counts '''
+        recalls = [
+            self.recall_probability(i)
+            for i in range(len(self.buckets))
+            if self.last_times[i] != float('-inf')
+        ]
+        buckets = collections.Counter(
+            BUCKET_NAMES[bucket] for bucket in self.buckets)
+        queries = sum(self.queries.values())
+        return {
+            'policy': self.policy._asdict(),
+            'reviews': reviews,
+            'peak_reviews_per_day': max(daily) if daily else 0,
+            'introduced': self.introduced,
+            'studied': len(recalls),
+            'success_rate': float(self.answers[1]) / reviews if reviews else None,
+            'retention': sum(recalls) / len(recalls) if recalls else None,
+            'forgotten': sum(1 for recall in recalls if recall < 0.5),
+            'buckets': dict(buckets),
+            'queries': dict(self.queries),
+            'queries_per_review': float(queries) / reviews if reviews else None,
+            'seconds': seconds,
+        }
+
+
+def simulate(snapshot, policy, days=30, reviews_per_day=100, seed=None,
+             from_scratch=False):
+    ''' Runs one policy over a snapshot and returns its report '''
+    simulation = Simulation(snapshot, policy, seed, from_scratch)
+    return simulation.run(days, reviews_per_day)
+
+
+def simulate_arguments(arguments):
+    ''' simulate() for executor.map, which passes a single argument '''
+    return simulate(*arguments)
+
+
+def run_policies(snapshot, policies, days=30, reviews_per_day=100, seed=None,
+                 from_scratch=False, processes=None):
+    '''
+    Simulates each policy with the same learner and returns their reports,
+    in parallel unless processes is 1
+    '''
+    if seed is None:
+        seed = random.randrange(2 ** 32)
+    arguments = [
+        (snapshot, policy, days, reviews_per_day, seed, from_scratch)
+        for policy in policies
+    ]
+    if processes == 1 or len(policies) == 1:
+        return [simulate_arguments(argument) for argument in arguments]
+    with concurrent.futures.ProcessPoolExecutor(max_workers=processes) as executor:
+        return list(executor.map(simulate_arguments, arguments))
+
+
+def print_report(reports):
+    ''' Prints the reports of run_policies side by side '''
+    print("%-40s %8s %8s %8s %8s %9s %9s %8s" % (
+        'policy', 'reviews', 'new', 'studied', 'success', 'retention',
+        'forgotten', 'q/review'))
+    for report in reports:
+        print("%-40s %8d %8d %8d %8s %9s %9d %8s" % (
+            report['policy']['name'][:40],
+            report['reviews'],
+            report['introduced'],
+            report['studied'],
+            '%.2f' % report['success_rate'] if report['reviews'] else '-',
+            '%.2f' % report['retention'] if report['studied'] else '-',
+            report['forgotten'],
+            '%.1f' % report['queries_per_review'] if report['reviews'] else '-',
+        ))
+
+
+def main():
+    ''' Runs the simulator from the command line '''
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--database', default='example.db')
+    parser.add_argument('--days', type=int, default=30)
+    parser.add_argument('--reviews-per-day', type=int, default=100)
+    parser.add_argument(
+        '--policy',
+        action='append',
+        help='Settings to change from the current policy, e.g. '
+             'working_set_size=15,easy_ratio=0.1 (repeatable)',
+    )
+    parser.add_argument('--seed', type=int)
+    parser.add_argument('--processes', type=int)
+    parser.add_argument(
+        '--from-scratch',
+        action='store_true',
+        help='Start every card as new and replay the recorded votes',
+    )
+    parser.add_argument(
+        '--all-cards',
+        action='store_true',
+        help='Study every card instead of the ones matching the preferences',
+    )
+    args = parser.parse_args()
+
+    started = time.time()
+    snapshot = load_snapshot(args.database, args.all_cards)
+    print("Loaded %d cards and %d votes in %.2fs" % (
+        len(snapshot), len(snapshot.history), time.time() - started))
+    policies = [CURRENT_POLICY] + [
+        parse_policy(spec) for spec in (args.policy or [])
+    ]
+    reports = run_policies(
+        snapshot,
+        policies,
+        days=args.days,
+        reviews_per_day=args.reviews_per_day,
+        seed=args.seed,
+        from_scratch=args.from_scratch,
+        processes=args.processes,
+    )
+    print_report(reports)
+
+
+if __name__ == '__main__':
+    main()
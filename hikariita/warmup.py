@@ -0,0 +1,168 @@
+'''
+Gets a freshly started process ready to serve its first requests as fast
+as its hundredth.
+
+A cold process would otherwise make its first visitors wait for the schema
+migrations and working set check, for Jinja to compile every template, and
+for the database pages to come off disk.  Warm-up does all of that once, at
+start up, timing each step.  Compiled templates are kept in a bytecode
+cache on disk, so after a restart they are only loaded, not recompiled.
+
+SQLite's own page cache belongs to a connection, and we open one per
+request, so what carries over between requests is the operating system's
+cache of the database file.  Warm-up asks the kernel to read the file
+ahead, then runs the queries every study page makes once, which also fills
+the metadata cache.
+
+Progress is reported by /healthz, which only says ready once warm-up is
+done, along with how long it took and how long after start up the first
+fast request was served.
+'''
+
+from __future__ import unicode_literals, print_function
+
+import logging
+import os
+import sqlite3
+import threading
+import time
+from urllib.request import pathname2url
+
+from . import cache, db
+
+
+LOG = logging.getLogger(__name__)
+
+# When this process started, near enough: when the package was imported
+STARTED = time.perf_counter()
+
+# Databases larger than this aren't read ahead whole, only their hot pages
+# are touched by the queries
+READ_AHEAD_MAX_BYTES = 256 * 1024 * 1024
+
+
+class WarmUp(object):
+    '''
+    Runs the warm-up steps of an app and keeps track of how it went
+    '''
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.ready = threading.Event()
+        self.steps = []
+        self.error = None
+        self.ready_after = None
+        self.first_fast_request = None
+
+    def run(self, steps):
+        ''' Runs each (name, function) step in turn, timing them '''
+        for (name, step) in steps:
+            started = time.perf_counter()
+            try:
+                step()
+            except Exception as error:
+                LOG.exception("Warm-up step %s failed", name)
+                with self.lock:
+                    self.error = '%s: %r' % (name, error)
+                return
+            elapsed = time.perf_counter() - started
+            LOG.info("Warm-up step %s took %.3fs", name, elapsed)
+            with self.lock:
+                self.steps.append((name, elapsed))
+        with self.lock:
+            self.ready_after = time.perf_counter() - STARTED
+        self.ready.set()
+        LOG.info("Ready %.3fs after start up", self.ready_after)
+
+    def start(self, steps, background=True):
+        '''
+        Runs the steps, in a background thread so the server can already
+        answer /healthz, or right away
+        '''
+        if not background:
+            self.run(steps)
+            return
+        thread = threading.Thread(
+            target=self.run,
+            args=(steps,),
+            name='warm-up',
+        )
+        thread.daemon = True
+        thread.start()
+
+    def record_request(self, slow):
+        ''' Notes when the first fast request after warm-up was served '''
+        if self.first_fast_request is not None or slow or \
+                not self.ready.is_set():
+            return
+        with self.lock:
+            if self.first_fast_request is None:
+                self.first_fast_request = time.perf_counter() - STARTED
+                LOG.info(
+                    "First fast request %.3fs after start up",
+                    self.first_fast_request,
+                )
+
+    def report(self):
+        ''' Returns the state of warm-up as a dictionary '''
+        with self.lock:
+            return {
+                'ready': self.ready.is_set(),
+                'error': self.error,
+                'steps': dict(self.steps),
+                'ready_after': self.ready_after,
+                'first_fast_request': self.first_fast_request,
+                'uptime': time.perf_counter() - STARTED,
+            }
+
+
+def compile_templates(jinja_env):
+    '''
+    Loads every template, compiling it (into the bytecode cache, if any)
+    unless a cached copy is still fresh.  Returns how many there were.
+    '''
+    names = jinja_env.list_templates()
+    for name in names:
+        jinja_env.get_template(name)
+    return len(names)
+
+
+def read_ahead(db_path):
+    '''
+    Asks the kernel to start reading the database and its write-ahead log
+    into the page cache, where the platform supports it
+    '''
+    if not hasattr(os, 'posix_fadvise'):
+        return
+    for path in (db_path, db_path + '-wal'):
+        try:
+            size = os.path.getsize(path)
+        except OSError:
+            continue
+        if size > READ_AHEAD_MAX_BYTES:
+            continue
+        descriptor = os.open(path, os.O_RDONLY)
+        try:
+            os.posix_fadvise(descriptor, 0, 0, os.POSIX_FADV_WILLNEED)
+        finally:
+            os.close(descriptor)
+
+
+def touch_hot_pages(db_path):
+    '''
+    Runs the read queries of the study pages once, on a read-only
+    connection, and caches the metadata they need
+    '''
+    uri = 'file:%s?mode=ro' % pathname2url(os.path.abspath(db_path))
+    connection = sqlite3.connect(uri, uri=True)
+    try:
+        connection.row_factory = sqlite3.Row
+        cursor = connection.cursor()
+        cache.METADATA.get(db_path, lambda: db.get_metadata(cursor))
+        card_id = db.get_next_card(cursor)
+        if card_id is not None:
+            db.get_card_attributes(cursor, card_id)
+        db.get_deck_settings(cursor)
+        db.get_card_stats(cursor)
+    finally:
+        connection.close()
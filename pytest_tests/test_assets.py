@@ -0,0 +1,88 @@
+'''
+Tests that pages only load our own long-cached, compressed assets
+'''
+
+from __future__ import print_function
+
+import gzip
+import io
+import os
+
+from bs4 import BeautifulSoup
+
+from hikariita import APP, get_db, db
+
+
+def _study_mandarin():
+    '''
+    Picks a book so the card page renders instead of redirecting
+    '''
+    with APP.app_context():
+        connection = get_db()
+        db.set_prefered_book(connection.cursor(), 'Mandarin')
+        connection.commit()
+
+
+def _asset_urls(client, path):
+    '''
+    Returns the stylesheet and script URLs of a page, which must exist
+    '''
+    response = client.get(path, follow_redirects=True)
+    assert response.status_code == 200
+    soup = BeautifulSoup(response.data, 'html.parser')
+    urls = [tag['href'] for tag in soup.find_all('link', href=True)]
+    urls += [tag['src'] for tag in soup.find_all('script', src=True)]
+    assert urls
+    return urls
+
+
+def test_no_third_party_requests(one_book_twenty_cards_client):
+    '''
+    The card page only links to our own hashed assets
+    '''
+    _study_mandarin()
+    for url in _asset_urls(one_book_twenty_cards_client, '/cards/'):
+        assert url.startswith('/assets/vendor/')
+
+
+def test_asset_caching(one_book_twenty_cards_client):
+    '''
+    Assets are immutable, precompressed when accepted, and stale hashes 404
+    '''
+    _study_mandarin()
+    url = [
+        url for url in _asset_urls(one_book_twenty_cards_client, '/cards/')
+        if url.endswith('.css')
+    ][0]
+    path = os.path.join(APP.static_folder, 'vendor', 'bootstrap.min.css')
+    with io.open(path, 'rb') as handle:
+        original = handle.read()
+
+    response = one_book_twenty_cards_client.get(url)
+    assert response.status_code == 200
+    assert response.mimetype == 'text/css'
+    assert 'immutable' in response.headers['Cache-Control']
+    assert 'max-age=31536000' in response.headers['Cache-Control']
+    assert 'Content-Encoding' not in response.headers
+    assert response.data == original
+
+    response = one_book_twenty_cards_client.get(
+        url, headers={'Accept-Encoding': 'gzip'})
+    assert response.headers['Content-Encoding'] == 'gzip'
+    assert 'Accept-Encoding' in response.headers['Vary']
+    assert gzip.decompress(response.data) == original
+
+    stale = url.replace('.css', '.000000000000.css')
+    assert one_book_twenty_cards_client.get(stale).status_code == 404
+
+
+def test_html_compression(one_book_twenty_cards_client):
+    '''
+    Pages are gzipped for browsers that accept it
+    '''
+    plain = one_book_twenty_cards_client.get('/stats/')
+    compressed = one_book_twenty_cards_client.get(
+        '/stats/', headers={'Accept-Encoding': 'gzip'})
+    assert 'Content-Encoding' not in plain.headers
+    assert compressed.headers['Content-Encoding'] == 'gzip'
+    assert gzip.decompress(compressed.data) == plain.data
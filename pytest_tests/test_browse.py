@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+
+'''
+Tests listing cards through /api/cards, page by page or streamed
+'''
+
+from __future__ import unicode_literals, print_function
+
+import json
+
+from hikariita import APP, get_db, db
+
+
+def test_pages(two_books_ten_cards_each_client):
+    '''
+    Following "next" walks every card once, in id order
+    '''
+    client = two_books_ten_cards_each_client
+    page = client.get('/api/cards?limit=7').get_json()
+    assert [card['id'] for card in page['cards']] == list(range(1, 8))
+    assert page['next'] == 7
+    assert page['cards'][1] == {
+        'id': 2,
+        'book': 'Genki 1',
+        'lessons': ['Lesson 1'],
+        'fields': {'kanji': '今', 'hiragana': 'いま', 'meaning': 'now'},
+        'items': [{'direction': 0, 'bucket': 'genesis'}],
+        'due': False,
+    }
+
+    seen = []
+    after = 0
+    while after is not None:
+        page = client.get('/api/cards?limit=7&after=%d' % after).get_json()
+        seen.extend(card['id'] for card in page['cards'])
+        after = page['next']
+    assert seen == list(range(1, 41))
+
+    assert client.get('/api/cards?limit=0').status_code == 400
+    assert client.get('/api/cards?after=x').status_code == 400
+    assert client.get('/api/cards?bucket=soon').status_code == 400
+
+
+def test_filters(two_books_ten_cards_each_client):
+    '''
+    Book, lesson, bucket and due narrow down the cards
+    '''
+    client = two_books_ten_cards_each_client
+    with APP.app_context():
+        connection = get_db()
+        cursor = connection.cursor()
+        db.set_prefered_book(cursor, 'Genki 1')
+        db.init_working_set(cursor)
+        db.create_vote(cursor, 12, 1)
+        connection.commit()
+        cursor.execute('SELECT card_id FROM working_set ORDER BY card_id')
+        due = [row[0] for row in cursor.fetchall()]
+    assert due
+
+    def ids(query):
+        response = client.get('/api/cards?' + query)
+        return [card['id'] for card in response.get_json()['cards']]
+
+    assert ids('book=Genki+1&lesson=Lesson+2') == list(range(11, 21))
+    assert ids('book=Genki+2&lesson=Lesson+2') == []
+    assert ids('book=Genki+3') == []
+    assert ids('lesson=Lesson+14&limit=3&after=32') == [33, 34, 35]
+    assert ids('bucket=easy') == [12]
+    assert ids('book=Genki+1&bucket=easy&after=12') == []
+    assert ids('due=true') == due
+    assert len(ids('due=false')) == 40 - len(due)
+
+
+def test_page_queries(two_books_ten_cards_each_client):
+    '''
+    A page is listed through the facet's index and read in one query
+    '''
+    del two_books_ten_cards_each_client
+    with APP.app_context():
+        connection = get_db()
+        cursor = connection.cursor()
+        statements = []
+        connection.set_trace_callback(statements.append)
+        try:
+            card_ids = db.list_card_ids(cursor, book='Genki 2', after=25, limit=5)
+            cards = db.get_cards(cursor, card_ids)
+        finally:
+            connection.set_trace_callback(None)
+        assert [card['id'] for card in cards] == [26, 27, 28, 29, 30]
+        assert len(statements) == 3
+
+        cursor.execute('EXPLAIN QUERY PLAN ' + statements[1], {
+            'facet0': 1, 'after': 25, 'limit': 5, 'bucket': None})
+        plan = ' '.join(row[3] for row in cursor.fetchall())
+        assert 'attributes_cards_relation_attribute_card' in plan
+        assert 'TEMP B-TREE' not in plan
+
+
+def test_json_lines(two_books_ten_cards_each_client):
+    '''
+    JSON Lines streams every matching card, one per line
+    '''
+    client = two_books_ten_cards_each_client
+    response = client.get('/api/cards?format=jsonl&book=Genki+2&after=22')
+    assert response.mimetype == 'application/x-ndjson'
+    lines = response.get_data(as_text=True).splitlines()
+    assert [json.loads(line)['id'] for line in lines] == list(range(23, 41))
+
+    response = client.get(
+        '/api/cards', headers={'Accept': 'application/x-ndjson'})
+    assert len(response.get_data(as_text=True).splitlines()) == 40
@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+
+'''
+Tests editing many cards at once through the bulk edit API
+'''
+
+from __future__ import unicode_literals, print_function
+
+from hikariita import APP, get_db, db
+
+LESSON_1 = 'Lesson  - Class 1'
+LESSON_2 = 'Lesson  - Class 2'
+
+
+def _cards(lesson):
+    '''
+    Returns the cards of a Mandarin lesson keyed by hanzi
+    '''
+    with APP.app_context():
+        cards = db.get_lesson_cards(get_db().cursor(), 'Mandarin', lesson)
+    return dict((values[0], (card_id, values)) for (card_id, values) in cards.items())
+
+
+def test_bulk_edit_json(one_book_twenty_cards_client):
+    '''
+    Fields of several cards are set at once, and moving a card to another
+    lesson doesn't rename the lesson of the cards left behind
+    '''
+    cards = _cards(LESSON_1)
+    (surf_id, _) = cards['冲浪']
+    (ski_id, _) = cards['滑雪']
+    response = one_book_twenty_cards_client.post('/api/cards/edit', json=[
+        {'id': surf_id, 'english': 'to go surfing'},
+        {'id': ski_id, 'pinyin': 'huá xuě', 'Lesson': LESSON_2},
+    ])
+    assert response.status_code == 200
+    assert response.get_json() == {'updated': 1, 'moved': 1, 'unchanged': 0}
+
+    cards = _cards(LESSON_1)
+    assert cards['冲浪'][1][2] == 'to go surfing'
+    assert '滑雪' not in cards
+    assert len(cards) == 9
+    assert _cards(LESSON_2)['滑雪'][0] == ski_id
+
+
+def test_bulk_edit_tsv(one_book_twenty_cards_client):
+    '''
+    A TSV patch with an id column works the same way
+    '''
+    cards = _cards(LESSON_1)
+    patch = 'id\tenglish\n%d\toutdoors\n%d\texercise\n' % (
+        cards['户外'][0], cards['运动'][0])
+    response = one_book_twenty_cards_client.post(
+        '/api/cards/edit',
+        data=patch.encode('utf8'),
+        content_type='text/tab-separated-values',
+    )
+    assert response.status_code == 200
+    assert response.get_json() == {'updated': 1, 'moved': 0, 'unchanged': 1}
+    assert _cards(LESSON_1)['户外'][1][2] == 'outdoors'
+
+
+def test_bulk_edit_is_all_or_nothing(one_book_twenty_cards_client):
+    '''
+    One bad card or field rejects the whole edit
+    '''
+    cards = _cards(LESSON_1)
+    response = one_book_twenty_cards_client.post('/api/cards/edit', json=[
+        {'id': cards['户外'][0], 'english': 'outdoors'},
+        {'id': cards['运动'][0], 'meaning': 'sport'},
+        {'id': 12345, 'english': 'nothing'},
+        {'english': 'no id'},
+    ])
+    assert response.status_code == 400
+    assert len(response.get_json()['errors']) == 1
+
+    response = one_book_twenty_cards_client.post('/api/cards/edit', json=[
+        {'id': cards['户外'][0], 'english': 'outdoors'},
+        {'id': cards['运动'][0], 'meaning': 'sport'},
+        {'id': 12345, 'english': 'nothing'},
+    ])
+    assert response.status_code == 400
+    assert len(response.get_json()['errors']) == 2
+    assert _cards(LESSON_1)['户外'][1][2] == 'outdoor'
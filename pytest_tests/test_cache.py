@@ -0,0 +1,70 @@
+'''
+Tests that card pages are served from the metadata cache
+'''
+
+from __future__ import print_function
+
+import os
+
+from hikariita import APP, cache, db
+
+
+def test_card_page_uses_cache(one_book_twenty_cards_client, monkeypatch):
+    '''
+    Metadata is loaded once, and again only after preferences change
+    '''
+    client = one_book_twenty_cards_client
+    loads = []
+    get_metadata = db.get_metadata
+
+    def counting_get_metadata(cursor):
+        ''' Counts how often the metadata is actually queried '''
+        loads.append(True)
+        return get_metadata(cursor)
+
+    monkeypatch.setattr(db, 'get_metadata', counting_get_metadata)
+
+    for _ in range(3):
+        body = client.get('/cards/1/').data.decode('utf8')
+        assert 'Select A Book' in body
+    assert len(loads) == 1
+
+    client.post(
+        '/preferences/edit',
+        data={'Book': 'Mandarin'},
+        headers={'Referer': '/cards/1/'},
+    )
+    body = client.get('/cards/1/').data.decode('utf8')
+    assert 'Select A Book' not in body
+    assert 'value="Mandarin"' in body
+    assert len(loads) == 2
+
+
+def test_reads_do_not_stamp(one_book_twenty_cards_client, monkeypatch):
+    '''
+    Pages are served without writing a stamp, so a read-only database
+    directory works, and the first change still invalidates the cache
+    '''
+    client = one_book_twenty_cards_client
+    stamp_path = cache.get_stamp_path(APP.config['DATABASE'])
+    if os.path.exists(stamp_path):
+        os.remove(stamp_path)
+    cache.METADATA.clear()
+
+    def refuse(db_path):
+        ''' Fails like a write into a read-only directory '''
+        raise OSError('read-only: %s' % db_path)
+
+    with monkeypatch.context() as patch:
+        patch.setattr(cache, 'bump_version', refuse)
+        for _ in range(2):
+            assert client.get('/cards/1/').status_code == 200
+    assert not os.path.exists(stamp_path)
+
+    client.post(
+        '/preferences/edit',
+        data={'Book': 'Mandarin'},
+        headers={'Referer': '/cards/1/'},
+    )
+    assert os.path.exists(stamp_path)
+    assert 'value="Mandarin"' in client.get('/cards/1/').data.decode('utf8')
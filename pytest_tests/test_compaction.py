@@ -0,0 +1,124 @@
+'''
+Tests that compacting the vote history keeps the scheduler's view intact
+'''
+
+from __future__ import print_function
+
+import sqlite3
+import tempfile
+
+from hikariita import APP, get_db, db
+from hikariita.compaction import compact_votes
+
+
+def _vote_everything(cursor, votes):
+    '''
+    Casts the given sequence of votes on every card
+    '''
+    cursor.execute('SELECT id FROM cards ORDER BY id')
+    card_ids = [row[0] for row in cursor.fetchall()]
+    for vote in votes:
+        for card_id in card_ids:
+            db.create_vote(cursor, card_id, vote)
+    return card_ids
+
+
+def _least_recently_seen(cursor):
+    '''
+    Returns the cards the scheduler would pull into an empty working set
+    '''
+    db.clear_working_set(cursor)
+    db.draw_from_least_recently_seen(cursor, 5)
+    cursor.execute('SELECT card_id FROM working_set ORDER BY id')
+    return [row[0] for row in cursor.fetchall()]
+
+
+def test_compaction_preserves_state(one_book_twenty_cards_client):
+    '''
+    Compacted cards keep their state and least-recently-seen order
+    '''
+    del one_book_twenty_cards_client
+    archive_path = tempfile.NamedTemporaryFile(delete=False).name
+    with APP.app_context():
+        connection = get_db()
+        cursor = connection.cursor()
+        db.set_prefered_book(cursor, 'Mandarin')
+        card_ids = _vote_everything(cursor, [1, -1, 0, 1])
+        connection.commit()
+
+        before = [db.calculate_state_of_card(cursor, i) for i in card_ids]
+        first_before = _least_recently_seen(cursor)
+        connection.rollback()
+
+        result = compact_votes(
+            connection,
+            retention_days=0,
+            archive_path=archive_path,
+            chunk_size=7,
+            pause=0,
+        )
+        assert result['votes'] == 4 * len(card_ids)
+        assert result['chunks'] > 1
+
+        cursor.execute('SELECT COUNT(*) FROM votes')
+        assert cursor.fetchone()[0] == 0
+        after = [db.calculate_state_of_card(cursor, i) for i in card_ids]
+        assert after == before
+        assert _least_recently_seen(cursor) == first_before
+        connection.rollback()
+
+    archive = sqlite3.connect(archive_path)
+    assert archive.execute('SELECT COUNT(*) FROM votes').fetchone()[0] == \
+        4 * len(card_ids)
+    archive.close()
+
+
+def test_compaction_respects_retention(one_book_twenty_cards_client):
+    '''
+    Votes inside the retention window are left alone
+    '''
+    del one_book_twenty_cards_client
+    with APP.app_context():
+        connection = get_db()
+        cursor = connection.cursor()
+        card_ids = _vote_everything(cursor, [-1, -1])
+        connection.commit()
+
+        result = compact_votes(connection, retention_days=1, pause=0)
+        assert result['votes'] == 0
+
+        # Mix in new votes after compacting the old ones
+        compact_votes(connection, retention_days=0, pause=0)
+        _vote_everything(cursor, [-1])
+        assert db.calculate_state_of_card(cursor, card_ids[0]) == 'hard'
+
+
+def test_compaction_reclaims_space(one_book_twenty_cards_client):
+    '''
+    The pages freed by compacting go back to the file system, on the
+    database the app created
+    '''
+    del one_book_twenty_cards_client
+    with APP.app_context():
+        connection = get_db()
+        cursor = connection.cursor()
+        cursor.execute('SELECT id FROM cards')
+        card_ids = [row[0] for row in cursor.fetchall()]
+        cursor.executemany(
+            'INSERT INTO votes (vote, card_id, created, item_id) '
+            'VALUES (?, ?, 0, ?)',
+            [
+                (1, card_id, db.make_item_id(card_id))
+                for card_id in card_ids for _ in range(300)
+            ],
+        )
+        connection.commit()
+        assert cursor.execute('PRAGMA auto_vacuum').fetchone()[0] == 2
+        pages_before = cursor.execute('PRAGMA page_count').fetchone()[0]
+
+        result = compact_votes(
+            connection, retention_days=0, pause=0, vacuum_pages=10000)
+        assert result['votes'] == 300 * len(card_ids)
+        assert result['pages'] > 0
+        assert cursor.execute('PRAGMA freelist_count').fetchone()[0] == 0
+        assert cursor.execute('PRAGMA page_count').fetchone()[0] < pages_before
@@ -0,0 +1,152 @@
+# -*- coding: utf-8 -*-
+
+'''
+Tests quizzing cards in several directions, each with its own schedule
+'''
+
+from __future__ import unicode_literals, print_function
+
+from hikariita import APP, get_db, db
+
+
+def _prefer(directions):
+    '''
+    Studies Mandarin in the given directions and returns the write cursor
+    '''
+    connection = get_db()
+    cursor = connection.cursor()
+    db.set_prefered_book(cursor, 'Mandarin')
+    db.set_directions(cursor, 'Mandarin', directions)
+    db.clear_working_set(cursor)
+    db.init_working_set(cursor)
+    connection.commit()
+    return cursor
+
+
+def test_migration(one_book_twenty_cards_client):
+    '''
+    Buckets, votes, summaries and the working set of databases from before
+    directions become those of each card's first direction
+    '''
+    del one_book_twenty_cards_client
+    with APP.app_context():
+        cursor = get_db().cursor()
+        db.create_vote(cursor, 2, -1)
+        cursor.executescript('''
+            DELETE FROM items;
+            DELETE FROM item_summaries;
+            UPDATE votes SET item_id = NULL;
+            UPDATE working_set SET item_id = NULL;
+            UPDATE cards SET bucket = 'hard' WHERE id == 1;
+            CREATE TABLE vote_summaries (
+                card_id INTEGER PRIMARY KEY,
+                vote_count INTEGER NOT NULL,
+                vote_sum INTEGER NOT NULL,
+                last_vote_id INTEGER
+            );
+            INSERT INTO vote_summaries VALUES (1, 3, -3, 0);
+        ''')
+
+        db.init(cursor)
+        cursor.execute('SELECT COUNT(*) FROM items')
+        assert cursor.fetchone()[0] == 20
+        cursor.execute('SELECT bucket FROM items WHERE id == 8')
+        assert cursor.fetchone()[0] == 'hard'
+        cursor.execute('SELECT item_id FROM votes')
+        assert [tuple(row) for row in cursor.fetchall()] == [(16,)]
+        cursor.execute('SELECT COUNT(*) FROM working_set WHERE item_id IS NULL')
+        assert cursor.fetchone()[0] == 0
+        assert db.calculate_state_of_card(cursor, 1) == 'hard'
+        cursor.execute(
+            "SELECT name FROM sqlite_master WHERE name == 'vote_summaries'")
+        assert cursor.fetchone() is None
+
+
+def test_set_directions(one_book_twenty_cards_client):
+    '''
+    Each enabled direction has an item per card, and dropped ones leave
+    the working set
+    '''
+    del one_book_twenty_cards_client
+    with APP.app_context():
+        cursor = _prefer([0, 1, 2])
+        assert db.get_directions(cursor, 'Mandarin') == [
+            (0, 'hanzi', True), (1, 'pinyin', True), (2, 'english', True)]
+        cursor.execute('SELECT COUNT(*) FROM items')
+        assert cursor.fetchone()[0] == 60
+
+        cursor = _prefer([2])
+        cursor.execute('SELECT DISTINCT id & 7 FROM items')
+        assert [tuple(row) for row in cursor.fetchall()] == [(2,)]
+        cursor.execute('SELECT COUNT(*), MIN(item_id & 7) FROM working_set')
+        assert tuple(cursor.fetchone()) == (db.DEFAULT_WORKING_SET_SIZE, 2)
+
+
+def test_vote_per_direction(one_book_twenty_cards_client):
+    '''
+    A vote only moves the item of the direction it was given in
+    '''
+    del one_book_twenty_cards_client
+    with APP.app_context():
+        cursor = _prefer([0, 1])
+        db.create_vote(cursor, 1, 1, direction=1)
+        cursor.execute('SELECT id, bucket FROM items WHERE id IN (8, 9)')
+        assert [tuple(row) for row in cursor.fetchall()] == [
+            (8, 'genesis'), (9, 'easy')]
+        assert db.calculate_state_of_card(cursor, 1, 0) is None
+
+
+def test_study_in_direction(one_book_twenty_cards_client):
+    '''
+    The card page shows only the prompt, and the direction travels from the
+    redirect to the vote
+    '''
+    client = one_book_twenty_cards_client
+    with APP.app_context():
+        db.set_prefered_book(get_db().cursor(), 'Mandarin')
+        get_db().commit()
+    response = client.post('/preferences/directions', data={'direction': ['1']})
+    assert response.status_code == 302
+    assert client.post('/preferences/directions', data={}).status_code == 400
+
+    response = client.get('/cards/')
+    assert 'direction=1' in response.headers['Location']
+
+    page = client.get('/cards/1/?direction=1').get_data(as_text=True)
+    assert 'id="pinyin" name="pinyin" value="hù wài">' in page
+    assert 'id="hanzi" name="hanzi" value="户外" style="display: none;">' in page
+    assert 'name="direction" value="1"' in page
+    assert client.get('/cards/1/?direction=8').status_code == 404
+
+    client.post('/cards/1/vote', data={'confidence': 'bad', 'direction': '1'})
+    assert client.post(
+        '/cards/1/vote', data={'confidence': 'bad', 'direction': '8'}
+    ).status_code == 400
+    with APP.app_context():
+        cursor = get_db().cursor()
+        cursor.execute('SELECT item_id FROM votes')
+        assert [tuple(row) for row in cursor.fetchall()] == [(9,)]
+
+
+def test_vote_in_disabled_direction(one_book_twenty_cards_client):
+    '''
+    Votes in a direction the book isn't quizzed in are refused, and touch
+    neither the votes nor the working set
+    '''
+    client = one_book_twenty_cards_client
+    with APP.app_context():
+        cursor = _prefer([0, 1])
+        cursor.execute('SELECT item_id FROM working_set ORDER BY id')
+        before = [row[0] for row in cursor.fetchall()]
+
+    for direction in ('2', '5'):
+        response = client.post(
+            '/cards/1/vote', data={'confidence': 'bad', 'direction': direction})
+        assert response.status_code == 400
+
+    with APP.app_context():
+        cursor = get_db().cursor()
+        cursor.execute('SELECT COUNT(*) FROM votes')
+        assert cursor.fetchone()[0] == 0
+        cursor.execute('SELECT item_id FROM working_set ORDER BY id')
+        assert [row[0] for row in cursor.fetchall()] == before
@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+
+'''
+Tests that likely duplicate cards are found when importing
+'''
+
+from __future__ import unicode_literals, print_function
+
+import logging
+import sqlite3
+
+from hikariita import APP, get_db, db
+from hikariita.normalize import content_key, normalize_text
+
+from conftest import MANDARIN_BOOKS
+
+HEADERS = MANDARIN_BOOKS['headers']
+LESSON = 'Lesson  - Class 1'
+ROWS = MANDARIN_BOOKS['Mandarin'][LESSON]
+
+
+def test_normalize_text():
+    '''
+    Width, kana, tone marks, case and punctuation don't matter, but ü does
+    '''
+    assert normalize_text('ＡＢＣ') == 'abc'
+    assert normalize_text('カタカナ') == normalize_text('かたかな')
+    assert normalize_text('chōng làng') == 'chonglang'
+    assert normalize_text('lǜ') == 'lü'
+    assert normalize_text('がっこう') == 'がっこう'
+    assert normalize_text('To swim!') == normalize_text('to swim')
+    assert content_key(['a', 'b']) == content_key(['b', 'a', ''])
+    assert content_key(['', ' ']) is None
+
+
+def _duplicated_rows():
+    '''
+    The lesson's rows retyped without tones and with different spacing
+    '''
+    return [
+        (hanzi, pinyin.replace(' ', ''), english.upper())
+        for (hanzi, pinyin, english) in ROWS
+    ]
+
+
+
+def test_new_database_not_migrated(caplog):
+    '''
+    Fresh databases are created with the content key, without migrating
+    '''
+    cursor = sqlite3.connect(':memory:').cursor()
+    with caplog.at_level(logging.INFO, logger='hikariita.db'):
+        db.init(cursor)
+    assert not [
+        record for record in caplog.records
+        if record.getMessage().startswith('Migrating')
+    ]
+    cursor.execute('PRAGMA table_info(cards)')
+    assert 'content_key' in [row[1] for row in cursor.fetchall()]
+
+def test_merge_on_import(one_book_twenty_cards_client):
+    '''
+    Merged duplicates reuse the existing card in the new lesson
+    '''
+    del one_book_twenty_cards_client
+    with APP.app_context():
+        cursor = get_db().cursor()
+        before = db.get_lesson_cards(cursor, 'Mandarin', LESSON)
+        db.create_content(
+            cursor, 'Mandarin', 'Review', HEADERS, _duplicated_rows(),
+            duplicates='merge')
+
+        cursor.execute('SELECT COUNT(*) FROM cards')
+        assert cursor.fetchone()[0] == 20
+        merged = db.get_lesson_cards(cursor, 'Mandarin', 'Review')
+        assert sorted(merged) == sorted(before)
+
+        # Unlinking the review lesson leaves the original cards alone
+        result = db.sync_content(
+            cursor, 'Mandarin', 'Review', HEADERS, [], delete_missing=True)
+        assert (result['deleted'], result['unlinked']) == (0, 10)
+        assert db.get_lesson_cards(cursor, 'Mandarin', 'Review') == {}
+        assert db.get_lesson_cards(cursor, 'Mandarin', LESSON) == before
+
+
+def test_link_and_report(one_book_twenty_cards_client):
+    '''
+    Linked duplicates are new cards that show up in the report
+    '''
+    del one_book_twenty_cards_client
+    with APP.app_context():
+        cursor = get_db().cursor()
+        assert db.find_duplicates(cursor) == []
+        db.create_content(
+            cursor, 'Mandarin', 'Review', HEADERS, _duplicated_rows()[:2],
+            duplicates='link')
+
+        cursor.execute('SELECT COUNT(*) FROM cards')
+        assert cursor.fetchone()[0] == 22
+        cursor.execute('SELECT card_id, duplicate_of FROM card_duplicates')
+        links = cursor.fetchall()
+        groups = db.find_duplicates(cursor)
+        assert sorted(groups) == sorted(
+            sorted([card_id, duplicate_of]) for (card_id, duplicate_of) in links)
+        assert len(groups) == 2
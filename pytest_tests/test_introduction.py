@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+
+'''
+Tests that new cards are introduced in lesson order, a few a day
+'''
+
+from __future__ import unicode_literals, print_function
+
+from hikariita import APP, get_db, db
+
+HEADERS = ['Hanzi', 'English']
+
+
+def _import(cursor, lesson, words):
+    '''
+    Imports one card per word into the given lesson of the Words book
+    '''
+    db.create_content(
+        cursor, 'Words', lesson, HEADERS,
+        [(word, word + '?') for word in words])
+
+
+def _drawn(cursor):
+    '''
+    Returns the first field of the cards in the working set, in order
+    '''
+    cursor.execute('''
+        SELECT cards.content FROM working_set
+        INNER JOIN cards ON cards.id == working_set.card_id
+        ORDER BY working_set.id
+    ''')
+    return [db.unpack_values(row[0])[0] for row in cursor.fetchall()]
+
+
+def test_lesson_order(empty_client):
+    '''
+    Lessons come in the order of their numbers, then cards in import order
+    '''
+    del empty_client
+    with APP.app_context():
+        cursor = get_db().cursor()
+        _import(cursor, 'Lesson 10', ['十'])
+        _import(cursor, 'Lesson 2', ['二', '两'])
+        _import(cursor, 'Lesson 1', ['一'])
+        db.set_prefered_book(cursor, 'Words')
+        db.clear_working_set(cursor)
+
+        assert db.draw_new_items(cursor, 20, 2) == 2
+        assert _drawn(cursor) == ['一', '二']
+        assert db.get_introduction_queue(cursor)[1] == 2
+
+        # Importing marks the queue stale, and it's rebuilt on the next draw
+        _import(cursor, 'Lesson 1', ['壹'])
+        assert db.draw_new_items(cursor, 20, 5) == 3
+        assert _drawn(cursor) == ['一', '二', '壹', '两', '十']
+
+
+def test_daily_budget(empty_client):
+    '''
+    No more than the deck's new cards per day are drawn, counted without
+    looking at the votes
+    '''
+    del empty_client
+    with APP.app_context():
+        connection = get_db()
+        cursor = connection.cursor()
+        _import(cursor, 'Lesson 1', ['一', '二', '三', '四', '五'])
+        db.set_prefered_book(cursor, 'Words')
+        db.set_deck_settings(cursor, 'Words', 7, 0.0, 2)
+        db.clear_working_set(cursor)
+
+        statements = []
+        connection.set_trace_callback(statements.append)
+        try:
+            assert db.draw_new_items(cursor, 2, 7) == 2
+        finally:
+            connection.set_trace_callback(None)
+        assert not [statement for statement in statements if 'votes' in statement]
+        assert _drawn(cursor) == ['一', '二']
+        assert db.init_working_set(cursor) == 0
+
+        # A new day
+        cursor.execute('UPDATE introduction_queues SET day = day - 1')
+        assert db.init_working_set(cursor) == 2
+        assert _drawn(cursor) == ['一', '二', '三', '四']
+
+
+def test_cleared_working_set(empty_client):
+    '''
+    Cards drawn but not learned are introduced again after the working set
+    is cleared
+    '''
+    del empty_client
+    with APP.app_context():
+        cursor = get_db().cursor()
+        _import(cursor, 'Lesson 1', ['一', '二', '三'])
+        db.set_prefered_book(cursor, 'Words')
+        db.clear_working_set(cursor)
+        assert db.draw_new_items(cursor, 20, 2) == 2
+        first = min(db.get_lesson_cards(cursor, 'Words', 'Lesson 1'))
+        db.create_vote(cursor, first, 1, refill=False)
+
+        db.clear_working_set(cursor)
+        assert db.draw_new_items(cursor, 20, 5) == 2
+        assert _drawn(cursor) == ['二', '三']
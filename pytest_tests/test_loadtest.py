@@ -0,0 +1,32 @@
+'''
+Tests that the load generator can drive the app in-process
+'''
+
+from __future__ import print_function
+
+from hikariita import APP
+from hikariita.loadtest import percentile, run_in_process
+
+
+def test_percentile():
+    '''
+    Nearest-rank percentiles of a sorted list
+    '''
+    samples = list(range(1, 101))
+    assert percentile(samples, 0.50) == 50
+    assert percentile(samples, 0.99) == 99
+    assert percentile([], 0.5) is None
+
+
+def test_in_process(two_books_ten_cards_each_client):
+    '''
+    A few learners can study concurrently without errors
+    '''
+    del two_books_ten_cards_each_client
+    summary = run_in_process(APP, learners=3, iterations=6, seed=1)
+    routes = summary['routes']
+    assert routes['/cards/']['count'] == 18
+    assert routes['/cards/<id>/vote']['count'] > 0
+    assert '/preferences/edit' in routes
+    assert not sum(route['errors'] for route in routes.values())
+    assert summary['lock_waits'] == 0
@@ -0,0 +1,154 @@
+'''
+Tests that logging stays off the request path and carries its context
+'''
+
+from __future__ import print_function
+
+import logging
+import threading
+
+import pytest
+
+from hikariita import logs
+
+
+class _Collector(logging.Handler):
+    '''
+    Keeps the records it's given, and which thread wrote them
+    '''
+
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.records = []
+        self.threads = set()
+
+    def emit(self, record):
+        self.records.append(record)
+        self.threads.add(threading.current_thread())
+
+
+class _Expensive(object):
+    '''
+    Counts how many times it was turned into a string
+    '''
+
+    def __init__(self):
+        self.formatted = 0
+
+    def __str__(self):
+        self.formatted += 1
+        return 'expensive'
+
+
+@pytest.fixture
+def collect():
+    '''
+    Configures logging with the given levels into a collector, and puts
+    back the default set up afterwards
+    '''
+    def configure(spec):
+        collector = _Collector()
+        logs.configure(spec, handlers=[collector])
+        return collector
+    yield configure
+    logs.configure()
+
+
+def test_parse_levels():
+    '''
+    A bare level is the default, the rest are per logger
+    '''
+    assert logs.parse_levels(None) == (logs.DEFAULT_LEVEL, {})
+    assert logs.parse_levels('warning, hikariita.db=debug') == (
+        'WARNING', {'hikariita.db': 'DEBUG'})
+
+
+def test_nothing_formatted_below_level(collect):
+    '''
+    Disabled debug calls never turn their arguments into strings
+    '''
+    collector = collect('INFO')
+    argument = _Expensive()
+    logging.getLogger('hikariita.db').debug('Got %s', argument)
+    logs.stop()
+    assert argument.formatted == 0
+    assert not collector.records
+
+
+def test_written_from_background_thread(collect):
+    '''
+    Records reach the handlers on the listener's thread, unformatted
+    '''
+    collector = collect('DEBUG')
+    argument = _Expensive()
+    # Straight to our handler, as pytest adds its own formatting ones
+    (handler,) = [
+        handler for handler in logging.getLogger('hikariita').handlers
+        if isinstance(handler, logs.BackgroundHandler)
+    ]
+    logger = logging.getLogger('hikariita.db')
+    handler.handle(logger.makeRecord(
+        logger.name, logging.INFO, __file__, 1, 'Got %s', (argument,), None))
+    logs.stop()
+    assert argument.formatted == 0
+    assert [record.msg for record in collector.records] == ['Got %s']
+    assert threading.current_thread() not in collector.threads
+
+
+def test_rate_limited_debug():
+    '''
+    Debug records from one call site are dropped past the burst, and the
+    next one let through counts them
+    '''
+    rate_limit = logs.RateLimitFilter(burst=3, rate=0.0)
+    logger = logging.getLogger('hikariita.test')
+
+    def record(level):
+        return logger.makeRecord(
+            logger.name, level, __file__, 1, 'message', (), None)
+
+    passed = [rate_limit.filter(record(logging.DEBUG)) for _ in range(10)]
+    assert passed.count(True) == 3
+    assert rate_limit.filter(record(logging.INFO))
+
+    rate_limit.buckets[(__file__, 1)][0] = 1.0
+    refilled = record(logging.DEBUG)
+    assert rate_limit.filter(refilled)
+    assert refilled.suppressed == 7
+
+
+def test_request_context(collect, one_book_twenty_cards_client):
+    '''
+    Records logged while handling a request carry its id and card
+    '''
+    collector = collect('WARNING,hikariita.db=DEBUG')
+    response = one_book_twenty_cards_client.post(
+        '/cards/1/vote',
+        data={'confidence': 'good'},
+    )
+    logs.stop()
+    request_id = response.headers['X-Request-Id']
+    records = [
+        record for record in collector.records
+        if getattr(record, 'request_id', None) == request_id
+    ]
+    assert records
+    assert all(record.name == 'hikariita.db' for record in records)
+    assert all(record.card_id == 1 for record in records)
+    assert all(record.elapsed_ms >= 0 for record in records)
+
+    formatted = logs.JSONFormatter().format(records[0])
+    assert '"request_id": "%s"' % request_id in formatted
+
+
+def test_no_environment_dump(capsys, one_book_twenty_cards_client):
+    '''
+    Requests don't print the environment or anything else
+    '''
+    capsys.readouterr()
+    one_book_twenty_cards_client.post(
+        '/cards/1/vote',
+        data={'confidence': 'good'},
+    )
+    one_book_twenty_cards_client.get('/cards/', follow_redirects=True)
+    assert capsys.readouterr().out == ''
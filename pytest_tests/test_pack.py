@@ -0,0 +1,148 @@
+'''
+Tests downloading the deck as a SQLite pack, whole or as a delta
+'''
+
+from __future__ import print_function
+
+import sqlite3
+import tempfile
+
+from hikariita import APP, get_db, get_db_path, db, pack
+
+
+def _open_pack(response):
+    '''
+    Saves a downloaded pack and returns a connection to it
+    '''
+    path = tempfile.NamedTemporaryFile(delete=False, suffix='.sqlite3').name
+    with open(path, 'wb') as handle:
+        handle.write(response.data)
+    return sqlite3.connect(path)
+
+
+def _prefer(book):
+    '''
+    Studies the given book and returns the write connection
+    '''
+    connection = get_db()
+    cursor = connection.cursor()
+    db.set_prefered_book(cursor, book)
+    db.clear_working_set(cursor)
+    db.init_working_set(cursor)
+    connection.commit()
+    return connection
+
+
+def test_full_pack(two_books_ten_cards_each_client):
+    '''
+    The pack has the studied book's cards, facets and scheduling state,
+    and honours ETags and ranges
+    '''
+    client = two_books_ten_cards_each_client
+    with APP.app_context():
+        connection = _prefer('Genki 1')
+        cursor = connection.cursor()
+        card_id = db.get_next_card(cursor)
+        db.create_vote(cursor, card_id, -1)
+        connection.commit()
+
+    response = client.get('/api/pack')
+    assert response.status_code == 200
+    etag = response.headers['ETag']
+    token = response.headers['X-Pack-Version']
+    packed = _open_pack(response)
+    assert packed.execute('SELECT COUNT(*) FROM cards').fetchone()[0] == 20
+    assert packed.execute('SELECT title FROM books').fetchall() == [('Genki 1',)]
+    assert packed.execute('SELECT COUNT(*) FROM lessons').fetchone()[0] == 2
+    assert packed.execute('SELECT COUNT(*) FROM working_set').fetchone()[0] == \
+        db.DEFAULT_WORKING_SET_SIZE
+    assert packed.execute(
+        'SELECT vote_count, vote_sum FROM items WHERE id == ?',
+        (db.make_item_id(card_id),)
+    ).fetchone() == (1, -1)
+    assert packed.execute(
+        "SELECT value FROM pack_info WHERE key == 'version'"
+    ).fetchone()[0] == token.split('-')[1]
+
+    assert client.get('/api/pack', headers={'If-None-Match': etag}).status_code == 304
+    partial = client.get('/api/pack', headers={'Range': 'bytes=0-15'})
+    assert partial.status_code == 206
+    assert partial.data == b'SQLite format 3\x00'
+
+
+def test_incremental_pack(two_books_ten_cards_each_client):
+    '''
+    New packs are built from the previous one, and deltas only carry the
+    cards that changed
+    '''
+    client = two_books_ten_cards_each_client
+    with APP.app_context():
+        _prefer('Genki 1')
+    first = client.get('/api/pack')
+    token = first.headers['X-Pack-Version']
+
+    with APP.app_context():
+        connection = get_db()
+        cursor = connection.cursor()
+        (removed, edited) = sorted(
+            db.get_lesson_cards(cursor, 'Genki 1', 'Lesson 1'))[:2]
+        db.delete_cards(cursor, [removed])
+        db.edit_card_fields(cursor, edited, [('meaning', 'edited')])
+        connection.commit()
+
+    second = client.get('/api/pack')
+    assert second.headers['X-Pack-Version'] != token
+    packed = _open_pack(second)
+    assert packed.execute('SELECT COUNT(*) FROM cards').fetchone()[0] == 19
+    content = packed.execute(
+        'SELECT content FROM cards WHERE id == ?', (edited,)).fetchone()[0]
+    assert 'edited' in content
+
+    delta = _open_pack(client.get('/api/pack?since=' + token))
+    assert [row[0] for row in delta.execute('SELECT id FROM cards')] == [edited]
+    assert [row[0] for row in delta.execute('SELECT card_id FROM removed')] == [removed]
+
+    # Only the latest pack of these preferences is kept around
+    with APP.app_context():
+        pack_dir = pack.get_pack_dir(get_db_path())
+    assert pack.find_latest_pack(pack_dir, token.split('-')[0], 10 ** 9)[1] == \
+        int(second.headers['X-Pack-Version'].split('-')[1])
+
+
+def test_refilled_working_set(two_books_ten_cards_each_client):
+    '''
+    Refilling the working set or changing directions makes a new pack, even
+    though no card was voted on
+    '''
+    client = two_books_ten_cards_each_client
+    with APP.app_context():
+        _prefer('Genki 1')
+    first = client.get('/api/pack')
+    token = first.headers['X-Pack-Version']
+
+    with APP.app_context():
+        connection = get_db()
+        cursor = connection.cursor()
+        db.set_deck_settings(cursor, 'Genki 1', 10, 0.0, 20)
+        db.clear_working_set(cursor)
+        db.init_working_set(cursor)
+        connection.commit()
+        cursor.execute('SELECT id, card_id, item_id FROM working_set ORDER BY id')
+        working_set = [tuple(row) for row in cursor.fetchall()]
+
+    second = client.get('/api/pack')
+    assert second.headers['X-Pack-Version'] != token
+    packed = _open_pack(second)
+    assert packed.execute(
+        'SELECT position, card_id, item_id FROM working_set ORDER BY position'
+    ).fetchall() == working_set
+    assert len(working_set) == 10
+
+    with APP.app_context():
+        connection = get_db()
+        db.set_directions(connection.cursor(), 'Genki 1', [0, 1])
+        connection.commit()
+    third = client.get('/api/pack')
+    assert third.headers['X-Pack-Version'] != second.headers['X-Pack-Version']
+    packed = _open_pack(third)
+    assert packed.execute('SELECT COUNT(*) FROM items').fetchone()[0] == 40
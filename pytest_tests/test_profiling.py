@@ -0,0 +1,71 @@
+'''
+Tests that admins can profile single requests
+'''
+
+from __future__ import print_function
+
+import os
+import tempfile
+
+import pytest
+
+from hikariita import APP
+
+
+@pytest.fixture
+def profile_dir():
+    '''
+    Turns profiling on for the duration of a test
+    '''
+    directory = tempfile.mkdtemp()
+    APP.config.update(
+        PROFILING=True,
+        PROFILE_TOKEN='secret',
+        PROFILE_DIR=directory,
+    )
+    yield directory
+    APP.config.update(PROFILING=False, PROFILE_TOKEN=None)
+
+
+def test_not_profiled_without_token(one_book_twenty_cards_client, profile_dir):
+    '''
+    Requests without the admin token are served as usual
+    '''
+    response = one_book_twenty_cards_client.get('/stats/?profile=wrong')
+    assert response.status_code == 200
+    assert 'X-Profile-Name' not in response.headers
+    assert not os.listdir(profile_dir)
+    assert one_book_twenty_cards_client.get('/profiles/').status_code == 404
+
+
+def test_profile_request(one_book_twenty_cards_client, profile_dir):
+    '''
+    A profiled request leaves pstats, collapsed stacks and a SQL summary
+    '''
+    client = one_book_twenty_cards_client
+    response = client.get('/stats/', headers={'X-Profile': 'secret'})
+    assert response.status_code == 200
+    name = response.headers['X-Profile-Name']
+    assert sorted(os.listdir(profile_dir)) == [
+        name + '.collapsed', name + '.json', name + '.pstats']
+
+    listing = client.get('/profiles/?profile=secret').get_json()
+    assert [entry['name'] for entry in listing] == [name]
+
+    summary = client.get('/profiles/%s.json?profile=secret' % name).get_json()
+    assert 'get_card_stats' in summary['db_functions']
+    assert any('GROUP BY attributes.value' in entry['sql']
+               for entry in summary['sql'])
+
+
+def test_token_not_saved(one_book_twenty_cards_client, profile_dir):
+    '''
+    A token given in the query string doesn't end up in the saved profile
+    '''
+    client = one_book_twenty_cards_client
+    response = client.get('/stats/?profile=secret')
+    name = response.headers['X-Profile-Name']
+    listing = client.get('/profiles/', headers={'X-Profile': 'secret'})
+    assert [entry['path'] for entry in listing.get_json()] == ['/stats/']
+    with open(os.path.join(profile_dir, name + '.json')) as handle:
+        assert 'secret' not in handle.read()
@@ -0,0 +1,64 @@
+'''
+Tests that GET requests never write to, or wait on, the database
+'''
+
+from __future__ import print_function
+
+import os
+import sqlite3
+import tempfile
+
+import pytest
+
+from hikariita import APP, get_read_db, init_db
+
+
+def test_read_connection_is_read_only(one_book_twenty_cards_client):
+    '''
+    The connection used by GET requests refuses to write
+    '''
+    del one_book_twenty_cards_client
+    with APP.test_request_context('/stats/'):
+        with pytest.raises(sqlite3.OperationalError):
+            get_read_db().execute('DELETE FROM working_set')
+
+
+def test_reads_while_writer_holds_lock(one_book_twenty_cards_client):
+    '''
+    Pages still load while another connection is in a write transaction,
+    even when the working set would need refilling
+    '''
+    client = one_book_twenty_cards_client
+    response = client.post(
+        '/preferences/edit',
+        data={'Book': 'Mandarin'},
+        headers={'Referer': '/cards/'},
+    )
+    assert response.status_code == 302
+
+    writer = sqlite3.connect(APP.config['DATABASE'], timeout=0)
+    writer.execute('DELETE FROM working_set')
+    writer.commit()
+    writer.execute('BEGIN IMMEDIATE')
+    try:
+        for path in ('/', '/stats/', '/preferences/', '/cards/-1/'):
+            assert client.get(path).status_code == 200
+        assert client.get('/cards/').status_code == 302
+    finally:
+        writer.rollback()
+        writer.close()
+
+
+def test_new_database_settings():
+    '''
+    Databases created by the app are in WAL mode and still get the
+    incremental auto_vacuum set by db.init
+    '''
+    db_path = os.path.join(tempfile.mkdtemp(), 'new.db')
+    init_db(db_path)
+    connection = sqlite3.connect(db_path)
+    try:
+        assert connection.execute('PRAGMA journal_mode').fetchone()[0] == 'wal'
+        assert connection.execute('PRAGMA auto_vacuum').fetchone()[0] == 2
+    finally:
+        connection.close()
@@ -0,0 +1,62 @@
+'''
+Tests that votes leave working set refills to the background thread
+'''
+
+from __future__ import print_function
+
+from hikariita import APP, get_db, db, replenish
+
+
+def _study_mandarin(client, working_set_size):
+    '''
+    Picks the Mandarin book with the given working set size and returns
+    the id of the first card to study
+    '''
+    client.post(
+        '/preferences/edit',
+        data={'Book': 'Mandarin'},
+        headers={'Referer': '/preferences/'},
+    )
+    client.post(
+        '/preferences/deck',
+        data={'working_set_size': str(working_set_size), 'easy_ratio': '0'},
+    )
+    location = client.get('/cards/').headers['Location']
+    return int(location.rstrip('/').split('/')[-1])
+
+
+def test_background_refill(one_book_twenty_cards_client):
+    '''
+    The working set is topped up after the vote request has returned
+    '''
+    client = one_book_twenty_cards_client
+    card_id = _study_mandarin(client, 7)
+    before = replenish.get_metrics()
+
+    response = client.post('/cards/%d/vote' % card_id, data={'confidence': 'good'})
+    assert response.status_code == 302
+    assert replenish.get_replenisher(APP.config['DATABASE']).wait_idle(5)
+
+    after = replenish.get_metrics()
+    assert after['sync_refills'] == before['sync_refills']
+    assert after['background_refills'] > before['background_refills']
+    with APP.app_context():
+        cursor = get_db().cursor()
+        assert db.get_working_set_size(cursor) == 7
+        cursor.execute('SELECT 1 FROM working_set WHERE card_id == ?', (card_id,))
+        assert cursor.fetchone() is None
+
+
+def test_sync_fallback(one_book_twenty_cards_client):
+    '''
+    When the vote empties the working set, the request refills it itself
+    '''
+    client = one_book_twenty_cards_client
+    card_id = _study_mandarin(client, 1)
+    before = replenish.get_metrics()['sync_refills']
+
+    client.post('/cards/%d/vote' % card_id, data={'confidence': 'good'})
+    assert replenish.get_metrics()['sync_refills'] == before + 1
+    assert client.get('/metrics').get_json()['replenish']['sync_refills'] == \
+        before + 1
+    assert not client.get('/cards/').headers['Location'].endswith('/-1/')
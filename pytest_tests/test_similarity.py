@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+
+'''
+Tests the index of easily confused cards and drawing them together
+'''
+
+from __future__ import unicode_literals, print_function
+
+from hikariita import APP, get_db, db, similarity
+from hikariita.similarity import card_features
+
+HEADERS = ['Hanzi', 'Pinyin', 'English']
+ROWS = [
+    ('大人', 'dà rén', 'adult'),
+    ('大学', 'dà xué', 'university'),
+    ('学生', 'xué shēng', 'student'),
+    ('苹果', 'píng guǒ', 'apple'),
+    ('你好', 'nǐ hǎo', 'hello'),
+]
+
+
+def _ids_by_hanzi(cursor):
+    '''
+    Returns the test cards' ids keyed by hanzi
+    '''
+    return dict(
+        (values[0], card_id)
+        for (card_id, values) in db.get_lesson_cards(cursor, 'Words', '1').items()
+    )
+
+
+def _neighbour_ids(cursor):
+    '''
+    Returns the set of neighbours of every card
+    '''
+    cursor.execute('SELECT id FROM cards')
+    return dict(
+        (row[0], set(neighbour for (neighbour, _) in db.get_neighbours(cursor, row[0])))
+        for row in cursor.fetchall()
+    )
+
+
+def test_card_features():
+    '''
+    Shared characters and toneless readings make features in common
+    '''
+    shared = card_features(['大人', 'dà rén']) & card_features(['大学', 'da xue'])
+    assert 'c:大' in shared
+    assert 'b:da' in shared
+    assert card_features(['', ' ']) == set()
+
+
+def test_incremental_matches_rebuild(empty_client):
+    '''
+    Importing and editing keeps the neighbours as a full rebuild finds them
+    '''
+    del empty_client
+    with APP.app_context():
+        cursor = get_db().cursor()
+        db.create_content(cursor, 'Words', '1', HEADERS, ROWS[:3])
+        db.create_content(cursor, 'Words', '1', HEADERS, ROWS[3:])
+        ids = _ids_by_hanzi(cursor)
+        assert db.get_neighbours(cursor, ids['大人'])[0][0] == ids['大学']
+        before = dict(db.get_neighbours(cursor, ids['大人'])).get(ids['你好'], 0)
+
+        db.edit_card_fields(cursor, ids['你好'], [('hanzi', '好人')])
+        db.update_neighbours(cursor)
+        assert dict(db.get_neighbours(cursor, ids['大人']))[ids['你好']] > before
+
+        db.delete_cards(cursor, [ids['大学']])
+        db.update_neighbours(cursor)
+        incremental = _neighbour_ids(cursor)
+        assert ids['大学'] not in incremental[ids['学生']]
+
+        assert db.rebuild_neighbours(cursor, processes=1) == 4
+        assert _neighbour_ids(cursor) == incremental
+
+
+def test_frequent_features_skipped(empty_client, monkeypatch):
+    '''
+    Features shared by more than MAX_POSTINGS cards are left out of the
+    incremental update, as they are from a rebuild
+    '''
+    del empty_client
+    monkeypatch.setattr(similarity, 'MAX_POSTINGS', 2)
+    with APP.app_context():
+        cursor = get_db().cursor()
+        db.create_content(
+            cursor, 'Words', '1', HEADERS, ROWS + [('大', 'dà', 'big')])
+        incremental = _neighbour_ids(cursor)
+        ids = _ids_by_hanzi(cursor)
+        assert ids['大学'] not in incremental[ids['大']]
+
+        db.rebuild_neighbours(cursor, processes=1)
+        assert _neighbour_ids(cursor) == incremental
+
+
+def test_draw_confusables(empty_client):
+    '''
+    Cards confused with the working set are drawn before anything else
+    '''
+    del empty_client
+    with APP.app_context():
+        cursor = get_db().cursor()
+        db.create_content(cursor, 'Words', '1', HEADERS, ROWS)
+        db.set_prefered_book(cursor, 'Words')
+        ids = _ids_by_hanzi(cursor)
+
+        db.clear_working_set(cursor)
+        db.add_card_to_working_set(cursor, ids['大人'])
+        assert db.draw_confusables(cursor, 1) == 1
+        cursor.execute('SELECT card_id FROM working_set ORDER BY id')
+        assert [row[0] for row in cursor.fetchall()] == [ids['大人'], ids['大学']]
@@ -0,0 +1,74 @@
+'''
+Tests that the scheduler simulator mirrors db.py and replays history
+'''
+
+from __future__ import print_function
+
+from hikariita import APP, get_db, get_db_path, db, simulator
+
+
+def _study(cursor, votes):
+    '''
+    Votes on the next card of the working set the given number of times
+    '''
+    for vote in votes:
+        db.create_vote(cursor, db.get_next_card(cursor), vote)
+
+
+def test_snapshot_and_replay(one_book_twenty_cards_client):
+    '''
+    The snapshot matches the database, and replaying it from scratch votes
+    the same number of times on each card
+    '''
+    del one_book_twenty_cards_client
+    with APP.app_context():
+        connection = get_db()
+        cursor = connection.cursor()
+        db.set_prefered_book(cursor, 'Mandarin')
+        db.clear_working_set(cursor)
+        db.init_working_set(cursor)
+        _study(cursor, [1, -1, 0, 1, -1, -1, 1, 0] * 5)
+        connection.commit()
+
+        snapshot = simulator.load_snapshot(get_db_path())
+        assert len(snapshot) == 20
+        assert len(snapshot.history) == 40
+        for (i, item_id) in enumerate(snapshot.item_ids):
+            cursor.execute('SELECT bucket FROM items WHERE id == ?', (item_id,))
+            assert simulator.BUCKET_NAMES[snapshot.buckets[i]] == cursor.fetchone()[0]
+        assert [snapshot.item_ids[i] for i in snapshot.working_set] == \
+            [row[0] for row in cursor.execute('SELECT item_id FROM working_set ORDER BY id')]
+
+    simulation = simulator.Simulation(
+        snapshot, simulator.CURRENT_POLICY, seed=1, from_scratch=True)
+    simulation.run(days=5, reviews_per_day=40)
+    assert list(simulation.replay) == list(snapshot.history_starts[1:])
+
+
+def test_policies(one_book_twenty_cards_client):
+    '''
+    Policies report review load and queries, the same in parallel or not
+    '''
+    del one_book_twenty_cards_client
+    with APP.app_context():
+        snapshot = simulator.load_snapshot(get_db_path())
+    policies = [
+        simulator.CURRENT_POLICY,
+        simulator.parse_policy('working_set_size=3,easy_ratio=0'),
+    ]
+    serial = simulator.run_policies(
+        snapshot, policies, days=3, reviews_per_day=20, seed=7, processes=1)
+    parallel = simulator.run_policies(
+        snapshot, policies, days=3, reviews_per_day=20, seed=7, processes=2)
+    for report in serial:
+        report['seconds'] = 0
+    for report in parallel:
+        report['seconds'] = 0
+    assert serial == parallel
+
+    (current, small) = serial
+    assert current['reviews'] == small['reviews'] == 60
+    assert current['introduced'] == 20
+    assert small['policy']['working_set_size'] == 3
+    assert current['queries']['next_card'] == 60
+    assert current['queries_per_review'] > 5
@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+
+'''
+Tests that cards are stored as one packed row each
+'''
+
+from __future__ import unicode_literals, print_function
+
+import sqlite3
+
+from hikariita import APP, get_db, db
+
+
+def _old_import(cursor, book, lesson, headers, rows):
+    '''
+    Imports cards the way older versions did, one attribute row per field
+    and a new Book and Lesson attribute for every lesson
+    '''
+    book_id = db.create_attribute(cursor, 'Book', book)
+    lesson_id = db.create_attribute(cursor, 'Lesson', lesson)
+    for row in rows:
+        cursor.execute('INSERT INTO cards (bucket) VALUES ("genesis")')
+        card_id = cursor.lastrowid
+        for (name, value) in zip(headers, row):
+            attribute_id = db.create_attribute(cursor, name, value)
+            db.associate_card_and_attribute(cursor, card_id, attribute_id)
+        db.associate_card_and_attribute(cursor, card_id, book_id)
+        db.associate_card_and_attribute(cursor, card_id, lesson_id)
+
+
+def test_card_fields(one_book_twenty_cards_client):
+    '''
+    Fields come back in header order, and only facets are attribute rows
+    '''
+    del one_book_twenty_cards_client
+    with APP.app_context():
+        cursor = get_db().cursor()
+        assert db.get_card_attributes(cursor, 1) == [
+            ('hanzi', '户外'), ('pinyin', 'hù wài'), ('english', 'outdoor')]
+        cursor.execute('SELECT name, COUNT(*) FROM attributes GROUP BY name')
+        assert dict(cursor.fetchall()) == {'Book': 1, 'Lesson': 2}
+
+
+def test_edit_card(one_book_twenty_cards_client):
+    '''
+    Editing a card only changes that card, and fields its book doesn't have
+    are refused without adding headers
+    '''
+    client = one_book_twenty_cards_client
+    response = client.post(
+        '/cards/1/edit/', data={'english': 'outdoors', 'notes': 'new field'})
+    assert response.status_code == 400
+    response = client.post('/cards/1/edit/', data={'english': 'outdoors'})
+    assert response.status_code == 302
+    with APP.app_context():
+        cursor = get_db().cursor()
+        assert db.get_card_attributes(cursor, 1) == [
+            ('hanzi', '户外'), ('pinyin', 'hù wài'), ('english', 'outdoors')]
+        assert len(db.get_card_attributes(cursor, 2)) == 3
+
+
+def test_migration():
+    '''
+    Databases from before packing are migrated on init
+    '''
+    connection = sqlite3.connect(':memory:')
+    cursor = connection.cursor()
+    cursor.executescript(db.INIT_DB_COMMANDS)
+    _old_import(cursor, 'Genki 1', 'Lesson 1', ('kanji', 'meaning'),
+                [('今', 'now'), ('学生', 'student')])
+    _old_import(cursor, 'Genki 1', 'Lesson 2', ('kanji', 'hiragana'),
+                [('皿', 'さら')])
+    db.create_vote(cursor, 3, -1)
+    db.set_prefered_book(cursor, 'Genki 1')
+
+    db.init(cursor)
+    assert db.get_card_attributes(cursor, 1) == [
+        ('kanji', '今'), ('meaning', 'now'), ('hiragana', '')]
+    assert db.get_card_attributes(cursor, 3) == [
+        ('kanji', '皿'), ('meaning', ''), ('hiragana', 'さら')]
+    cursor.execute('SELECT COUNT(*) FROM attributes')
+    assert cursor.fetchone()[0] == 3
+    assert db.get_books(cursor) == ['Genki 1']
+    assert db.get_working_set_size(cursor) == 3
+
+    # Running it again doesn't change anything
+    db.init(cursor)
+    assert db.get_card_attributes(cursor, 2) == [
+        ('kanji', '学生'), ('meaning', 'student'), ('hiragana', '')]
@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+
+'''
+Tests that re-syncing a lesson only touches what changed
+'''
+
+from __future__ import unicode_literals, print_function
+
+from hikariita import APP, get_db, db
+
+from conftest import MANDARIN_BOOKS
+
+HEADERS = MANDARIN_BOOKS['headers']
+LESSON = 'Lesson  - Class 1'
+ROWS = MANDARIN_BOOKS['Mandarin'][LESSON]
+
+
+def _lesson(cursor):
+    '''
+    Returns the lesson's cards keyed by hanzi
+    '''
+    result = {}
+    for card_id in db.get_lesson_cards(cursor, 'Mandarin', LESSON):
+        fields = dict(db.get_card_attributes(cursor, card_id))
+        result[fields['hanzi']] = (card_id, fields)
+    return result
+
+
+def test_resync_unchanged(one_book_twenty_cards_client):
+    '''
+    Syncing the same content again changes nothing
+    '''
+    del one_book_twenty_cards_client
+    with APP.app_context():
+        cursor = get_db().cursor()
+        result = db.sync_content(cursor, 'Mandarin', LESSON, HEADERS, ROWS)
+        assert result == {
+            'inserted': 0, 'updated': 0, 'deleted': 0, 'unlinked': 0,
+            'unchanged': 10}
+        cursor.execute('SELECT COUNT(*) FROM cards')
+        assert cursor.fetchone()[0] == 20
+
+
+def test_resync_by_key(one_book_twenty_cards_client):
+    '''
+    Edits keep the card and its votes, new rows are added, and missing rows
+    are deleted only when asked to
+    '''
+    del one_book_twenty_cards_client
+    with APP.app_context():
+        connection = get_db()
+        cursor = connection.cursor()
+        (card_id, _) = _lesson(cursor)['冲浪']
+        db.create_vote(cursor, card_id, 1)
+
+        rows = [row for row in ROWS if row[0] != '滑雪']
+        rows[2] = ('冲浪', 'chōng làng', 'to go surfing')
+        rows.append(('游泳', 'yóu yǒng', 'to swim'))
+        result = db.sync_content(
+            cursor, 'Mandarin', LESSON, HEADERS, rows, key_column='hanzi')
+        assert result == {
+            'inserted': 1, 'updated': 1, 'deleted': 0, 'unlinked': 0,
+            'unchanged': 8}
+
+        lesson = _lesson(cursor)
+        assert lesson['冲浪'][0] == card_id
+        assert lesson['冲浪'][1]['english'] == 'to go surfing'
+        assert '游泳' in lesson
+        assert '滑雪' in lesson
+        assert db.calculate_state_of_card(cursor, card_id) is None
+        cursor.execute('SELECT COUNT(*) FROM votes WHERE card_id == ?', (card_id,))
+        assert cursor.fetchone()[0] == 1
+
+        result = db.sync_content(
+            cursor, 'Mandarin', LESSON, HEADERS, rows,
+            key_column='hanzi', delete_missing=True)
+        assert result['deleted'] == 1
+        assert '滑雪' not in _lesson(cursor)
+        connection.commit()
@@ -0,0 +1,99 @@
+'''
+Tests that configure_app warms the app up and /healthz reports it
+'''
+
+from __future__ import print_function
+
+import os
+import threading
+
+import pytest
+
+import hikariita
+from hikariita import APP, cache, configure_app, warmup
+
+
+@pytest.fixture
+def warm_client(one_book_twenty_cards_client, tmp_path, monkeypatch):
+    '''
+    Returns a client of an app warmed up synchronously, with its template
+    bytecode cached in a temporary folder
+    '''
+    template_cache_dir = str(tmp_path / 'jinja')
+    # As if in a new process, which hasn't compiled any template yet
+    APP.jinja_env.cache.clear()
+    # configure_app replaces it, so have it put back afterwards
+    monkeypatch.setattr(hikariita, 'WARM_UP', hikariita.WARM_UP)
+    configure_app({
+        'TEMPLATE_CACHE_DIR': template_cache_dir,
+        'WARM_UP_IN_BACKGROUND': False,
+        'BACKGROUND_REFILL': False,
+    })
+    yield (one_book_twenty_cards_client, template_cache_dir)
+    APP.jinja_env.bytecode_cache = None
+    APP.config.update(WARM_UP_IN_BACKGROUND=True, BACKGROUND_REFILL=True)
+    del APP.config['TEMPLATE_CACHE_DIR']
+
+
+def test_ready_after_warm_up(warm_client):
+    '''
+    Every step ran, templates were compiled to disk and the metadata was
+    cached
+    '''
+    (client, template_cache_dir) = warm_client
+    response = client.get('/healthz')
+    assert response.status_code == 200
+    report = response.get_json()
+    assert report['ready']
+    assert report['error'] is None
+    assert sorted(report['steps']) == [
+        'database', 'queries', 'read_ahead', 'templates']
+    assert len(os.listdir(template_cache_dir)) == len(
+        APP.jinja_env.list_templates())
+    assert APP.config['DATABASE'] in cache.METADATA.entries
+
+
+def test_first_fast_request(warm_client):
+    '''
+    The first fast request after warm-up is reported, but not /healthz
+    '''
+    (client, _) = warm_client
+    client.get('/healthz')
+    assert client.get('/healthz').get_json()['first_fast_request'] is None
+    client.get('/stats/')
+    report = client.get('/healthz').get_json()
+    assert report['ready_after'] <= report['first_fast_request']
+
+
+def test_not_ready_while_warming_up(one_book_twenty_cards_client, monkeypatch):
+    '''
+    /healthz answers 503 until the last step finished
+    '''
+    release = threading.Event()
+    warm_up = warmup.WarmUp()
+    monkeypatch.setattr(hikariita, 'WARM_UP', warm_up)
+    warm_up.start([('slow', lambda: release.wait(5))])
+    response = one_book_twenty_cards_client.get('/healthz')
+    assert response.status_code == 503
+    assert not response.get_json()['ready']
+
+    release.set()
+    assert warm_up.ready.wait(5)
+    assert one_book_twenty_cards_client.get('/healthz').status_code == 200
+
+
+def test_failed_warm_up(one_book_twenty_cards_client, monkeypatch):
+    '''
+    A failing step keeps the app from ever reporting ready
+    '''
+    def fail():
+        raise IOError('disk on fire')
+
+    warm_up = warmup.WarmUp()
+    monkeypatch.setattr(hikariita, 'WARM_UP', warm_up)
+    warm_up.start([('database', fail), ('templates', lambda: None)],
+                  background=False)
+    response = one_book_twenty_cards_client.get('/healthz')
+    assert response.status_code == 503
+    assert 'disk on fire' in response.get_json()['error']
+    assert response.get_json()['steps'] == {}
@@ -0,0 +1,96 @@
+'''
+Tests that the working set is refilled in a few set-based statements
+'''
+
+from __future__ import print_function
+
+from hikariita import APP, get_db, db
+
+
+class _CountingCursor(object):
+    '''
+    Cursor counting the statements the code runs through it.  Tracing the
+    connection would also count every trigger program a statement fires.
+    '''
+
+    def __init__(self, cursor):
+        self.cursor = cursor
+        self.statements = 0
+
+    def execute(self, *args):
+        ''' Counts one statement '''
+        self.statements += 1
+        return self.cursor.execute(*args)
+
+    def executemany(self, command, parameters):
+        ''' Counts one statement per row of parameters '''
+        parameters = list(parameters)
+        self.statements += len(parameters)
+        return self.cursor.executemany(command, parameters)
+
+    def __getattr__(self, name):
+        return getattr(self.cursor, name)
+
+
+def _count_statements(cursor, func):
+    '''
+    Runs func with a counting cursor and returns (its result, how many
+    statements it executed)
+    '''
+    counting = _CountingCursor(cursor)
+    return (func(counting), counting.statements)
+
+
+def test_refill_statement_count(one_book_twenty_cards_client):
+    '''
+    A full refill takes a handful of statements and never duplicates cards
+    '''
+    del one_book_twenty_cards_client
+    with APP.app_context():
+        cursor = get_db().cursor()
+        db.set_prefered_book(cursor, 'Mandarin')
+        db.clear_working_set(cursor)
+
+        (added, statements) = _count_statements(
+            cursor, db.init_working_set)
+        assert added == db.DEFAULT_WORKING_SET_SIZE
+        assert statements <= 5
+
+        cursor.execute('SELECT COUNT(DISTINCT card_id), COUNT(*) FROM working_set')
+        assert tuple(cursor.fetchone()) == (added, added)
+
+        # Already full, so nothing else to do
+        (added, statements) = _count_statements(
+            cursor, db.init_working_set)
+        assert added == 0
+        assert statements <= 2
+
+
+def test_deck_settings(one_book_twenty_cards_client):
+    '''
+    The working set size can be changed per book
+    '''
+    client = one_book_twenty_cards_client
+    client.post(
+        '/preferences/edit',
+        data={'Book': 'Mandarin'},
+        headers={'Referer': '/preferences/'},
+    )
+    response = client.post(
+        '/preferences/deck',
+        data={'working_set_size': '12', 'easy_ratio': '0.5'},
+    )
+    assert response.status_code == 302
+    assert 'value="12"' in client.get('/preferences/').data.decode('utf8')
+
+    with APP.app_context():
+        cursor = get_db().cursor()
+        assert db.get_deck_settings(cursor) == (
+            12, 0.5, db.DEFAULT_NEW_CARDS_PER_DAY)
+        assert db.get_working_set_size(cursor) == 12
+
+    response = client.post(
+        '/preferences/deck',
+        data={'working_set_size': '0', 'easy_ratio': '0.5'},
+    )
+    assert response.status_code == 400